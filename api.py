@@ -4,253 +4,77 @@ Web API 服务器，提供图片生成接口
 """
 import io
 import logging
-import base64
-import urllib.request
-import urllib.parse
+import time
 import uuid
-from typing import Optional
-from flask import Flask, request, send_file, jsonify
+from typing import Any, Dict, List, Optional, Tuple
+from flask import Flask, g, request, send_file, jsonify, make_response
 from flask_cors import CORS
-from PIL import Image
+from werkzeug.exceptions import HTTPException
 
-from config_loader import load_config
-from image_fit_paste import paste_image_auto
-from text_fit_draw import draw_text_auto
+from image_encoder import MIME_TYPES, negotiate_format
+from log_pipeline import new_request_id
+from metrics import CONTENT_TYPE, IN_FLIGHT, REGISTRY, REQUEST_SECONDS, REQUESTS
+from profiler import ProfileBusyError
+from service import (
+    AdminAuthError,
+    RenderError,
+    batch_json,
+    batch_log_fields,
+    batch_multipart,
+    batch_zip,
+    config,
+    generate_log_fields,
+    parse_batch_request,
+    parse_flag,
+    parse_profile_args,
+    public_urls,
+    render_image_bytes,
+    request_logger,
+    require_admin,
+    result_cache_key,
+    run_profile,
+    slow_requests,
+    submit_batch,
+)
+from upload_reader import Upload, UploadError, digest_file, spool_stream
 
 app = Flask(__name__)
 # 启用CORS支持，允许跨域请求
 CORS(app, resources={r"/*": {"origins": "*"}})
-config = load_config()
-
-# 配置日志
-logging.basicConfig(
-    level=getattr(logging, config.logging_level.upper(), logging.INFO),
-    format="%(asctime)s [%(levelname)s] %(message)s",
-)
+# 请求体大小上限（JSON、multipart 与原始图片上传），超出时返回 413
+app.config['MAX_CONTENT_LENGTH'] = config.max_upload_bytes
 
-# 全局变量：当前使用的表情和比例
-current_emotion = "#普通#"
-last_used_image_file = config.baseimage_mapping.get(current_emotion, config.baseimage_file)
-ratio = 1
 
-
-def is_vertical_image(image: Image.Image) -> bool:
-    """
-    判断图像是否为竖图
-    """
-    return image.height * ratio > image.width
+@app.before_request
+def _start_request_metrics():
+    g.request_start = time.perf_counter()
+    g.request_id = new_request_id(request.headers.get('X-Request-ID'))
+    # 生成类接口在此写入请求日志字段
+    g.log_fields = None
+    IN_FLIGHT.inc()
 
 
-def get_ratio(x1, y1, x2, y2):
+@app.after_request
+def _record_request_metrics(response):
     """
-    计算并更新全局比例
+    按路由统计请求数与耗时（未匹配的路径归为 other，避免标签无限增长），
+    并为生成类接口与失败的请求写请求日志
     """
-    global ratio
-    try:
-        ratio = (x2 - x1) / (y2 - y1)
-        logging.info("比例: %s", ratio)
-    except Exception as e:
-        logging.error("计算比例时出错: %s", e)
-
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'other'
+    duration = time.perf_counter() - g.request_start
+    REQUESTS.inc(endpoint=endpoint, status=str(response.status_code))
+    REQUEST_SECONDS.observe(duration, endpoint=endpoint)
+    response.headers['X-Request-ID'] = g.request_id
+    if g.log_fields is not None or response.status_code >= 400:
+        fields = {'request_id': g.request_id, 'method': request.method, 'path': endpoint}
+        fields.update(g.log_fields or {})
+        request_logger.log(response.status_code, duration, fields)
+    return response
 
-def load_image_from_url_or_base64(image_input: str) -> Optional[Image.Image]:
-    """
-    从URL或base64字符串加载图片
-    
-    Args:
-        image_input: 图片URL或base64编码的图片数据（支持 data:image/...;base64,... 格式）
-    
-    Returns:
-        PIL Image对象，如果加载失败返回None
-    """
-    try:
-        # URL解码（处理URL编码的字符）
-        image_input = urllib.parse.unquote(image_input)
-        
-        # 检查是否是base64格式
-        if image_input.startswith('data:image'):
-            # 处理 data:image/png;base64,xxx 格式
-            header, data = image_input.split(',', 1)
-            image_data = base64.b64decode(data)
-            return Image.open(io.BytesIO(image_data))
-        elif image_input.startswith('http://') or image_input.startswith('https://'):
-            # 从URL下载图片
-            req = urllib.request.Request(image_input)
-            req.add_header('User-Agent', 'Mozilla/5.0')
-            with urllib.request.urlopen(req, timeout=10) as response:
-                image_data = response.read()
-                return Image.open(io.BytesIO(image_data))
-        else:
-            # 尝试直接作为base64解码
-            image_data = base64.b64decode(image_input)
-            return Image.open(io.BytesIO(image_data))
-    except Exception as e:
-        logging.error(f"加载图片失败: {e}")
-        return None
-
-
-def process_text_and_image(text: str, image: Optional[Image.Image], emotion: Optional[str] = None) -> Optional[bytes]:
-    """
-    同时处理文本和图像内容，将其绘制到同一张图片上
-    
-    Args:
-        text: 文本内容
-        image: PIL Image对象（可选）
-        emotion: 表情标签（可选）
-    
-    Returns:
-        PNG图片的字节流，如果失败返回None
-    """
-    global last_used_image_file
-    
-    # 确定使用的底图
-    if emotion and emotion in config.baseimage_mapping:
-        last_used_image_file = config.baseimage_mapping[emotion]
-        logging.info(f"使用表情: {emotion}，底图: {last_used_image_file}")
-    elif not emotion:
-        # 如果没有指定表情，检查文本中是否包含表情标签
-        for keyword, img_file in config.baseimage_mapping.items():
-            if keyword in text:
-                last_used_image_file = img_file
-                text = text.replace(keyword, "").strip()
-                logging.info(f"检测到关键词 '{keyword}'，使用底图: {last_used_image_file}")
-                break
-    
-    if text == "" and image is None:
-        return None
-
-    # 获取配置的区域坐标
-    x1, y1 = config.text_box_topleft
-    x2, y2 = config.image_box_bottomright
-    region_width = x2 - x1
-    region_height = y2 - y1
-
-    # 只有图像的情况
-    if text == "" and image is not None:
-        logging.info("处理图片内容")
-        try:
-            return paste_image_auto(
-                image_source=last_used_image_file,
-                image_overlay=(
-                    config.base_overlay_file if config.use_base_overlay else None
-                ),
-                top_left=(x1, y1),
-                bottom_right=(x2, y2),
-                content_image=image,
-                align="center",
-                valign="middle",
-                padding=12,
-                allow_upscale=True,
-                keep_alpha=True,
-            )
-        except Exception as e:
-            logging.error("生成图片失败: %s", e)
-            return None
 
-    # 只有文本的情况
-    elif text != "" and image is None:
-        logging.info("从文本生成图片: " + text)
-        try:
-            return draw_text_auto(
-                image_source=last_used_image_file,
-                image_overlay=(
-                    config.base_overlay_file if config.use_base_overlay else None
-                ),
-                top_left=(x1, y1),
-                bottom_right=(x2, y2),
-                text=text,
-                color=(0, 0, 0),
-                max_font_height=64,
-                font_path=config.font_file,
-                wrap_algorithm=config.text_wrap_algorithm,
-            )
-        except Exception as e:
-            logging.error("生成图片失败: %s", e)
-            return None
-
-    # 同时有图像和文本的情况
-    else:
-        logging.info("同时处理文本和图片内容")
-        logging.info("文本内容: " + text)
-        get_ratio(x1, y1, x2, y2)
-        try:
-            # 根据图像方向决定排布方式
-            if is_vertical_image(image):
-                logging.info("使用左右排布（竖图）")
-                # 左右排布：图像在左，文本在右
-                spacing = 10
-                left_width = region_width // 2 - spacing // 2
-                right_width = region_width - left_width - spacing
-                
-                left_region_right = x1 + left_width
-                right_region_left = left_region_right + spacing
-                
-                # 先绘制左半部分的图像
-                intermediate_bytes = paste_image_auto(
-                    image_source=last_used_image_file,
-                    image_overlay=None,
-                    top_left=(x1, y1),
-                    bottom_right=(left_region_right, y2),
-                    content_image=image,
-                    align="center",
-                    valign="middle",
-                    padding=12,
-                    allow_upscale=True, 
-                    keep_alpha=True,
-                )
-                
-                # 在已有图像基础上添加右半部分的文本
-                final_bytes = draw_text_auto(
-                    image_source=io.BytesIO(intermediate_bytes),
-                    image_overlay=config.base_overlay_file if config.use_base_overlay else None,
-                    top_left=(right_region_left, y1),
-                    bottom_right=(x2, y2),
-                    text=text,
-                    color=(0, 0, 0),
-                    max_font_height=64,
-                    font_path=config.font_file,
-                    wrap_algorithm=config.text_wrap_algorithm,
-                )
-            else:
-                logging.info("使用上下排布（横图）")
-                # 上下排布：图像在上，文本在下
-                estimated_text_height = min(region_height // 2, 100)
-                image_region_bottom = y1 + (region_height - estimated_text_height)
-                text_region_top = image_region_bottom
-                text_region_bottom = y2
-                
-                # 先绘制图像
-                intermediate_bytes = paste_image_auto(
-                    image_source=last_used_image_file,
-                    image_overlay=None,
-                    top_left=(x1, y1),
-                    bottom_right=(x2, image_region_bottom),
-                    content_image=image,
-                    align="center",
-                    valign="middle",
-                    padding=12,
-                    allow_upscale=True, 
-                    keep_alpha=True,
-                )
-                
-                # 在已有图像基础上添加文本
-                final_bytes = draw_text_auto(
-                    image_source=io.BytesIO(intermediate_bytes),
-                    image_overlay=config.base_overlay_file if config.use_base_overlay else None,
-                    top_left=(x1, text_region_top),
-                    bottom_right=(x2, text_region_bottom),
-                    text=text,
-                    color=(0, 0, 0),
-                    max_font_height=64,
-                    font_path=config.font_file,
-                    wrap_algorithm=config.text_wrap_algorithm,
-                )
-            
-            return final_bytes
-            
-        except Exception as e:
-            logging.error("生成图片失败: %s", e)
-            return None
+@app.teardown_request
+def _finish_request_metrics(exc):
+    IN_FLIGHT.dec()
 
 
 @app.route('/')
@@ -263,6 +87,57 @@ def index():
         return "前端页面未找到，请确保index.html文件存在", 404
 
 
+def _cached_response(response, etag: str):
+    """为可缓存的响应附加强 ETag 与 Cache-Control"""
+    response.set_etag(etag)
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = config.result_cache_max_age
+    return response
+
+
+def _image_response(image_bytes: bytes, fmt: str, etag: Optional[str] = None):
+    """
+    以附件形式返回图片。可缓存的结果使用基于内容的稳定文件名与 ETag，
+    不可缓存的结果（远程图片）使用随机文件名且不附加缓存头。
+    """
+    name = etag[:16] if etag else uuid.uuid4().hex
+    response = send_file(
+        io.BytesIO(image_bytes),
+        mimetype=MIME_TYPES[fmt],
+        as_attachment=True,
+        download_name=f"{name}.{fmt}",
+    )
+    # 未显式指定格式时结果取决于 Accept 头
+    response.vary.add('Accept')
+    if etag is None:
+        return response
+    return _cached_response(response, etag)
+
+
+def _render_error_response(error: RenderError):
+    response = jsonify({'error': str(error)})
+    response.status_code = error.status
+    if error.retry_after is not None:
+        response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
+def _read_generate_request() -> Tuple[Optional[dict], Optional[Upload]]:
+    """
+    解析 /generate 请求，返回 (参数, 上传的图片)。
+    multipart/form-data 的图片放在文件字段 image 中；原始 image/* 请求体的参数放在查询字符串中。
+    """
+    if request.mimetype == 'multipart/form-data':
+        # werkzeug 已将文件字段流式写入临时文件
+        file = request.files.get('image')
+        upload = digest_file(file.stream) if file and file.filename else None
+        return request.form, upload
+    if request.mimetype.startswith('image/') or request.mimetype == 'application/octet-stream':
+        return request.args, spool_stream(request.stream, config.max_upload_bytes)
+    return request.get_json(), None
+
+
 @app.route('/generate', methods=['POST'])
 def generate_image():
     """
@@ -272,65 +147,131 @@ def generate_image():
         text: 文本内容（可选）
         image_url: 图片URL或base64编码的图片数据（可选）
         emotion: 表情标签，如 #普通#、#开心# 等（可选）
+        format: 输出格式 png / webp / jpeg / avif（可选，也可用查询参数 ?format= 或 Accept 头指定）
+        crop: 为 true 时只返回文本/图片所在区域，而不是整张图片（可选，也可用查询参数 ?crop=1 指定）
+
+    也可以直接上传图片：
+        multipart/form-data：上述参数作为表单字段，图片放在文件字段 image 中
+        原始图片请求体（Content-Type: image/*）：上述参数放在查询字符串中
     
     返回:
-        生成的PNG图片，或错误信息（JSON格式）
+        生成的图片（默认PNG），或错误信息（JSON格式）
+        相同请求返回相同的强 ETag；携带匹配的 If-None-Match 时返回 304
     
     示例:
         POST /generate
         Body: {"text": "你好世界", "emotion": "#开心#"}
     """
     try:
-        # 获取JSON数据
-        data = request.get_json()
-        if not data:
+        # 获取请求参数（JSON、表单或查询字符串）与上传的图片
+        try:
+            data, upload = _read_generate_request()
+        except UploadError as e:
+            return jsonify({'error': str(e)}), 400
+        if not data and upload is None:
             return jsonify({
                 'error': '请提供JSON格式的请求体'
             }), 400
+        data = data or {}
         
         text = data.get('text', '').strip()
         image_url = data.get('image_url', '').strip()
         emotion = data.get('emotion', '').strip()
         
         # 如果没有提供任何内容，返回错误
-        if not text and not image_url:
+        if not text and not image_url and upload is None:
             return jsonify({
                 'error': '请至少提供 text 或 image_url 参数之一'
             }), 400
         
-        # 加载图片（如果提供了）
-        image = None
-        if image_url:
-            image = load_image_from_url_or_base64(image_url)
-            if image is None:
-                return jsonify({
-                    'error': '无法加载图片，请检查 image_url 参数是否正确'
-                }), 400
-        
-        # 处理表情参数
-        emotion_tag = emotion if emotion else None
-        
-        # 生成图片
-        png_bytes = process_text_and_image(text, image, emotion_tag)
-        
-        if png_bytes is None:
-            return jsonify({
-                'error': '生成图片失败，请检查参数是否正确'
-            }), 500
-        
-        # 生成UUID文件名
-        filename = f"{uuid.uuid4()}.png"
-        
-        # 返回图片，设置Content-Disposition头以支持下载
-        return send_file(
-            io.BytesIO(png_bytes),
-            mimetype='image/png',
-            as_attachment=True,
-            download_name=filename
-        )
+        # 输出格式：format 参数优先，其次 Accept 头，最后使用配置的默认格式
+        try:
+            fmt = negotiate_format(
+                data.get('format') or request.args.get('format'),
+                request.headers.get('Accept'),
+                config.output_format,
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        crop = parse_flag(data.get('crop') or request.args.get('crop'))
+        g.log_fields = generate_log_fields(text, emotion, image_url, fmt, upload, crop)
+
+        cache_key = result_cache_key(text, emotion, image_url, fmt, upload, crop)
+        etag = cache_key[:32] if cache_key is not None else None
+        if etag is not None and request.if_none_match.contains(etag):
+            return _cached_response(make_response('', 304), etag)
+
+        try:
+            image_bytes = render_image_bytes(
+                text, emotion, image_url, fmt, upload, cache_key, crop, log_fields=g.log_fields
+            )
+        except RenderError as e:
+            return _render_error_response(e)
+        return _image_response(image_bytes, fmt, etag)
         
+    except HTTPException:
+        # 请求体过大（413）、JSON 格式错误等交由 Flask 返回对应状态码
+        raise
+    except Exception as e:
+        logging.error("API错误: %s", e, exc_info=True)
+        return jsonify({
+            'error': f'服务器内部错误: {str(e)}'
+        }), 500
+
+
+def _batch_zip_response(results: List[Dict[str, Any]], fmt: str):
+    """ZIP 形式：成功的条目为 000.png 等文件，manifest.json 记录每一项的状态"""
+    return send_file(io.BytesIO(batch_zip(results, fmt)), mimetype='application/zip',
+                     as_attachment=True, download_name='batch.zip')
+
+
+def _batch_multipart_response(results: List[Dict[str, Any]], fmt: str):
+    """multipart/mixed 形式：每项一个部分，失败的条目为 JSON 错误信息"""
+    body, boundary = batch_multipart(results, fmt)
+    response = make_response(body)
+    response.mimetype = 'multipart/mixed'
+    response.mimetype_params['boundary'] = boundary
+    return response
+
+
+@app.route('/generate/batch', methods=['POST'])
+def generate_batch():
+    """
+    批量生成图片的API端点，条目并行渲染，单项失败不影响其他条目
+
+    JSON Body参数:
+        items: 条目数组，每项与 /generate 相同：{"text": ..., "emotion": ..., "image_url": ...}
+               （也可以直接以数组作为请求体）
+        format: 输出格式，对全部条目生效（可选，同 /generate）
+        crop: 只返回文本/图片所在区域，对全部条目生效（可选，同 /generate）
+        output: 返回形式 json / zip / multipart（可选，也可用查询参数 ?output= 或 Accept 头指定，默认 json）
+
+    返回:
+        json: {"results": [{"index": 0, "status": 200, "etag": ..., "data_uri": ...}, {"index": 1, "status": 400, "error": ...}]}
+        zip: 000.png、001.png ... 与记录每项状态的 manifest.json
+        multipart: multipart/mixed，每项一个部分，带 X-Item-Index / X-Item-Status 头
+    """
+    try:
+        try:
+            items, fmt, output, crop = parse_batch_request(
+                request.get_json(), request.args, request.headers.get('Accept'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        results = [f.result() for f in submit_batch(items, fmt, crop)]
+        g.log_fields = batch_log_fields(results, fmt, output, crop)
+
+        if output == 'zip':
+            return _batch_zip_response(results, fmt)
+        if output == 'multipart':
+            return _batch_multipart_response(results, fmt)
+        return jsonify(batch_json(results, fmt))
+
+    except HTTPException:
+        raise
     except Exception as e:
-        logging.error(f"API错误: {e}", exc_info=True)
+        logging.error("API错误: %s", e, exc_info=True)
         return jsonify({
             'error': f'服务器内部错误: {str(e)}'
         }), 500
@@ -343,18 +284,60 @@ def get_config():
     # 如果通过反向代理访问，使用请求头中的信息
     scheme = request.headers.get('X-Forwarded-Proto', request.scheme)
     host = request.headers.get('X-Forwarded-Host', request.host.split(':')[0])
-    
-    # 如果使用标准端口，不显示端口号；否则显示端口
-    if (scheme == 'https' and request.environ.get('SERVER_PORT') == '443') or \
-       (scheme == 'http' and request.environ.get('SERVER_PORT') == '80'):
-        base_url = f'{scheme}://{host}'
-    else:
-        base_url = f'{scheme}://{host}:{config.server_port}'
-    
-    return jsonify({
-        'server_url': base_url,
-        'api_url': f'{base_url}/generate'
-    })
+    return jsonify(public_urls(scheme, host, request.environ.get('SERVER_PORT')))
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus 文本格式的指标：各阶段耗时、缓存命中、渲染队列深度与处理中的请求数"""
+    if not config.metrics_enabled:
+        return jsonify({'error': '未找到'}), 404
+    return REGISTRY.expose(), 200, {'Content-Type': CONTENT_TYPE}
+
+
+def _check_admin():
+    """校验管理令牌，失败时返回错误响应，通过时返回 None"""
+    try:
+        require_admin(request.headers.get('Authorization'), request.headers.get('X-Admin-Token'))
+    except AdminAuthError as e:
+        return jsonify({'error': str(e)}), e.status
+    return None
+
+
+@app.route('/admin/profile', methods=['GET'])
+def admin_profile():
+    """
+    对渲染任务做采样分析，阻塞到结束后以折叠栈文本返回（可直接交给 flamegraph.pl 或 speedscope）
+
+    查询参数:
+        seconds: 持续时间（秒），默认 10，最多 300
+        requests: 采样的渲染任务数达到该值时提前结束（可选）
+        interval_ms: 采样间隔（毫秒），默认 5
+    """
+    error = _check_admin()
+    if error is not None:
+        return error
+    try:
+        session = run_profile(*parse_profile_args(request.args))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except ProfileBusyError as e:
+        return jsonify({'error': str(e)}), 409
+    response = make_response(session.collapsed())
+    response.mimetype = 'text/plain'
+    response.headers['Content-Disposition'] = f'attachment; filename=profile-{int(session.started)}.folded'
+    response.headers['X-Profile-Requests'] = str(session.requests)
+    return response
+
+
+@app.route('/admin/slow-requests', methods=['GET'])
+def admin_slow_requests():
+    """慢请求缓冲区中的记录（含各阶段耗时），查询参数 clear=1 时读取后清空"""
+    error = _check_admin()
+    if error is not None:
+        return error
+    entries = slow_requests.entries(clear=parse_flag(request.args.get('clear')))
+    return jsonify({'threshold_ms': config.slow_request_ms, 'requests': entries})
 
 
 if __name__ == '__main__':
@@ -362,5 +345,6 @@ if __name__ == '__main__':
     server_url = f"http://www.hvenjustic.top:{config.server_port}"
     logging.info(f"前端页面: {server_url}/")
     logging.info(f"API端点: {server_url}/generate")
-    app.run(host=config.server_host, port=config.server_port, debug=False)
+    # 请求之间不共享可变状态，可多线程处理
+    app.run(host=config.server_host, port=config.server_port, debug=False, threaded=True)
 
@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+"""
+ASGI 入口：提供与 Flask 版本（api.py）相同的 /、/api/config、/generate、/generate/batch、/metrics 与 /admin/* 接口。
+请求体读取与远程图片下载为异步 I/O，图片解码、合成与编码交给线程池与渲染进程池，
+少量进程即可同时保持大量 keep-alive 连接。
+
+运行：
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import json
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.formparser import FormDataParser
+from werkzeug.http import parse_etags, parse_options_header
+
+import service
+from image_encoder import MIME_TYPES, negotiate_format
+from log_pipeline import new_request_id
+from metrics import CONTENT_TYPE, IN_FLIGHT, REGISTRY, REQUEST_SECONDS, REQUESTS, stage
+from profiler import ProfileBusyError
+from service import (
+    AdminAuthError,
+    RenderError,
+    batch_json,
+    batch_log_fields,
+    batch_multipart,
+    batch_zip,
+    check_render_capacity,
+    config,
+    generate_log_fields,
+    load_input_image,
+    parse_batch_request,
+    parse_flag,
+    parse_profile_args,
+    public_urls,
+    remote_image_url,
+    render_loaded,
+    request_logger,
+    require_admin,
+    result_cache_key,
+    run_profile,
+    slow_requests,
+    submit_batch,
+)
+from upload_reader import Upload, UploadError, UploadSpooler, digest_file
+
+# 等待渲染结果的线程。线程数多于渲染执行器的名额，名额已满时请求在 RenderExecutor.run 中
+# 立即得到 503，而不是在线程池的队列中等待（这段等待不计入 render_timeout）
+_render_waiters = ThreadPoolExecutor(
+    max_workers=2 * service.render_executor.capacity,
+    thread_name_prefix="asgi-render",
+)
+# 解码 base64 / 上传图片与解析 multipart 请求体，不与渲染争用线程
+_io_executor = ThreadPoolExecutor(thread_name_prefix="asgi-io")
+
+_CORS_HEADERS = [("Access-Control-Allow-Origin", "*")]
+
+
+class _Response:
+    def __init__(self, status: int, body: bytes = b"", headers: Iterable[Tuple[str, str]] = ()):
+        self.status = status
+        self.body = body
+        self.headers = list(headers)
+
+
+def _json_response(data: Any, status: int = 200, headers: Iterable[Tuple[str, str]] = ()) -> _Response:
+    body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+    return _Response(status, body, [("Content-Type", "application/json")] + list(headers))
+
+
+def _error_response(error: RenderError) -> _Response:
+    headers = []
+    if error.retry_after is not None:
+        headers.append(("Retry-After", str(error.retry_after)))
+    return _json_response({'error': str(error)}, error.status, headers)
+
+
+def _cache_headers(etag: str) -> List[Tuple[str, str]]:
+    """可缓存响应的强 ETag 与 Cache-Control"""
+    return [
+        ("ETag", f'"{etag}"'),
+        ("Cache-Control", f"public, max-age={config.result_cache_max_age}"),
+    ]
+
+
+def _image_response(image_bytes: bytes, fmt: str, etag: Optional[str] = None) -> _Response:
+    """
+    以附件形式返回图片。可缓存的结果使用基于内容的稳定文件名与 ETag，
+    不可缓存的结果（远程图片）使用随机文件名且不附加缓存头。
+    """
+    name = etag[:16] if etag else uuid.uuid4().hex
+    headers = [
+        ("Content-Type", MIME_TYPES[fmt]),
+        ("Content-Disposition", f"attachment; filename={name}.{fmt}"),
+        # 未显式指定格式时结果取决于 Accept 头
+        ("Vary", "Accept"),
+    ]
+    if etag is not None:
+        headers += _cache_headers(etag)
+    return _Response(200, image_bytes, headers)
+
+
+class _HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class _Request:
+    """ASGI HTTP 请求的最小封装：请求行、查询参数、请求头与异步读取请求体"""
+
+    def __init__(self, scope: Dict[str, Any], receive):
+        self.scope = scope
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+        self.headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        self.mimetype, self.mimetype_params = parse_options_header(self.headers.get("content-type", ""))
+        self.request_id = new_request_id(self.headers.get("x-request-id"))
+        # 生成类接口在此写入请求日志字段
+        self.log_fields: Optional[Dict[str, Any]] = None
+        self._receive = receive
+
+    async def chunks(self, max_bytes: int):
+        """逐块读取请求体；声明或实际长度超过 max_bytes 时抛出 413"""
+        length = self.headers.get("content-length")
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise _HTTPError(413, f"请求体超过大小上限 {max_bytes} 字节")
+        while True:
+            message = await self._receive()
+            if message["type"] == "http.disconnect":
+                raise _HTTPError(400, "客户端已断开连接")
+            chunk = message.get("body", b"")
+            if chunk:
+                yield chunk
+            if not message.get("more_body", False):
+                return
+
+    async def body(self, max_bytes: int) -> bytes:
+        parts = []
+        size = 0
+        async for chunk in self.chunks(max_bytes):
+            size += len(chunk)
+            if size > max_bytes:
+                raise _HTTPError(413, f"请求体超过大小上限 {max_bytes} 字节")
+            parts.append(chunk)
+        return b"".join(parts)
+
+    async def spool(self, max_bytes: int) -> Upload:
+        """异步读取请求体并写入临时文件（小文件留在内存）"""
+        spooler = UploadSpooler(max_bytes)
+        try:
+            async for chunk in self.chunks(max_bytes):
+                spooler.write(chunk)
+        except UploadError as e:
+            raise _HTTPError(413, str(e)) from e
+        return spooler.finish()
+
+
+def _parse_multipart(upload: Upload, boundary: str):
+    """解析已落地的 multipart 请求体，返回 (表单字段, 文件字段 image 的上传数据)"""
+    parser = FormDataParser(max_content_length=config.max_upload_bytes)
+    _, form, files = parser.parse(upload.file, "multipart/form-data", upload.size, {"boundary": boundary})
+    file = files.get("image")
+    image = digest_file(file.stream) if file and file.filename else None
+    return form, image
+
+
+async def _read_generate_request(request: _Request) -> Tuple[Optional[dict], Optional[Upload]]:
+    """
+    解析 /generate 请求，返回 (参数, 上传的图片)。
+    multipart/form-data 的图片放在文件字段 image 中；原始 image/* 请求体的参数放在查询字符串中。
+    """
+    loop = asyncio.get_running_loop()
+    if request.mimetype == "multipart/form-data":
+        body = await request.spool(config.max_upload_bytes)
+        return await loop.run_in_executor(
+            _io_executor, _parse_multipart, body, request.mimetype_params.get("boundary", "")
+        )
+    if request.mimetype.startswith("image/") or request.mimetype == "application/octet-stream":
+        return request.args, await request.spool(config.max_upload_bytes)
+    if not _is_json(request.mimetype):
+        raise _HTTPError(415, "请求体必须为 JSON、multipart/form-data 或图片")
+    return await _read_json(request), None
+
+
+def _is_json(mimetype: str) -> bool:
+    return mimetype == "application/json" or (mimetype.startswith("application/") and mimetype.endswith("+json"))
+
+
+async def _read_json(request: _Request) -> Any:
+    body = await request.body(config.max_upload_bytes)
+    try:
+        return json.loads(body) if body else None
+    except ValueError as e:
+        raise _HTTPError(400, f"请求体不是有效的 JSON: {e}") from e
+
+
+async def _load_image(image_url: str, upload: Optional[Upload]):
+    """远程图片异步下载，base64 与上传数据在线程池中解码；失败时抛出 RenderError"""
+    url = remote_image_url(image_url) if upload is None else None
+    if url is None:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_io_executor, load_input_image, image_url, upload)
+    try:
+        # 同一 URL 的并发请求共享一次下载，shield 保证超时不会取消其他请求等待的任务
+        future = asyncio.wrap_future(service.image_fetcher.fetch_async(url))
+        with stage('image_load'):
+            return await asyncio.wait_for(asyncio.shield(future), config.fetch_timeout)
+    except Exception as e:
+        logging.error("加载图片失败: %s", e)
+        raise RenderError('无法加载图片，请检查 image_url 参数是否正确')
+
+
+async def generate_image(request: _Request) -> _Response:
+    """生成图片，参数与返回值同 Flask 版本的 /generate"""
+    try:
+        data, upload = await _read_generate_request(request)
+    except UploadError as e:
+        return _json_response({'error': str(e)}, 400)
+    if not data and upload is None:
+        return _json_response({'error': '请提供JSON格式的请求体'}, 400)
+    data = data or {}
+
+    text = data.get('text', '').strip()
+    image_url = data.get('image_url', '').strip()
+    emotion = data.get('emotion', '').strip()
+    if not text and not image_url and upload is None:
+        return _json_response({'error': '请至少提供 text 或 image_url 参数之一'}, 400)
+
+    # 输出格式：format 参数优先，其次 Accept 头，最后使用配置的默认格式
+    try:
+        fmt = negotiate_format(
+            data.get('format') or request.args.get('format'),
+            request.headers.get('accept'),
+            config.output_format,
+        )
+    except ValueError as e:
+        return _json_response({'error': str(e)}, 400)
+
+    crop = parse_flag(data.get('crop') or request.args.get('crop'))
+    request.log_fields = log_fields = generate_log_fields(text, emotion, image_url, fmt, upload, crop)
+
+    cache_key = result_cache_key(text, emotion, image_url, fmt, upload, crop)
+    etag = cache_key[:32] if cache_key is not None else None
+    if etag is not None:
+        if parse_etags(request.headers.get('if-none-match')).contains(etag):
+            return _Response(304, b"", _cache_headers(etag))
+        image_bytes = service.result_cache.get(cache_key)
+        log_fields['cache'] = 'hit' if image_bytes is not None else 'miss'
+        if image_bytes is not None:
+            return _image_response(image_bytes, fmt, etag)
+
+    try:
+        # 渲染队列已满时不再下载或解码图片
+        check_render_capacity()
+        image = await _load_image(image_url, upload)
+        loop = asyncio.get_running_loop()
+        image_bytes = await loop.run_in_executor(
+            _render_waiters, render_loaded, text, emotion, image, fmt, cache_key, crop, log_fields
+        )
+    except RenderError as e:
+        return _error_response(e)
+    return _image_response(image_bytes, fmt, etag)
+
+
+async def generate_batch(request: _Request) -> _Response:
+    """批量生成图片，参数与返回值同 Flask 版本的 /generate/batch"""
+    if not _is_json(request.mimetype):
+        raise _HTTPError(415, "请求体必须为 JSON")
+    try:
+        items, fmt, output, crop = parse_batch_request(
+            await _read_json(request), request.args, request.headers.get('accept'))
+    except ValueError as e:
+        return _json_response({'error': str(e)}, 400)
+
+    futures = submit_batch(items, fmt, crop)
+    results = await asyncio.gather(*(asyncio.wrap_future(f) for f in futures))
+    request.log_fields = batch_log_fields(results, fmt, output, crop)
+
+    if output == 'zip':
+        return _Response(200, batch_zip(results, fmt), [
+            ("Content-Type", "application/zip"),
+            ("Content-Disposition", "attachment; filename=batch.zip"),
+        ])
+    if output == 'multipart':
+        body, boundary = batch_multipart(results, fmt)
+        return _Response(200, body, [("Content-Type", f"multipart/mixed; boundary={boundary}")])
+    return _json_response(batch_json(results, fmt))
+
+
+async def index(request: _Request) -> _Response:
+    """提供前端页面"""
+    try:
+        with open('index.html', 'rb') as f:
+            return _Response(200, f.read(), [("Content-Type", "text/html; charset=utf-8")])
+    except FileNotFoundError:
+        body = "前端页面未找到，请确保index.html文件存在".encode("utf-8")
+        return _Response(404, body, [("Content-Type", "text/html; charset=utf-8")])
+
+
+async def get_config(request: _Request) -> _Response:
+    """返回服务器配置信息（供前端使用）"""
+    # 如果通过反向代理访问，使用请求头中的信息
+    scheme = request.headers.get('x-forwarded-proto', request.scope.get('scheme', 'http'))
+    host = request.headers.get('x-forwarded-host', request.headers.get('host', '').split(':')[0])
+    server = request.scope.get('server')
+    return _json_response(public_urls(scheme, host, str(server[1]) if server else None))
+
+
+async def get_metrics(request: _Request) -> _Response:
+    """Prometheus 文本格式的指标，同 Flask 版本的 /metrics"""
+    if not config.metrics_enabled:
+        return _json_response({'error': '未找到'}, 404)
+    return _Response(200, REGISTRY.expose().encode("utf-8"), [("Content-Type", CONTENT_TYPE)])
+
+
+def _check_admin(request: _Request) -> Optional[_Response]:
+    """校验管理令牌，失败时返回错误响应，通过时返回 None"""
+    try:
+        require_admin(request.headers.get('authorization'), request.headers.get('x-admin-token'))
+    except AdminAuthError as e:
+        return _json_response({'error': str(e)}, e.status)
+    return None
+
+
+async def admin_profile(request: _Request) -> _Response:
+    """对渲染任务做采样分析并返回折叠栈文本，参数同 Flask 版本的 /admin/profile"""
+    error = _check_admin(request)
+    if error is not None:
+        return error
+    try:
+        args = parse_profile_args(request.args)
+        # 分析期间阻塞等待，不占用渲染线程池
+        session = await asyncio.get_running_loop().run_in_executor(None, run_profile, *args)
+    except ValueError as e:
+        return _json_response({'error': str(e)}, 400)
+    except ProfileBusyError as e:
+        return _json_response({'error': str(e)}, 409)
+    return _Response(200, session.collapsed().encode("utf-8"), [
+        ("Content-Type", "text/plain; charset=utf-8"),
+        ("Content-Disposition", f"attachment; filename=profile-{int(session.started)}.folded"),
+        ("X-Profile-Requests", str(session.requests)),
+    ])
+
+
+async def admin_slow_requests(request: _Request) -> _Response:
+    """慢请求缓冲区中的记录，参数同 Flask 版本的 /admin/slow-requests"""
+    error = _check_admin(request)
+    if error is not None:
+        return error
+    entries = slow_requests.entries(clear=parse_flag(request.args.get('clear')))
+    return _json_response({'threshold_ms': config.slow_request_ms, 'requests': entries})
+
+
+_ROUTES = {
+    ('GET', '/'): index,
+    ('GET', '/api/config'): get_config,
+    ('POST', '/generate'): generate_image,
+    ('POST', '/generate/batch'): generate_batch,
+    ('GET', '/metrics'): get_metrics,
+    ('GET', '/admin/profile'): admin_profile,
+    ('GET', '/admin/slow-requests'): admin_slow_requests,
+}
+
+
+async def _dispatch(request: _Request) -> _Response:
+    if request.method == 'OPTIONS':
+        # CORS 预检请求
+        return _Response(200, b"", [
+            ("Access-Control-Allow-Methods", "GET, POST, OPTIONS"),
+            ("Access-Control-Allow-Headers", request.headers.get('access-control-request-headers', '*')),
+        ])
+    handler = _ROUTES.get((request.method, request.path))
+    if handler is not None:
+        return await handler(request)
+    if any(path == request.path for _, path in _ROUTES):
+        return _json_response({'error': '不支持的请求方法'}, 405)
+    return _json_response({'error': '未找到'}, 404)
+
+
+async def _lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            service.image_fetcher.close()
+            service.render_executor.shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send) -> None:
+    """ASGI 应用"""
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    request = _Request(scope, receive)
+    start = time.perf_counter()
+    IN_FLIGHT.inc()
+    try:
+        response = await _dispatch(request)
+    except _HTTPError as e:
+        response = _json_response({'error': str(e)}, e.status)
+    except HTTPException as e:
+        # multipart 解析中的大小限制等
+        response = _json_response({'error': e.description}, e.code or 500)
+    except Exception as e:
+        logging.error("API错误: %s", e, exc_info=True)
+        response = _json_response({'error': f'服务器内部错误: {str(e)}'}, 500)
+    finally:
+        IN_FLIGHT.dec()
+
+    # 未匹配的路径归为 other，避免标签无限增长
+    endpoint = request.path if any(path == request.path for _, path in _ROUTES) else 'other'
+    duration = time.perf_counter() - start
+    REQUESTS.inc(endpoint=endpoint, status=str(response.status))
+    REQUEST_SECONDS.observe(duration, endpoint=endpoint)
+    # 生成类接口与失败的请求写请求日志
+    if request.log_fields is not None or response.status >= 400:
+        fields = {'request_id': request.request_id, 'method': request.method, 'path': endpoint}
+        fields.update(request.log_fields or {})
+        request_logger.log(response.status, duration, fields)
+
+    headers = response.headers + _CORS_HEADERS + [
+        ("X-Request-ID", request.request_id),
+        ("Content-Length", str(len(response.body))),
+    ]
+    await send({
+        "type": "http.response.start",
+        "status": response.status,
+        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+    })
+    await send({"type": "http.response.body", "body": response.body})
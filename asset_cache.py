@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# filename: asset_cache.py
+"""
+底图资源缓存：启动时一次性解码所有差分底图与置顶图层，供所有请求共享。
+"""
+import logging
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from PIL import Image
+
+
+def _normalize(path: str) -> str:
+    return os.path.normpath(path)
+
+
+def _decode(path: str) -> Image.Image:
+    """解码图片文件为 RGBA，并确保像素数据已加载到内存。"""
+    with Image.open(path) as im:
+        img = im.convert("RGBA")
+    img.load()
+    return img
+
+
+class BaseImageRegistry:
+    """
+    已解码底图注册表。
+
+    `get` / `overlay` 返回的是进程内共享的 Image 对象，调用方只能读取；
+    需要在其上绘制时必须先 `copy()`（draw_text_auto / paste_image_auto 会自动复制）。
+    """
+
+    def __init__(self, image_files: Iterable[str], overlay_file: Optional[str] = None):
+        self._files = [_normalize(p) for p in dict.fromkeys(image_files)]
+        self._overlay_file = _normalize(overlay_file) if overlay_file else None
+        self._images: Dict[str, Image.Image] = {}
+        self._overlay: Optional[Image.Image] = None
+        self._overlay_bbox: Optional[Tuple[int, int, int, int]] = None
+        # 已叠加置顶图层的底图：路径 -> Image，按需生成
+        self._composited: Dict[str, Image.Image] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config) -> "BaseImageRegistry":
+        """根据配置中的 baseimage_mapping / baseimage_file / base_overlay_file 构建并加载注册表"""
+        files = list(config.baseimage_mapping.values()) + [config.baseimage_file]
+        overlay = config.base_overlay_file if config.use_base_overlay else None
+        registry = cls(files, overlay)
+        registry.load()
+        return registry
+
+    def load(self) -> None:
+        """解码全部底图与置顶图层；缺失的文件仅记录警告，不会中断启动"""
+        images: Dict[str, Image.Image] = {}
+        for path in self._files:
+            try:
+                images[path] = _decode(path)
+            except (OSError, ValueError) as e:
+                logging.warning("底图加载失败: %s (%s)", path, e)
+
+        overlay = None
+        if self._overlay_file:
+            if os.path.isfile(self._overlay_file):
+                overlay = _decode(self._overlay_file)
+            else:
+                logging.warning("置顶图层不存在: %s", self._overlay_file)
+
+        # 置顶图层通常只覆盖画布的一小部分，记录其非透明像素的范围
+        overlay_bbox = overlay.getchannel("A").getbbox() if overlay is not None else None
+
+        # 整体替换，正在进行中的请求仍持有旧对象，不受影响
+        with self._lock:
+            self._images = images
+            self._overlay = overlay
+            self._overlay_bbox = overlay_bbox
+            self._composited = {}
+        logging.info("已预加载 %d 张底图", len(images))
+
+    def reload(self) -> None:
+        """重新从磁盘解码全部资源，用于替换素材后无需重启服务"""
+        self.load()
+
+    def get(self, path: str) -> Image.Image:
+        """
+        获取已解码的底图（共享只读对象）。
+        未在配置中登记的路径会在首次访问时解码并缓存。
+        """
+        key = _normalize(path)
+        img = self._images.get(key)
+        if img is None:
+            img = _decode(key)
+            with self._lock:
+                self._images.setdefault(key, img)
+        return img
+
+    def composited(self, path: str) -> Image.Image:
+        """
+        获取已叠加置顶图层的底图（共享只读对象），首次访问时生成并缓存。
+        没有置顶图层时与 get 相同。
+        """
+        key = _normalize(path)
+        img = self._composited.get(key)
+        if img is None:
+            base = self.get(key)
+            overlay, composited = self._overlay, self._composited
+            if overlay is None:
+                img = base
+            else:
+                img = base.copy()
+                img.paste(overlay, (0, 0), overlay)
+            with self._lock:
+                img = composited.setdefault(key, img)
+        return img
+
+    @property
+    def files(self) -> List[str]:
+        """注册表管理的全部素材文件路径（含置顶图层）"""
+        return self._files + ([self._overlay_file] if self._overlay_file else [])
+
+    @property
+    def overlay(self) -> Optional[Image.Image]:
+        """已解码的置顶图层；未配置或文件缺失时为 None"""
+        return self._overlay
+
+    @property
+    def overlay_bbox(self) -> Optional[Tuple[int, int, int, int]]:
+        """置顶图层非透明像素的包围盒 (x1, y1, x2, y2)；没有置顶图层或完全透明时为 None"""
+        return self._overlay_bbox
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+# filename: benchmarks/bench_render.py
+"""
+渲染基准测试：用固定语料（仓库自带的底图、配置的字体与合成图片）分阶段测量渲染耗时。
+
+覆盖纯文本（短/长中文、英文单词、【】括号，两种换行算法）、纯图片（竖图/横图）与图文混排。
+每个用例对以下阶段分别统计 p50/p95/p99 延迟与吞吐量：
+    decode       用户图片解码（ImageDecoder）
+    font_search  字号搜索（排版缓存关闭）
+    wrap         选定字号下的换行
+    draw         文字绘制（排版缓存命中，只测绘制）
+    paste        图片缩放与粘贴
+    overlay      置顶图层覆盖并贴回底图
+    encode       编码（PNG 默认走分段编码，与线上路径一致）
+    total        解码 + 完整渲染（renderer.render，排版缓存关闭）
+各阶段单独调用对应组件，在整个文本/图片区域上测量；图文混排的区域划分只体现在 total 中。
+结果以 JSON 输出，可用 --baseline 与上一次的结果比较，p50 变慢超过阈值时以非零状态退出。
+
+用法：
+    python benchmarks/bench_render.py --iterations 30 --output bench.json
+    python benchmarks/bench_render.py --baseline bench.json --threshold 0.15
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import resource
+import sys
+import time
+from collections import defaultdict
+from io import BytesIO
+from typing import Callable, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import PIL  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+
+import renderer  # noqa: E402
+from asset_cache import BaseImageRegistry  # noqa: E402
+from config_loader import load_config  # noqa: E402
+from image_decoder import ImageDecoder  # noqa: E402
+from image_encoder import encode_image  # noqa: E402
+from image_fit_paste import paste_image_onto  # noqa: E402
+from png_stitch import encode_png_rows  # noqa: E402
+from text_fit_draw import (  # noqa: E402
+    _load_font,
+    configure_layout_cache,
+    draw_text_onto,
+    layout_text,
+    wrap_lines,
+    wrap_lines_knuth_plass,
+)
+
+TEXTS = {
+    "cjk_short": "你好",
+    "cjk_long": (
+        "今天的天气非常好，我们一起去公园散步吧。路边的花都开了，空气里有淡淡的香味，"
+        "远处传来小朋友的笑声。走累了就在长椅上坐一会儿，看看湖面上的小船慢慢划过，"
+        "等太阳落山以后再回家吃晚饭。"
+    ) * 2,
+    "ascii_words": "The quick brown fox jumps over the lazy dog while the sketchbook stays open. " * 3,
+    "brackets": "今天【重要】的事情是[开会]，记得带上【笔记本】和[资料]，不要迟到！",
+}
+
+WRAP_ALGORITHMS = ("original", "knuth_plass")
+
+STAGES = ("decode", "font_search", "wrap", "draw", "paste", "overlay", "encode", "total")
+
+
+def _synthetic_image(size, fmt: str) -> bytes:
+    """渐变叠加噪声的合成图片，编码后作为用户上传的图片"""
+    w, h = size
+    gradient = Image.linear_gradient("L").resize((w, h))
+    noise = Image.effect_noise((w, h), 40)
+    image = Image.merge("RGB", (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    buf = BytesIO()
+    if fmt == "JPEG":
+        image.save(buf, format=fmt, quality=90)
+    else:
+        image.save(buf, format=fmt)
+    return buf.getvalue()
+
+
+IMAGES = {
+    "portrait": (lambda: _synthetic_image((900, 1600), "JPEG")),
+    "landscape": (lambda: _synthetic_image((1600, 900), "PNG")),
+}
+
+
+def build_corpus() -> List[dict]:
+    """固定语料：纯文本 × 换行算法、纯图片、图文混排"""
+    cases = []
+    for text_name, text in TEXTS.items():
+        for wrap in WRAP_ALGORITHMS:
+            cases.append({"name": f"text/{text_name}/{wrap}", "text": text, "image": None, "wrap": wrap})
+    for image_name in IMAGES:
+        cases.append({"name": f"image/{image_name}", "text": "", "image": image_name, "wrap": "original"})
+    for image_name in IMAGES:
+        for text_name in ("cjk_short", "brackets"):
+            for wrap in WRAP_ALGORITHMS:
+                cases.append({
+                    "name": f"mixed/{image_name}/{text_name}/{wrap}",
+                    "text": TEXTS[text_name],
+                    "image": image_name,
+                    "wrap": wrap,
+                })
+    return cases
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """最近秩百分位数"""
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    total = sum(samples)
+    return {
+        "n": len(samples),
+        "mean_ms": round(total / len(samples) * 1000, 3),
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "ops_per_sec": round(len(samples) / total, 1) if total > 0 else None,
+    }
+
+
+def _timed(samples: List[float], fn: Callable, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    samples.append(time.perf_counter() - start)
+    return result
+
+
+class RenderBenchmark:
+    """按阶段测量单个用例；各阶段的输入在计时之外准备好"""
+
+    def __init__(self, config, formats: List[str]):
+        self.config = config
+        self.formats = formats
+        self.registry = BaseImageRegistry.from_config(config)
+        renderer.init_renderer(config, self.registry)
+        self.context = renderer.RenderContext.from_config(config, config.baseimage_file)
+        self.decoder = ImageDecoder.from_config(config)
+        self.base = self.registry.get(config.baseimage_file)
+        self.background = self.registry.composited(config.baseimage_file)
+        self.dirty = renderer.dirty_box(self.context.region, self.base.size)
+        self.images = {name: make() for name, make in IMAGES.items()}
+        self.text_options = dict(
+            max_font_height=config.max_font_height,
+            font_path=config.font_file,
+        )
+
+    def _local_region(self):
+        dx, dy = self.dirty[0], self.dirty[1]
+        x1, y1, x2, y2 = self.context.region
+        return (x1 - dx, y1 - dy), (x2 - dx, y2 - dy)
+
+    def run_case(self, case: dict, iterations: int, warmup: int) -> Dict[str, List[float]]:
+        samples: Dict[str, List[float]] = defaultdict(list)
+        for i in range(warmup + iterations):
+            current = samples if i >= warmup else defaultdict(list)
+            self._iteration(case, current)
+        return samples
+
+    def _iteration(self, case: dict, samples: Dict[str, List[float]]) -> None:
+        config = self.config
+        text, wrap = case["text"], case["wrap"]
+        config.text_wrap_algorithm = wrap
+        top_left, bottom_right = self._local_region()
+        region_w = bottom_right[0] - top_left[0]
+        region_h = bottom_right[1] - top_left[1]
+
+        image = None
+        if case["image"] is not None:
+            data = self.images[case["image"]]
+            image = _timed(samples["decode"], self.decoder.decode, data)
+
+        tile = self.base.crop(self.dirty)
+        if image is not None:
+            _timed(samples["paste"], paste_image_onto, tile, top_left, bottom_right, image,
+                   align="center", valign="middle", padding=12, allow_upscale=True, keep_alpha=True)
+
+        if text:
+            measure = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+            # 关闭排版缓存，测量完整的字号搜索
+            configure_layout_cache(0)
+            layout = _timed(samples["font_search"], layout_text, measure, text, config.font_file,
+                            region_w, region_h, config.max_font_height, 0.15, wrap)
+            configure_layout_cache(config.layout_cache_size)
+            font = _load_font(config.font_file, layout.font_size)
+            wrapper = wrap_lines_knuth_plass if wrap == "knuth_plass" else wrap_lines
+            _timed(samples["wrap"], wrapper, measure, text, font, region_w)
+            # 排版结果已缓存，只测绘制
+            layout_text(measure, text, config.font_file, region_w, region_h, config.max_font_height, 0.15, wrap)
+            _timed(samples["draw"], draw_text_onto, tile, top_left, bottom_right, text,
+                   wrap_algorithm=wrap, **self.text_options)
+
+        _timed(samples["overlay"], self._overlay, tile)
+
+        if config.png_band_cache and config.quantize_colors <= 0:
+            _timed(samples["encode"], encode_png_rows, self.background, tile, self.dirty,
+                   compress_level=config.png_compress_level)
+        else:
+            full = self._overlay(tile)
+            _timed(samples["encode"], encode_image, full, "png", compress_level=config.png_compress_level)
+        for fmt in self.formats:
+            if fmt != "png":
+                full = self._overlay(tile)
+                _timed(samples[f"encode_{fmt}"], encode_image, full, fmt, quality=config.output_quality)
+
+        # 端到端：解码 + 合成 + 编码；关闭排版缓存，相当于每次都是新文本（字形缓存保持预热）
+        configure_layout_cache(0)
+        start = time.perf_counter()
+        if case["image"] is not None:
+            image = self.decoder.decode(self.images[case["image"]])
+        renderer.render(text, image, self.context, "png")
+        samples["total"].append(time.perf_counter() - start)
+        configure_layout_cache(config.layout_cache_size)
+
+    def _overlay(self, tile: Image.Image) -> Image.Image:
+        """覆盖重绘区域内的置顶图层并贴回预先叠加了置顶图层的底图（同 renderer.compose）"""
+        tile = tile.copy()
+        overlay, bbox = self.registry.overlay, self.registry.overlay_bbox
+        if overlay is not None and bbox is not None:
+            x1, y1 = max(self.dirty[0], bbox[0]), max(self.dirty[1], bbox[1])
+            x2, y2 = min(self.dirty[2], bbox[2]), min(self.dirty[3], bbox[3])
+            if x1 < x2 and y1 < y2:
+                part = overlay.crop((x1, y1, x2, y2))
+                tile.paste(part, (x1 - self.dirty[0], y1 - self.dirty[1]), part)
+        full = self.background.copy()
+        full.paste(tile, self.dirty[:2])
+        return full
+
+
+def peak_rss_mb() -> float:
+    """进程峰值常驻内存（Linux 上 ru_maxrss 单位为 KB，macOS 为字节）"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def compare(result: dict, baseline: dict, threshold: float) -> List[str]:
+    """返回 p50 相对基线变慢超过 threshold（比例）的 用例/阶段"""
+    regressions = []
+    for case, stages in result["cases"].items():
+        for stage, stats in stages.items():
+            base = baseline.get("cases", {}).get(case, {}).get(stage)
+            if not base or not base.get("p50_ms"):
+                continue
+            ratio = stats["p50_ms"] / base["p50_ms"] - 1
+            if ratio > threshold:
+                regressions.append(
+                    f"{case} {stage}: p50 {base['p50_ms']}ms -> {stats['p50_ms']}ms (+{ratio:.0%})"
+                )
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="渲染流水线分阶段基准测试")
+    parser.add_argument("--config", default="config.yaml", help="配置文件（相对仓库根目录）")
+    parser.add_argument("--iterations", type=int, default=30, help="每个用例的计时次数")
+    parser.add_argument("--warmup", type=int, default=3, help="每个用例计时前的预热次数")
+    parser.add_argument("--formats", default="png", help="额外测量的编码格式，逗号分隔，如 png,webp,jpeg")
+    parser.add_argument("--filter", default="", help="只运行名称包含该字符串的用例")
+    parser.add_argument("--output", help="结果 JSON 输出路径，默认输出到标准输出")
+    parser.add_argument("--baseline", help="基线结果 JSON，用于检测性能回退")
+    parser.add_argument("--threshold", type=float, default=0.15, help="p50 允许变慢的比例")
+    args = parser.parse_args(argv)
+
+    os.chdir(ROOT)
+    logging.disable(logging.CRITICAL)
+    config = load_config(args.config)
+    formats = [f.strip() for f in args.formats.split(",") if f.strip()]
+    bench = RenderBenchmark(config, formats)
+
+    cases = [c for c in build_corpus() if args.filter in c["name"]]
+    per_case: Dict[str, Dict[str, dict]] = {}
+    combined: Dict[str, List[float]] = defaultdict(list)
+    started = time.perf_counter()
+    for case in cases:
+        samples = bench.run_case(case, args.iterations, args.warmup)
+        per_case[case["name"]] = {stage: summarize(values) for stage, values in samples.items() if values}
+        for stage, values in samples.items():
+            combined[stage].extend(values)
+        print(f"{case['name']}: total p50 {per_case[case['name']]['total']['p50_ms']}ms", file=sys.stderr)
+
+    ordered = [s for s in STAGES if s in combined] + sorted(s for s in combined if s not in STAGES)
+    result = {
+        "meta": {
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "font_file": config.font_file,
+            "iterations": args.iterations,
+            "warmup": args.warmup,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "elapsed_sec": round(time.perf_counter() - started, 2),
+        },
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": {stage: summarize(combined[stage]) for stage in ordered},
+        "cases": per_case,
+    }
+
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.threshold)
+        for line in regressions:
+            print(f"性能回退: {line}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+# filename: benchmarks/load_test.py
+"""
+HTTP 压测：按配置的并发数与请求组合持续请求本地实例的 /generate，输出吞吐量、延迟分布、
+错误率与服务端各进程的 CPU 占用，可与保存的基线结果比较，用于确定 gunicorn / PM2 的进程数。
+
+请求类型（--mix 指定权重）：
+    text     纯文本
+    image    base64 图片
+    mixed    文本 + base64 图片
+    remote   文本 + 远程 image_url（由内置的本地图片服务器提供，不访问外网）
+    batch    /generate/batch，每次 4 项
+每个请求的文本都带有序号，不会命中结果缓存；--repeat 指定重复之前请求的比例以模拟缓存命中。
+
+用法：
+    python api.py &                       # 或 uvicorn asgi:app --port 5000
+    python benchmarks/load_test.py --concurrency 1,4,8 --duration 20 --server-pid $! --output load.json
+    python benchmarks/load_test.py --concurrency 8 --baseline load.json
+"""
+import argparse
+import base64
+import http.client
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, ImageDraw
+
+KINDS = ("text", "image", "mixed", "remote", "batch")
+DEFAULT_MIX = "text=6,image=1,mixed=2,remote=1"
+
+# 延迟直方图桶上界（毫秒），最后一个桶为 +Inf
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+TEXTS = (
+    "你好",
+    "今天【重要】的事情是[开会]，记得带上【笔记本】",
+    "The quick brown fox jumps over the lazy dog",
+    "今天的天气非常好，我们一起去公园散步吧。路边的花都开了，空气里有淡淡的香味。",
+    "#开心#终于放假了！",
+)
+
+
+def _synthetic_png(size: Tuple[int, int], seed: int) -> bytes:
+    """合成测试图片：渐变叠加按 seed 变化的颜色，左上角写有 seed，保证内容各不相同"""
+    w, h = size
+    gradient = Image.linear_gradient("L").resize((w, h))
+    tint = Image.new("L", (w, h), seed * 37 % 256)
+    image = Image.merge("RGB", (gradient, tint, gradient.transpose(Image.Transpose.FLIP_TOP_BOTTOM)))
+    ImageDraw.Draw(image).text((4, 4), str(seed), fill="white")
+    buf = BytesIO()
+    image.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class _StubImageHandler(BaseHTTPRequestHandler):
+    """本地图片服务器：/img/<宽>x<高>.png?v=<n>，n 不同则内容不同"""
+
+    protocol_version = "HTTP/1.1"
+    images: Dict[str, bytes] = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        parsed = urllib.parse.urlsplit(self.path)
+        name = os.path.basename(parsed.path)
+        try:
+            w, h = (int(v) for v in name.split(".")[0].split("x"))
+            seed = int(urllib.parse.parse_qs(parsed.query).get("v", ["0"])[0])
+        except ValueError:
+            self.send_error(404)
+            return
+        key = f"{w}x{h}/{seed}"
+        with self.lock:
+            data = self.images.get(key)
+            if data is None:
+                data = self.images[key] = _synthetic_png((w, h), seed)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "max-age=60")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubImageHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-image-server", daemon=True).start()
+    return server
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for part in spec.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in KINDS:
+            raise ValueError(f"未知的请求类型: {kind}，可选值: {', '.join(KINDS)}")
+        mix[kind] = float(weight or 1)
+    return {k: w for k, w in mix.items() if w > 0}
+
+
+class PayloadFactory:
+    """按请求组合生成请求；文本带序号以避开结果缓存"""
+
+    def __init__(self, mix: Dict[str, float], stub_url: str, repeat: float, remote_variants: int, seed: int = 1):
+        self._kinds = list(mix)
+        self._weights = [mix[k] for k in self._kinds]
+        self._stub_url = stub_url
+        self._repeat = repeat
+        self._remote_variants = remote_variants
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._history: List[Tuple[str, str, bytes]] = []
+        # 预先生成少量 base64 图片（竖图/横图），请求时只替换文本
+        self._data_uris = [
+            "data:image/png;base64," + base64.b64encode(_synthetic_png(size, i)).decode("ascii")
+            for i, size in enumerate([(300, 600), (640, 360), (400, 400)])
+        ]
+
+    def next(self) -> Tuple[str, str, bytes]:
+        """返回 (类型, 路径, JSON 请求体)"""
+        with self._lock:
+            if self._history and self._random.random() < self._repeat:
+                return self._random.choice(self._history)
+            self._seq += 1
+            seq = self._seq
+            kind = self._random.choices(self._kinds, self._weights)[0]
+            text = f"{self._random.choice(TEXTS)} {seq}"
+            data_uri = self._random.choice(self._data_uris)
+            size = self._random.choice(["300x600", "800x450"])
+            variant = self._random.randrange(self._remote_variants)
+
+        if kind == "text":
+            path, body = "/generate", {"text": text}
+        elif kind == "image":
+            # 纯图片请求没有文本，每次生成内容不同的图片以避开结果缓存
+            fresh = base64.b64encode(_synthetic_png((300, 400), seq)).decode("ascii")
+            path, body = "/generate", {"image_url": "data:image/png;base64," + fresh}
+        elif kind == "mixed":
+            path, body = "/generate", {"text": text, "image_url": data_uri}
+        elif kind == "remote":
+            path, body = "/generate", {"text": text, "image_url": f"{self._stub_url}/img/{size}.png?v={variant}"}
+        else:
+            path, body = "/generate/batch", {"items": [{"text": f"{text} {i}"} for i in range(4)]}
+        request = (kind, path, json.dumps(body, ensure_ascii=False).encode("utf-8"))
+        with self._lock:
+            if len(self._history) < 256:
+                self._history.append(request)
+        return request
+
+
+class Recorder:
+    """线程安全的结果记录：按请求类型统计延迟、状态码与字节数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Counter] = defaultdict(Counter)
+        self.bytes = 0
+
+    def record(self, kind: str, status: int, seconds: float, size: int) -> None:
+        with self._lock:
+            self.latencies[kind].append(seconds)
+            self.statuses[kind][status] += 1
+            self.bytes += size
+
+
+def _worker(host: str, port: int, factory: PayloadFactory, recorder: Recorder,
+            deadline: float, remaining: List[int], timeout: float) -> None:
+    conn = None
+    while time.perf_counter() < deadline:
+        with recorder._lock:
+            if remaining[0] == 0:
+                return
+            remaining[0] -= 1
+        kind, path, body = factory.next()
+        start = time.perf_counter()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection(host, port, timeout=timeout)
+            conn.request("POST", path, body, {"Content-Type": "application/json"})
+            response = conn.getresponse()
+            data = response.read()
+            status = response.status
+            if response.getheader("Connection", "").lower() == "close":
+                conn.close()
+                conn = None
+        except (OSError, http.client.HTTPException):
+            # 连接错误记为状态 0，下次重新建立连接
+            status, data = 0, b""
+            if conn is not None:
+                conn.close()
+            conn = None
+        recorder.record(kind, status, time.perf_counter() - start, len(data))
+    if conn is not None:
+        conn.close()
+
+
+def _clock_ticks() -> int:
+    return os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def _process_tree(pid: int) -> List[int]:
+    """pid 及其全部子孙进程（读取 /proc/<pid>/task/*/children）"""
+    pids, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        pids.append(current)
+        try:
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    stack.extend(int(p) for p in f.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def _cpu_seconds(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    # 去掉 "pid (comm)" 后，utime / stime 位于第 12、13 个字段
+    return (int(fields[11]) + int(fields[12])) / _clock_ticks()
+
+
+def _cmdline(pid: int) -> str:
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            return f.read().replace(b"\0", b" ").decode("utf-8", "replace").strip()[:200]
+    except OSError:
+        return ""
+
+
+class CpuSampler:
+    """定期采样服务端进程树（主进程与渲染工作进程）的 CPU 时间"""
+
+    def __init__(self, pid: int, interval: float = 1.0):
+        self._pid = pid
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="cpu-sampler", daemon=True)
+        self._first: Dict[int, Tuple[float, float]] = {}
+        self._last: Dict[int, Tuple[float, float]] = {}
+        self._peak: Dict[int, float] = defaultdict(float)
+
+    def start(self) -> None:
+        self._sample()
+        self._thread.start()
+
+    def stop(self) -> Dict[str, dict]:
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        report = {}
+        for pid, (t0, c0) in self._first.items():
+            t1, c1 = self._last[pid]
+            wall = t1 - t0
+            report[str(pid)] = {
+                "cmdline": _cmdline(pid),
+                "cpu_seconds": round(c1 - c0, 2),
+                "cpu_percent": round((c1 - c0) / wall * 100, 1) if wall > 0 else None,
+                "peak_cpu_percent": round(self._peak[pid], 1),
+            }
+        return report
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._interval):
+            self._sample()
+
+    def _sample(self) -> None:
+        now = time.perf_counter()
+        for pid in _process_tree(self._pid):
+            cpu = _cpu_seconds(pid)
+            if cpu is None:
+                continue
+            previous = self._last.get(pid)
+            if previous is not None and now > previous[0]:
+                self._peak[pid] = max(self._peak[pid], (cpu - previous[1]) / (now - previous[0]) * 100)
+            self._first.setdefault(pid, (now, cpu))
+            self._last[pid] = (now, cpu)
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """最近秩百分位数"""
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(-(-q * len(ordered) // 100)) - 1))
+    return ordered[index]
+
+
+def histogram(samples: List[float]) -> Dict[str, int]:
+    """按 BUCKETS_MS 统计的累计直方图（le=上界）"""
+    counts = {}
+    for bound in BUCKETS_MS:
+        counts[f"le_{bound}ms"] = sum(1 for s in samples if s * 1000 <= bound)
+    counts["le_inf"] = len(samples)
+    return counts
+
+
+def summarize(latencies: List[float], statuses: Counter, elapsed: float) -> dict:
+    total = sum(statuses.values())
+    errors = total - statuses.get(200, 0)
+    ms = [s * 1000 for s in latencies]
+    return {
+        "requests": total,
+        "throughput_rps": round(total / elapsed, 2) if elapsed > 0 else None,
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "statuses": {str(k): v for k, v in sorted(statuses.items())},
+        "latency_ms": {
+            "mean": round(sum(ms) / len(ms), 2),
+            "p50": round(percentile(ms, 50), 2),
+            "p90": round(percentile(ms, 90), 2),
+            "p95": round(percentile(ms, 95), 2),
+            "p99": round(percentile(ms, 99), 2),
+            "max": round(max(ms), 2),
+        } if ms else {},
+        "histogram": histogram(latencies),
+    }
+
+
+def run_level(args, concurrency: int, factory: PayloadFactory) -> dict:
+    """以给定并发数运行一轮压测"""
+    target = urllib.parse.urlsplit(args.url)
+    recorder = Recorder()
+    remaining = [args.requests if args.requests else -1]
+    sampler = CpuSampler(args.server_pid) if args.server_pid else None
+    if sampler:
+        sampler.start()
+    start = time.perf_counter()
+    deadline = start + args.duration
+    threads = [
+        threading.Thread(
+            target=_worker,
+            args=(target.hostname, target.port or 80, factory, recorder, deadline, remaining, args.timeout),
+            daemon=True,
+        )
+        for _ in range(concurrency)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    all_latencies = [s for values in recorder.latencies.values() for s in values]
+    all_statuses = sum(recorder.statuses.values(), Counter())
+    result = {
+        "concurrency": concurrency,
+        "elapsed_sec": round(elapsed, 2),
+        "response_bytes": recorder.bytes,
+        "overall": summarize(all_latencies, all_statuses, elapsed),
+        "by_kind": {
+            kind: summarize(recorder.latencies[kind], recorder.statuses[kind], elapsed)
+            for kind in sorted(recorder.latencies)
+        },
+    }
+    if sampler:
+        result["server_cpu"] = sampler.stop()
+    return result
+
+
+def compare(result: dict, baseline: dict, threshold: float) -> List[str]:
+    """与基线中相同并发数的结果比较：p95 变慢、吞吐量下降或错误率上升超过阈值时记为回退"""
+    base_levels = {level["concurrency"]: level for level in baseline.get("levels", [])}
+    regressions = []
+    for level in result["levels"]:
+        base = base_levels.get(level["concurrency"])
+        if base is None:
+            continue
+        cur, old = level["overall"], base["overall"]
+        c = level["concurrency"]
+        if old.get("latency_ms") and cur.get("latency_ms"):
+            if cur["latency_ms"]["p95"] > old["latency_ms"]["p95"] * (1 + threshold):
+                regressions.append(f"并发 {c}: p95 {old['latency_ms']['p95']}ms -> {cur['latency_ms']['p95']}ms")
+        if old.get("throughput_rps") and cur["throughput_rps"] < old["throughput_rps"] * (1 - threshold):
+            regressions.append(f"并发 {c}: 吞吐量 {old['throughput_rps']} -> {cur['throughput_rps']} req/s")
+        if cur["error_rate"] > old["error_rate"] + threshold / 10:
+            regressions.append(f"并发 {c}: 错误率 {old['error_rate']:.2%} -> {cur['error_rate']:.2%}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="/generate HTTP 压测")
+    parser.add_argument("--url", default="http://127.0.0.1:5000", help="被测实例地址")
+    parser.add_argument("--concurrency", default="4", help="并发连接数，逗号分隔时依次运行多轮，如 1,4,8")
+    parser.add_argument("--duration", type=float, default=20.0, help="每轮持续时间（秒）")
+    parser.add_argument("--requests", type=int, default=0, help="每轮最多请求数，0 表示只按持续时间")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"请求组合权重，默认 {DEFAULT_MIX}")
+    parser.add_argument("--repeat", type=float, default=0.0, help="重复之前请求（命中结果缓存）的比例 0-1")
+    parser.add_argument("--remote-variants", type=int, default=8, help="远程图片的不同 URL 数量")
+    parser.add_argument("--timeout", type=float, default=60.0, help="单个请求超时（秒）")
+    parser.add_argument("--server-pid", type=int, help="服务端主进程 PID，采样其进程树的 CPU 占用（仅 Linux）")
+    parser.add_argument("--output", help="结果 JSON 输出路径，默认输出到标准输出")
+    parser.add_argument("--baseline", help="基线结果 JSON，用于检测性能回退")
+    parser.add_argument("--threshold", type=float, default=0.15, help="允许的回退比例")
+    args = parser.parse_args(argv)
+
+    stub = start_stub_server()
+    stub_url = f"http://127.0.0.1:{stub.server_address[1]}"
+    factory = PayloadFactory(parse_mix(args.mix), stub_url, args.repeat, max(1, args.remote_variants))
+
+    levels = []
+    for concurrency in (int(c) for c in args.concurrency.split(",") if c.strip()):
+        level = run_level(args, concurrency, factory)
+        overall = level["overall"]
+        print(
+            f"并发 {concurrency}: {overall['throughput_rps']} req/s，"
+            f"p95 {overall['latency_ms'].get('p95')}ms，错误率 {overall['error_rate']:.2%}",
+            file=sys.stderr,
+        )
+        levels.append(level)
+    stub.shutdown()
+
+    result = {
+        "meta": {
+            "url": args.url,
+            "mix": parse_mix(args.mix),
+            "repeat": args.repeat,
+            "duration_sec": args.duration,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "levels": levels,
+    }
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("meta", {}).get("mix") != result["meta"]["mix"]:
+            print("警告: 基线的请求组合与本次不同，结果可能不可比", file=sys.stderr)
+        regressions = compare(result, baseline, args.threshold)
+        for line in regressions:
+            print(f"性能回退: {line}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 import os
 import yaml
-from typing import Dict, Tuple
+from typing import Dict, List, Optional, Tuple
 from pydantic import BaseModel
 
 
@@ -25,8 +25,80 @@ class Config(BaseModel):
     """是否使用底图置顶图层"""
     logging_level: str = "INFO"
     """日志记录等级"""
+    log_format: str = "json"
+    """日志格式，可选值："json"(每行一条 JSON 记录), "text"(文本)"""
+    log_queue_size: int = 10000
+    """日志队列容量，由后台线程写出；队列已满时丢弃新记录而不阻塞请求"""
+    log_max_field_chars: int = 256
+    """日志正文与各字段保留的最大字符数，超出部分截断（异常堆栈不截断）"""
+    log_sample_rate: float = 0.1
+    """成功请求的请求日志抽样比例 0-1，失败与慢请求（见 slow_request_ms）总是记录"""
     text_wrap_algorithm: str = "original"
     """文本换行算法，可选值："original"(原始算法), "knuth_plass"(改进的Knuth-Plass算法)"""
+    max_font_height: int = 64
+    """文本最大字号（像素）"""
+    font_cache_size: int = 256
+    """字体对象缓存容量上限（按 字体路径+字号 计数）"""
+    warm_font_cache: bool = True
+    """启动时是否预加载 1..max_font_height 全部字号"""
+    layout_cache_size: int = 1024
+    """排版结果（字号+换行）缓存容量上限，重复文本可跳过排版"""
+    glyph_cache_size: int = 8192
+    """字形缓存容量上限（按 字体+字号+字符 计数），0 表示每次都重新光栅化"""
+    glyph_warm_file: Optional[str] = None
+    """启动时预先光栅化的字符表文件（UTF-8 文本，如常用汉字表），为空表示不预热"""
+    glyph_warm_sizes: Optional[List[int]] = None
+    """预热字形使用的字号，为空时使用 max_font_height"""
+    output_format: str = "png"
+    """默认输出格式，可选值："png", "webp", "jpeg", "avif"（请求可通过 format 参数或 Accept 头覆盖）"""
+    png_compress_level: int = 6
+    """PNG 压缩级别 0-9，越低编码越快、体积越大"""
+    output_quality: int = 90
+    """WebP / JPEG / AVIF 输出质量 1-100，WebP 取 100 时为无损"""
+    quantize_colors: int = 0
+    """大于 0 时将 PNG 输出量化为该颜色数（最多 256）的自适应调色板，0 表示不量化"""
+    png_band_cache: bool = True
+    """PNG 输出时缓存底图上下不变部分的压缩数据，每次只压缩文本框所在的行（体积略大于整图编码）"""
+    result_cache_size: int = 128
+    """渲染结果内存缓存容量上限（条目数），0 表示关闭"""
+    result_cache_dir: Optional[str] = None
+    """渲染结果磁盘缓存目录，为空表示不启用磁盘层"""
+    result_cache_max_age: int = 86400
+    """渲染结果响应的 Cache-Control max-age（秒）"""
+    max_image_pixels: int = 50_000_000
+    """用户图片（base64 或远程 URL）允许的最大像素数，超出时拒绝解码"""
+    max_upload_bytes: int = 20 * 1024 * 1024
+    """请求体大小上限（字节），包括 JSON 中的 base64 图片与直接上传的图片"""
+    fetch_timeout: float = 10.0
+    """远程图片下载超时（秒），包含连接、等待与读取正文的总时间"""
+    fetch_max_bytes: int = 10 * 1024 * 1024
+    """远程图片最大字节数，超出后立即中止下载"""
+    fetch_cache_ttl: float = 300.0
+    """已下载远程图片的缓存有效期（秒），过期后以 ETag / Last-Modified 条件请求重新验证"""
+    fetch_cache_size: int = 64
+    """远程图片缓存容量上限（按 URL 计数），0 表示关闭"""
+    fetch_workers: int = 8
+    """远程图片下载线程数"""
+    fetch_pool_size: int = 4
+    """每个主机保留的空闲 keep-alive 连接数"""
+    batch_max_items: int = 64
+    """/generate/batch 单次请求的条目数上限"""
+    batch_workers: int = 4
+    """批量生成的并行渲染线程数"""
+    render_workers: Optional[int] = None
+    """渲染进程数，为空时使用 CPU 核心数，0 表示在请求线程中渲染（使用 gunicorn 等多进程部署时建议设为 0）"""
+    render_queue_size: int = 32
+    """除正在执行的任务外最多排队的渲染任务数，队列已满时返回 503"""
+    render_timeout: float = 30.0
+    """单个渲染任务的超时时间（秒），超时返回 504"""
+    metrics_enabled: bool = True
+    """是否提供 /metrics 接口（Prometheus 文本格式的各阶段耗时、缓存命中与队列深度）"""
+    admin_token: Optional[str] = None
+    """管理接口（/admin/profile、/admin/slow-requests）的访问令牌，为空时管理接口不可用"""
+    slow_request_ms: float = 1000
+    """渲染耗时（含排队）不低于该值（毫秒）的请求连同各阶段耗时记录到慢请求缓冲区，0 表示不记录"""
+    slow_request_buffer: int = 100
+    """慢请求缓冲区保留的最近记录条数"""
     server_host: str = "0.0.0.0"
     """服务器监听地址，0.0.0.0 表示监听所有网络接口"""
     server_port: int = 5000
@@ -70,7 +142,7 @@ def load_config(config_file: str = "config.yaml") -> Config:
             return os.path.normpath(normalized)
         return path
     
-    path_fields = ['font_file', 'baseimage_file', 'base_overlay_file']
+    path_fields = ['font_file', 'baseimage_file', 'base_overlay_file', 'glyph_warm_file']
     for field in path_fields:
         if field in config_data and isinstance(config_data[field], str):
             config_data[field] = normalize_path(config_data[field])
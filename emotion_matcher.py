@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# filename: emotion_matcher.py
+"""
+表情关键词匹配：由 baseimage_mapping 的全部关键词预编译为一个正则表达式，
+一次扫描文本即可找出并去除所有表情关键词。
+"""
+import re
+from functools import lru_cache
+from typing import Dict, NamedTuple, Optional, Sequence
+
+
+class EmotionMatch(NamedTuple):
+    text: str
+    """去除全部表情关键词后的文本"""
+    emotion: Optional[str]
+    """生效的表情关键词，文本中没有关键词时为 None"""
+
+
+class EmotionMatcher:
+    """
+    多关键词匹配器。
+
+    同一位置可匹配多个关键词时取最长的一个；文本中出现多个不同关键词时，
+    按 keywords 中的先后顺序（即配置中 baseimage_mapping 的顺序）决定生效的表情。
+    """
+
+    def __init__(self, keywords: Sequence[str]):
+        self._priority: Dict[str, int] = {}
+        for keyword in keywords:
+            if keyword:
+                self._priority.setdefault(keyword, len(self._priority))
+        # 正则按分支顺序尝试，长关键词在前保证最长匹配
+        alternatives = sorted(self._priority, key=len, reverse=True)
+        self._pattern = re.compile("|".join(map(re.escape, alternatives))) if alternatives else None
+
+    @classmethod
+    def from_config(cls, config) -> "EmotionMatcher":
+        """同一组关键词只编译一次"""
+        return _compile(tuple(config.baseimage_mapping))
+
+    def match(self, text: str) -> EmotionMatch:
+        """找出文本中的全部表情关键词，返回去除关键词后的文本与生效的表情"""
+        if self._pattern is None:
+            return EmotionMatch(text, None)
+        found = []
+        stripped = self._pattern.sub(lambda m: found.append(m.group()) or "", text)
+        if not found:
+            return EmotionMatch(text, None)
+        emotion = min(found, key=self._priority.__getitem__)
+        return EmotionMatch(stripped.strip(), emotion)
+
+
+@lru_cache(maxsize=8)
+def _compile(keywords: tuple) -> EmotionMatcher:
+    return EmotionMatcher(keywords)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# filename: glyph_atlas.py
+"""
+字形缓存：按 (字体, 字符, 亚像素起点) 缓存 FreeType 光栅化后的字形遮罩。
+绘制时把一行中缓存的字形拼成整行遮罩（重叠处与 Pillow 整串渲染相同，按覆盖率叠加），
+再一次性按颜色混合到画布上；同一字形只光栅化一次，结果与 ImageDraw.text 逐像素一致。
+
+拼接与混合用到 Pillow 的内部接口。导入时检查这些接口，不可用或调用出错时停用字形缓存，
+draw_glyphs 返回 False，由调用方改用 draw.text。
+"""
+import logging
+import math
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+from PIL import Image, ImageDraw, ImageFont, ImageMath
+
+from lru_cache import LRUCache
+
+# 亚像素起点按 1/64 像素（FreeType 26.6 定点精度）区分
+_SUBPIXELS = 64
+
+
+class Glyph(NamedTuple):
+    mask: Optional[Image.Image]
+    """字形遮罩（L 模式），空白字符为 None"""
+    offset: Tuple[int, int]
+    """遮罩左上角相对绘制起点的偏移"""
+    advance: float
+    """前进宽度"""
+
+
+# 进程级字形缓存：(字体对象, 字符, 亚像素起点) -> Glyph
+_glyph_cache: LRUCache[tuple, Glyph] = LRUCache(8192)
+
+# 字距调整缓存：(字体对象, 字符对) -> 相邻两字的附加间距（像素）
+_kerning_cache: LRUCache[tuple, float] = LRUCache(65536)
+
+
+def _probe_internals() -> bool:
+    """检查依赖的 Pillow 内部接口是否存在"""
+    try:
+        core = ImageDraw.Draw(Image.new("RGBA", (1, 1))).draw
+        return (
+            callable(getattr(Image.Image(), "_new", None))
+            and callable(getattr(core, "draw_bitmap", None))
+            and callable(getattr(core, "draw_ink", None))
+            and callable(getattr(ImageMath, "lambda_eval", None))
+        )
+    except Exception:
+        return False
+
+
+_enabled = _probe_internals()
+if not _enabled:
+    logging.warning("当前 Pillow 版本缺少字形缓存所需的接口，文本改用 draw.text 绘制")
+
+
+def _disable(error: Exception) -> None:
+    global _enabled
+    if _enabled:
+        _enabled = False
+        logging.warning("字形缓存绘制失败，已停用并改用 draw.text: %s", error)
+
+
+def _rasterize(font: ImageFont.FreeTypeFont, ch: str, subpixel: int) -> Glyph:
+    mask, offset = font.getmask2(ch, "L", start=(subpixel / _SUBPIXELS, 0))
+    width, height = mask.size
+    # getmask2 返回 Pillow 内部图像，包装为 Image 以便拼接
+    image = Image.Image()._new(mask) if width and height else None
+    return Glyph(image, offset, font.getlength(ch))
+
+
+def _overlay(dst: Image.Image, src: Image.Image) -> Image.Image:
+    """重叠字形的叠加：src + dst * (255 - src) / 255（四舍五入），与 Pillow 整串渲染一致"""
+    return ImageMath.lambda_eval(
+        lambda e: e["convert"](e["src"] + (e["dst"] * (255 - e["src"]) + 127) / 255, "L"),
+        dst=dst, src=src,
+    )
+
+
+def _kerning(font: ImageFont.FreeTypeFont, pair: str) -> float:
+    def measure() -> float:
+        return font.getlength(pair) - font.getlength(pair[0]) - font.getlength(pair[1])
+    return _kerning_cache.get_or_create((font, pair), measure)
+
+
+def _place(font: ImageFont.FreeTypeFont, text: str, kerning: bool) -> Tuple[list, float]:
+    """按前进宽度（可选计入字距调整）排列字形，返回 ([(x, y, 遮罩)], 总宽度)"""
+    placed = []
+    pen = 0.0
+    for i, ch in enumerate(text):
+        if kerning and i:
+            pen += _kerning(font, text[i - 1:i + 1])
+        frac, whole = math.modf(pen)
+        glyph = get_glyph(font, ch, int(round(frac * _SUBPIXELS)))
+        if glyph.mask is not None:
+            placed.append((int(whole) + glyph.offset[0], glyph.offset[1], glyph.mask))
+        pen += glyph.advance
+    return placed, pen
+
+
+def get_glyph(font: ImageFont.FreeTypeFont, ch: str, subpixel: int = 0) -> Glyph:
+    """从缓存获取字形，未命中时光栅化"""
+    return _glyph_cache.get_or_create((font, ch, subpixel), lambda: _rasterize(font, ch, subpixel))
+
+
+def configure_glyph_cache(maxsize: int) -> None:
+    """设置字形缓存容量上限（字形个数），0 表示不缓存"""
+    _glyph_cache.resize(maxsize)
+
+
+def warm_glyphs(font: ImageFont.FreeTypeFont, chars: Iterable[str]) -> None:
+    """预先光栅化给定字符（整像素起点）"""
+    if not _enabled:
+        return
+    try:
+        for ch in chars:
+            if not ch.isspace():
+                get_glyph(font, ch)
+    except (AttributeError, TypeError) as e:
+        _disable(e)
+
+
+def glyph_cache_stats() -> dict:
+    """返回字形缓存的命中/未命中统计"""
+    return _glyph_cache.stats()
+
+
+def draw_glyphs(
+    draw: ImageDraw.ImageDraw,
+    xy: Tuple[int, int],
+    text: str,
+    font: ImageFont.FreeTypeFont,
+    fill,
+    width: Optional[float] = None,
+) -> bool:
+    """
+    用缓存的字形在 xy 处绘制单行文本，等价于 draw.text(xy, text, font=font, fill=fill)。
+
+    字形按各自的前进宽度依次排列，与整串的实际排版宽度 width（draw.textlength）不一致时
+    按字符对计入字距调整；仍不一致或字形缓存已停用时不绘制并返回 False，由调用方改用 draw.text。
+    """
+    if not _enabled or draw.mode != "RGBA" or draw.fontmode != "L" or not isinstance(font, ImageFont.FreeTypeFont):
+        return False
+    try:
+        return _draw_line(draw, xy, text, font, fill, width)
+    except (AttributeError, TypeError) as e:
+        # Pillow 内部接口变化：整行在最后一步才绘制到画布，出错时画布未被修改
+        _disable(e)
+        return False
+
+
+def _draw_line(draw: ImageDraw.ImageDraw, xy: Tuple[int, int], text: str, font: ImageFont.FreeTypeFont,
+               fill, width: Optional[float]) -> bool:
+    placed, pen = _place(font, text, kerning=False)
+    if width is not None and pen != width:
+        # 字体带字距调整表：按字符对修正间距后再比较
+        placed, pen = _place(font, text, kerning=True)
+        if pen != width:
+            return False
+    if not placed:
+        return True
+
+    left = min(gx for gx, _, _ in placed)
+    top = min(gy for _, gy, _ in placed)
+    right = max(gx + m.width for gx, _, m in placed)
+    bottom = max(gy + m.height for _, gy, m in placed)
+    line = Image.new("L", (right - left, bottom - top), 0)
+    # 字形按 x 递增排列，只有伸出前一个字形右边界的部分才可能重叠
+    filled = 0
+    for gx, gy, mask in placed:
+        box = (gx - left, gy - top)
+        if box[0] >= filled:
+            line.paste(mask, box)
+        else:
+            region = line.crop((box[0], box[1], box[0] + mask.width, box[1] + mask.height))
+            line.paste(_overlay(region, mask), box)
+        filled = max(filled, box[0] + mask.width)
+
+    x, y = xy
+    draw.draw.draw_bitmap((x + left, y + top), line.im, draw.draw.draw_ink(fill))
+    return True
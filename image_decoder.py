@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# filename: image_decoder.py
+"""
+用户图片解码：先读文件头检查像素上限，再按目标框尺寸缩小解码（JPEG draft + reduce），
+应用 EXIF 方向后直接转换为 RGBA。内存占用取决于输出框大小，而不是上传图片的大小。
+"""
+import math
+from io import BytesIO
+from typing import BinaryIO, Tuple, Union
+
+from PIL import Image, ImageOps
+
+from metrics import stage
+
+# EXIF Orientation 取这些值时图片需要旋转 90°/270°，宽高互换
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+_EXIF_ORIENTATION = 0x0112
+# Image.reduce 支持的模式；P、1、I;16 等需先转换为 RGBA（调色板透明色随之保留）
+_REDUCIBLE_MODES = frozenset(("L", "LA", "La", "RGB", "RGBA", "RGBa", "RGBX", "CMYK", "YCbCr", "I", "F"))
+
+
+class ImageDecodeError(ValueError):
+    """图片无法识别、像素数超出上限或解码失败"""
+
+
+class ImageDecoder:
+    """
+    按目标框尺寸解码用户图片。
+
+    缩小后的图片仍至少保留目标框“等比放入”尺寸的 reducing_gap 倍，
+    最终缩放（LANCZOS）交给 paste_image_onto，画质与直接缩放原图基本一致。
+    """
+
+    def __init__(
+        self,
+        target_size: Tuple[int, int],
+        max_pixels: int = 50_000_000,
+        reducing_gap: float = 2.0,
+    ):
+        self._target_size = target_size
+        self._max_pixels = max_pixels
+        self._reducing_gap = reducing_gap
+
+    @classmethod
+    def from_config(cls, config) -> "ImageDecoder":
+        """以文本/图片区域整体大小作为目标框（图片实际放入的区域不会超过它）"""
+        x1, y1 = config.text_box_topleft
+        x2, y2 = config.image_box_bottomright
+        return cls((x2 - x1, y2 - y1), config.max_image_pixels)
+
+    def decode(self, source: Union[bytes, BinaryIO]) -> Image.Image:
+        """解码字节或二进制文件对象，返回已加载的 RGBA 图片"""
+        with stage("decode"):
+            return self._decode(source)
+
+    def _decode(self, source: Union[bytes, BinaryIO]) -> Image.Image:
+        fp = BytesIO(source) if isinstance(source, (bytes, bytearray, memoryview)) else source
+        try:
+            im = Image.open(fp)
+        except (OSError, Image.DecompressionBombError) as e:
+            raise ImageDecodeError(f"无法识别的图片: {e}") from e
+
+        try:
+            # Image.open 只解析了文件头，此时还没有分配像素内存
+            w, h = im.size
+            if w <= 0 or h <= 0:
+                raise ImageDecodeError("图片尺寸无效")
+            if w * h > self._max_pixels:
+                raise ImageDecodeError(f"图片像素过多: {w}x{h}，上限 {self._max_pixels} 像素")
+
+            tw, th = self._target_size
+            if im.getexif().get(_EXIF_ORIENTATION) in _TRANSPOSED_ORIENTATIONS:
+                tw, th = th, tw
+            # 原图等比放入目标框后的尺寸，缩小解码不低于它的 reducing_gap 倍
+            scale = min(tw / w, th / h)
+            if scale < 1:
+                keep_w = math.ceil(w * scale * self._reducing_gap)
+                keep_h = math.ceil(h * scale * self._reducing_gap)
+                # JPEG 在 DCT 阶段按 1/2、1/4、1/8 缩小解码，其他格式忽略
+                im.draft("RGB" if im.mode in ("RGB", "YCbCr") else None, (keep_w, keep_h))
+                im.load()
+                factor = min(im.width // keep_w, im.height // keep_h)
+                if factor >= 2:
+                    if im.mode not in _REDUCIBLE_MODES:
+                        im = im.convert("RGBA")
+                    im = im.reduce(factor)
+
+            im = ImageOps.exif_transpose(im)
+            return im.convert("RGBA")
+        except ImageDecodeError:
+            raise
+        except Exception as e:
+            raise ImageDecodeError(f"图片解码失败: {e}") from e
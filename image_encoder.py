@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# filename: image_encoder.py
+"""
+输出编码：按请求选择 PNG / WebP / JPEG / AVIF，并记录各格式的编码耗时。
+"""
+import logging
+import time
+from io import BytesIO
+from typing import Dict, Optional, Tuple
+
+from PIL import Image, features
+
+MIME_TYPES: Dict[str, str] = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+    "avif": "image/avif",
+}
+
+_ALIASES = {"jpg": "jpeg"}
+
+
+def available_formats() -> Tuple[str, ...]:
+    """当前 Pillow 构建支持的输出格式"""
+    formats = ["png", "jpeg"]
+    if features.check("webp"):
+        formats.append("webp")
+    if features.check("avif"):
+        formats.append("avif")
+    return tuple(formats)
+
+
+_AVAILABLE = available_formats()
+
+
+def normalize_format(name: str) -> str:
+    """规范化格式名（大小写、jpg 别名），不支持的格式抛出 ValueError"""
+    fmt = name.strip().lower()
+    fmt = _ALIASES.get(fmt, fmt)
+    if fmt not in _AVAILABLE:
+        raise ValueError(f"不支持的输出格式: {name}，可选值: {', '.join(_AVAILABLE)}")
+    return fmt
+
+
+def negotiate_format(requested: Optional[str], accept: Optional[str], default: str) -> str:
+    """
+    选择输出格式：显式指定的 format 优先；否则按 Accept 头中明确列出的图片类型及其 q 值选择；
+    Accept 只包含通配符（*/*、image/*）或未提供时使用 default。
+    """
+    if requested:
+        return normalize_format(requested)
+
+    best, best_q = None, 0.0
+    mime_to_format = {mime: fmt for fmt, mime in MIME_TYPES.items() if fmt in _AVAILABLE}
+    for part in (accept or "").split(","):
+        fields = part.strip().split(";")
+        fmt = mime_to_format.get(fields[0].strip().lower())
+        if fmt is None:
+            continue
+        q = 1.0
+        for param in fields[1:]:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > best_q:
+            best, best_q = fmt, q
+    return best or normalize_format(default)
+
+
+def encode_image(
+    img: Image.Image,
+    fmt: str = "png",
+    compress_level: int = 6,
+    quality: int = 90,
+    quantize_colors: int = 0,
+) -> bytes:
+    """
+    将画布编码为指定格式的字节。
+
+    :param fmt: png / webp / jpeg / avif
+    :param compress_level: PNG zlib 压缩级别（0-9），越低越快、体积越大
+    :param quality: WebP / JPEG / AVIF 的质量（1-100），WebP 取 100 时使用无损模式
+    :param quantize_colors: 大于 0 时先将 PNG 量化为该颜色数的自适应调色板（平涂插画体积显著减小）
+    """
+    start = time.perf_counter()
+    buf = BytesIO()
+    if fmt == "png":
+        if quantize_colors > 0:
+            img = img.quantize(colors=min(256, quantize_colors), method=Image.Quantize.FASTOCTREE)
+        img.save(buf, format="PNG", compress_level=compress_level)
+    elif fmt == "webp":
+        if quality >= 100:
+            img.save(buf, format="WEBP", lossless=True)
+        else:
+            img.save(buf, format="WEBP", quality=quality)
+    elif fmt == "jpeg":
+        img.convert("RGB").save(buf, format="JPEG", quality=quality)
+    elif fmt == "avif":
+        img.save(buf, format="AVIF", quality=quality)
+    else:
+        raise ValueError(f"不支持的输出格式: {fmt}")
+
+    data = buf.getvalue()
+    logging.debug(
+        "编码 %s 耗时 %.1fms，%d 字节", fmt, (time.perf_counter() - start) * 1000, len(data)
+    )
+    return data
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+# filename: image_fetcher.py
+"""
+远程图片获取：按主机复用 keep-alive 连接，在独立线程池中并发下载，
+流式读取并限制最大字节数，解码前校验 Content-Type 与文件头，
+并按 URL 缓存解码结果（过期后用 ETag / Last-Modified 条件请求重新验证）。
+"""
+import concurrent.futures
+import http.client
+import logging
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from PIL import Image
+
+from image_decoder import ImageDecoder
+from lru_cache import LRUCache
+from metrics import stage
+
+_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+_MAX_REDIRECTS = 5
+_CHUNK_SIZE = 64 * 1024
+# 304 与重定向响应的正文不使用，不超过此大小时读完以便复用连接，否则直接关闭连接
+_MAX_DISCARD_BYTES = 64 * 1024
+
+# 复用的空闲连接可能已被服务端关闭，遇到这些异常时换新连接重试一次
+_STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    BrokenPipeError,
+)
+
+# 明确不是图片的 Content-Type，无需读取正文即可拒绝
+_REJECTED_CONTENT_TYPES = ("text/", "application/json", "application/xml", "application/javascript")
+
+
+class FetchError(Exception):
+    """远程图片获取失败（网络错误、状态码异常、超出大小限制、不是图片等）"""
+
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """根据文件头魔数判断图片格式，无法识别时返回 None"""
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head[4:8] == b"ftyp" and head[8:12] in (b"avif", b"avis", b"heic", b"heix", b"mif1"):
+        return "avif" if head[8:11] == b"avi" else "heif"
+    if head[:2] == b"BM":
+        return "bmp"
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return "tiff"
+    if head[:4] == b"\x00\x00\x01\x00":
+        return "ico"
+    return None
+
+
+class _CachedImage(NamedTuple):
+    image: Image.Image
+    etag: Optional[str]
+    last_modified: Optional[str]
+    expires: float
+
+
+class _ConnectionPool:
+    """按 (scheme, host, port) 保存空闲的 keep-alive 连接"""
+
+    def __init__(self, max_idle_per_host: int, timeout: float):
+        self._max_idle = max_idle_per_host
+        self._timeout = timeout
+        self._idle: Dict[Tuple[str, str, int], List[http.client.HTTPConnection]] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key: Tuple[str, str, int]) -> Tuple[http.client.HTTPConnection, bool]:
+        """取出一个空闲连接（第二个返回值为 True）或新建连接"""
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self.connect(key), False
+
+    def connect(self, key: Tuple[str, str, int]) -> http.client.HTTPConnection:
+        """新建连接（实际建立 TCP 连接发生在首次请求时）"""
+        scheme, host, port = key
+        cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        return cls(host, port, timeout=self._timeout)
+
+    def release(self, key: Tuple[str, str, int], conn: http.client.HTTPConnection) -> None:
+        """归还可复用的连接，超出空闲上限时直接关闭"""
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self._max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self) -> None:
+        with self._lock:
+            conns = [c for idle in self._idle.values() for c in idle]
+            self._idle.clear()
+        for conn in conns:
+            conn.close()
+
+
+class ImageFetcher:
+    """
+    远程图片获取器。
+
+    `fetch_async` 立即返回 Future，下载与解码在内部线程池中完成，同一 URL 的并发请求共享一次下载；
+    `fetch` 为其阻塞版本。返回的 Image 可能被缓存并在请求间共享，调用方只能读取。
+    """
+
+    def __init__(
+        self,
+        timeout: float = 10.0,
+        max_bytes: int = 10 * 1024 * 1024,
+        cache_ttl: float = 300.0,
+        cache_size: int = 64,
+        workers: int = 8,
+        max_idle_per_host: int = 4,
+        user_agent: str = "Mozilla/5.0",
+        decoder: Optional[ImageDecoder] = None,
+    ):
+        self._timeout = timeout
+        self._decoder = decoder
+        self._max_bytes = max_bytes
+        self._cache_ttl = cache_ttl
+        self._user_agent = user_agent
+        self._pool = _ConnectionPool(max_idle_per_host, timeout)
+        self._cache: LRUCache[str, _CachedImage] = LRUCache(cache_size)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-fetch")
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config) -> "ImageFetcher":
+        """根据配置中的 fetch_* 选项构建获取器"""
+        return cls(
+            timeout=config.fetch_timeout,
+            max_bytes=config.fetch_max_bytes,
+            cache_ttl=config.fetch_cache_ttl,
+            cache_size=config.fetch_cache_size,
+            workers=config.fetch_workers,
+            max_idle_per_host=config.fetch_pool_size,
+            decoder=ImageDecoder.from_config(config),
+        )
+
+    def fetch_async(self, url: str) -> "Future[Image.Image]":
+        """提交下载任务并返回 Future；失败时 Future 抛出 FetchError"""
+        with self._lock:
+            future = self._inflight.get(url)
+            if future is not None:
+                return future
+            future = self._executor.submit(self._fetch, url)
+            self._inflight[url] = future
+        # 任务可能已经完成，此时回调在当前线程中立即执行，不能在持有锁时注册
+        future.add_done_callback(lambda _f, u=url: self._forget(u))
+        return future
+
+    def fetch(self, url: str) -> Image.Image:
+        """阻塞获取图片，超过 timeout 仍未完成时抛出 FetchError"""
+        try:
+            return self.fetch_async(url).result(timeout=self._timeout)
+        except concurrent.futures.TimeoutError as e:
+            raise FetchError(f"下载超时: {url}") from e
+
+    def close(self) -> None:
+        """停止线程池并关闭全部空闲连接"""
+        self._executor.shutdown(wait=False)
+        self._pool.close()
+
+    def cache_stats(self) -> Dict[str, int]:
+        return self._cache.stats()
+
+    def _forget(self, url: str) -> None:
+        with self._lock:
+            self._inflight.pop(url, None)
+
+    def _fetch(self, url: str) -> Image.Image:
+        cached = self._cache.get(url)
+        now = time.monotonic()
+        if cached is not None and now < cached.expires:
+            return cached.image
+
+        headers = {"User-Agent": self._user_agent, "Accept": "image/*"}
+        if cached is not None:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+
+        with stage("fetch"):
+            status, resp_headers, body = self._request(url, headers, time.monotonic() + self._timeout)
+        ttl = self._ttl(resp_headers)
+        if status == 304 and cached is not None:
+            # 内容未变化，沿用已解码的图片并刷新有效期
+            logging.debug("远程图片未变化: %s", url)
+            if ttl is not None:
+                self._cache.put(url, cached._replace(expires=time.monotonic() + ttl))
+            return cached.image
+
+        try:
+            if self._decoder is not None:
+                image = self._decoder.decode(body)
+            else:
+                image = Image.open(BytesIO(body))
+                image.load()
+        except Exception as e:
+            raise FetchError(f"图片解码失败: {e}") from e
+        logging.debug("已下载远程图片: %s（%d 字节）", url, len(body))
+
+        # max-age=0 时仍保留条目，下次请求可凭 ETag / Last-Modified 做条件请求
+        if ttl is not None:
+            self._cache.put(
+                url,
+                _CachedImage(image, resp_headers.get("ETag"), resp_headers.get("Last-Modified"),
+                             time.monotonic() + ttl),
+            )
+        return image
+
+    def _ttl(self, headers: http.client.HTTPMessage) -> Optional[float]:
+        """缓存有效期：配置的 TTL，服务端声明 max-age 时取较小值，声明 no-store 时返回 None（不缓存）"""
+        ttl = self._cache_ttl
+        for directive in (headers.get("Cache-Control") or "").lower().split(","):
+            name, _, value = directive.strip().partition("=")
+            if name == "no-store":
+                return None
+            if name == "max-age" and value.isdigit():
+                ttl = min(ttl, int(value))
+        return ttl
+
+    def _request(
+        self, url: str, headers: Dict[str, str], deadline: float
+    ) -> Tuple[int, http.client.HTTPMessage, bytes]:
+        """发起 GET 请求（跟随重定向），返回状态码、响应头与正文"""
+        for _ in range(_MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ("http", "https") or not parts.hostname:
+                raise FetchError(f"不支持的图片地址: {url}")
+            port = parts.port or (443 if parts.scheme == "https" else 80)
+            key = (parts.scheme, parts.hostname, port)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+
+            conn, response = self._send(key, path, headers)
+            body = b""
+            try:
+                if response.status == 200:
+                    body = self._read_body(response, deadline)
+                    drained = True
+                elif response.status == 304 or response.status in _REDIRECT_STATUSES:
+                    drained = self._discard_body(response, deadline)
+                else:
+                    raise FetchError(f"下载失败: HTTP {response.status} {url}")
+            except BaseException:
+                # 正文未读完的连接不能复用
+                conn.close()
+                raise
+            # 关闭响应后连接才能发送下一个请求；正文未读完的连接不能复用
+            response.close()
+            if response.will_close or not drained:
+                conn.close()
+            else:
+                self._pool.release(key, conn)
+
+            if response.status in _REDIRECT_STATUSES:
+                location = response.getheader("Location")
+                if not location:
+                    raise FetchError(f"重定向缺少 Location: {url}")
+                url = urllib.parse.urljoin(url, location)
+                headers = {k: v for k, v in headers.items() if not k.startswith("If-")}
+                continue
+            return response.status, response.msg, body
+        raise FetchError(f"重定向次数过多: {url}")
+
+    def _send(
+        self, key: Tuple[str, str, int], path: str, headers: Dict[str, str]
+    ) -> Tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+        conn, reused = self._pool.acquire(key)
+        try:
+            conn.request("GET", path, headers=headers)
+            return conn, conn.getresponse()
+        except _STALE_CONNECTION_ERRORS as e:
+            conn.close()
+            if not reused:
+                raise FetchError(f"连接失败: {key[1]}:{key[2]} ({e})") from e
+        except OSError as e:
+            conn.close()
+            raise FetchError(f"连接失败: {key[1]}:{key[2]} ({e})") from e
+
+        conn = self._pool.connect(key)
+        try:
+            conn.request("GET", path, headers=headers)
+            return conn, conn.getresponse()
+        except OSError as e:
+            conn.close()
+            raise FetchError(f"连接失败: {key[1]}:{key[2]} ({e})") from e
+
+    @staticmethod
+    def _discard_body(response: http.client.HTTPResponse, deadline: float) -> bool:
+        """读完并丢弃不使用的正文，超过 _MAX_DISCARD_BYTES 或超时时停止读取并返回 False（连接不可复用）"""
+        length = response.getheader("Content-Length")
+        if length and length.isdigit() and int(length) > _MAX_DISCARD_BYTES:
+            return False
+        read = 0
+        while read <= _MAX_DISCARD_BYTES:
+            if time.monotonic() > deadline:
+                return False
+            chunk = response.read1(_CHUNK_SIZE)
+            if not chunk:
+                return True
+            read += len(chunk)
+        return False
+
+    def _read_body(self, response: http.client.HTTPResponse, deadline: float) -> bytes:
+        """校验 Content-Type 与文件头后流式读取正文，超出大小或时间限制时中止"""
+        content_type = (response.getheader("Content-Type") or "").lower()
+        if content_type.startswith(_REJECTED_CONTENT_TYPES):
+            raise FetchError(f"响应不是图片: {content_type}")
+        length = response.getheader("Content-Length")
+        if length and length.isdigit() and int(length) > self._max_bytes:
+            raise FetchError(f"图片过大: {length} 字节，上限 {self._max_bytes} 字节")
+
+        buf = bytearray()
+        while True:
+            chunk = response.read1(_CHUNK_SIZE)
+            if not chunk:
+                break
+            buf += chunk
+            if len(buf) > self._max_bytes:
+                raise FetchError(f"图片超过大小上限 {self._max_bytes} 字节")
+            if time.monotonic() > deadline:
+                raise FetchError("下载超时")
+            # 首个分块到达后立即检查文件头，不是图片则不必继续下载
+            if len(buf) == len(chunk) and len(buf) >= 16 and sniff_image_type(bytes(buf[:16])) is None:
+                raise FetchError("响应内容不是可识别的图片格式")
+        if sniff_image_type(bytes(buf[:16])) is None:
+            raise FetchError("响应内容不是可识别的图片格式")
+        return bytes(buf)
@@ -6,12 +6,14 @@ from typing import Literal, Tuple, Union
 
 from PIL import Image
 
+from metrics import stage
+
 Align = Literal["left", "center", "right"]
 VAlign = Literal["top", "middle", "bottom"]
 
 
-def paste_image_auto(
-    image_source: Union[str, Image.Image],
+def paste_image_onto(
+    img: Image.Image,
     top_left: Tuple[int, int],
     bottom_right: Tuple[int, int],
     content_image: Image.Image,
@@ -20,44 +22,14 @@ def paste_image_auto(
     padding: int = 0,
     allow_upscale: bool = False,
     keep_alpha: bool = True,
-    image_overlay: Union[str, Image.Image, None] = None,
-) -> bytes:
+) -> Image.Image:
     """
-    在指定矩形内放置一张图片（content_image），按比例缩放至“最大但不超过”该矩形。
-
-    : param base_image: 底图（会被复制，原图不改）
-    : param top_left: 指定矩形区域（左上坐标）
-    : param bottom_right: 指定矩形区域（右下坐标）
-    : param content_image: 待放入的图片（PIL.Image.Image）
-    : param align: 水平对齐方式
-    : param valign: 垂直对齐方式
-    : param padding: 矩形内边距（像素），四边统一
-    : param allow_upscale: 是否允许放大（默认只缩小不放大）
-    : param keep_alpha: True 时保留透明通道并用其作为粘贴蒙版
-    : param image_overlay: 可选的置顶覆盖图（会被复制，原图不改）
-
-    返回：最终 PNG 的 bytes。
+    在画布 img 的指定矩形内放置 content_image（原地修改并返回 img），
+    按比例缩放至“最大但不超过”该矩形。参数含义同 paste_image_auto。
     """
     if not isinstance(content_image, Image.Image):
         raise TypeError("content_image 必须为 PIL.Image.Image")
 
-    if isinstance(image_source, Image.Image):
-        img = image_source.copy()
-    else:
-        img = Image.open(image_source).convert("RGBA")
-
-    if image_overlay is not None:
-        if isinstance(image_overlay, Image.Image):
-            img_overlay = image_overlay.copy()
-        else:
-            img_overlay = (
-                Image.open(image_overlay).convert("RGBA")
-                if os.path.isfile(image_overlay)
-                else None
-            )
-    else:
-        img_overlay = None
-
     x1, y1 = top_left
     x2, y2 = bottom_right
     if not (x2 > x1 and y2 > y1):
@@ -84,7 +56,8 @@ def paste_image_auto(
     new_h = max(1, int(round(ch * scale)))
 
     # 选择高质量插值
-    resized = content_image.resize((new_w, new_h), Image.Resampling.LANCZOS)
+    with stage("resize"):
+        resized = content_image.resize((new_w, new_h), Image.Resampling.LANCZOS)
 
     # 计算粘贴坐标（考虑对齐与 padding）
     if align == "left":
@@ -102,11 +75,73 @@ def paste_image_auto(
         py = y2 - padding - new_h
 
     # 处理透明度：若 keep_alpha=True 且有 alpha，则用 alpha 作为 mask 粘贴
-    if keep_alpha and ("A" in resized.getbands()):
-        img.paste(resized, (px, py), resized)
+    with stage("paste"):
+        if keep_alpha and ("A" in resized.getbands()):
+            img.paste(resized, (px, py), resized)
+        else:
+            # 没有 alpha 就直接粘贴（会覆盖底图该区域）
+            img.paste(resized, (px, py))
+
+    return img
+
+
+def paste_image_auto(
+    image_source: Union[str, Image.Image],
+    top_left: Tuple[int, int],
+    bottom_right: Tuple[int, int],
+    content_image: Image.Image,
+    align: Align = "center",
+    valign: VAlign = "middle",
+    padding: int = 0,
+    allow_upscale: bool = False,
+    keep_alpha: bool = True,
+    image_overlay: Union[str, Image.Image, None] = None,
+) -> bytes:
+    """
+    在指定矩形内放置一张图片（content_image），按比例缩放至“最大但不超过”该矩形。
+
+    : param base_image: 底图（会被复制，原图不改）
+    : param top_left: 指定矩形区域（左上坐标）
+    : param bottom_right: 指定矩形区域（右下坐标）
+    : param content_image: 待放入的图片（PIL.Image.Image）
+    : param align: 水平对齐方式
+    : param valign: 垂直对齐方式
+    : param padding: 矩形内边距（像素），四边统一
+    : param allow_upscale: 是否允许放大（默认只缩小不放大）
+    : param keep_alpha: True 时保留透明通道并用其作为粘贴蒙版
+    : param image_overlay: 可选的置顶覆盖图（只读使用，原图不改）
+
+    返回：最终 PNG 的 bytes；需要继续合成时请直接使用 paste_image_onto。
+    """
+    if not isinstance(content_image, Image.Image):
+        raise TypeError("content_image 必须为 PIL.Image.Image")
+
+    if isinstance(image_source, Image.Image):
+        img = image_source.copy()
+    else:
+        img = Image.open(image_source).convert("RGBA")
+
+    if image_overlay is not None:
+        if isinstance(image_overlay, Image.Image):
+            # 置顶图层只作为粘贴源读取，无需复制
+            img_overlay = image_overlay
+        else:
+            img_overlay = (
+                Image.open(image_overlay).convert("RGBA")
+                if os.path.isfile(image_overlay)
+                else None
+            )
     else:
-        # 没有 alpha 就直接粘贴（会覆盖底图该区域）
-        img.paste(resized, (px, py))
+        img_overlay = None
+
+    paste_image_onto(
+        img, top_left, bottom_right, content_image,
+        align=align,
+        valign=valign,
+        padding=padding,
+        allow_upscale=allow_upscale,
+        keep_alpha=keep_alpha,
+    )
 
     # 覆盖置顶图层（如果有）
     if image_overlay is not None and img_overlay is not None:
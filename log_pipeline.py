@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# filename: log_pipeline.py
+"""
+非阻塞日志：业务线程只把日志记录放入有界队列，由后台线程（QueueListener）格式化并写出，
+队列已满时丢弃记录并计数，不会阻塞请求。输出为 JSON（每行一条）或文本，字段长度有上限。
+
+请求日志按请求记录 request_id、表情、文本长度与各阶段耗时等结构化字段；
+成功的请求按比例抽样，失败与慢请求总是记录。
+"""
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+REQUEST_LOGGER = "anan.request"
+
+# 单个字段（含日志正文）保留的最大字符数，由 configure_logging 按配置设置
+_max_field_chars = 256
+
+# 本进程因队列已满丢弃、尚未被 take_dropped 取走的记录数
+_dropped = 0
+_dropped_lock = threading.Lock()
+
+
+def truncate(value: Any, limit: Optional[int] = None) -> Any:
+    """截断过长的字符串，末尾注明原长度；字典、列表逐项处理，其他类型原样返回"""
+    limit = _max_field_chars if limit is None else limit
+    if isinstance(value, str):
+        if limit > 0 and len(value) > limit:
+            return f"{value[:limit]}…（共 {len(value)} 字）"
+        return value
+    if isinstance(value, dict):
+        return {k: truncate(v, limit) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [truncate(v, limit) for v in value]
+    return value
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """队列已满时丢弃记录而不是阻塞或报错"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 在调用线程中完成参数插值与异常格式化，记录本身可安全交给后台线程；正文与异常分开保存
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        global _dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with _dropped_lock:
+                _dropped += 1
+
+
+def take_dropped() -> int:
+    """
+    返回上次调用以来本进程丢弃的记录数并清零。
+    主进程在输出指标时计入 anan_log_records_dropped_total，渲染进程随任务结果返回主进程汇总。
+    """
+    global _dropped
+    with _dropped_lock:
+        dropped, _dropped = _dropped, 0
+    return dropped
+
+
+class JsonFormatter(logging.Formatter):
+    """每条记录输出一行 JSON：时间、级别、来源、进程号、正文与 extra={"fields": {...}} 中的结构化字段"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "pid": record.process,
+            "msg": truncate(record.getMessage()),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            data.update(truncate(fields))
+        if record.exc_text:
+            # 异常堆栈不截断
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """与原有格式一致的文本日志，结构化字段以 key=value 追加在正文后"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s [%(levelname)s] %(message)s")
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        text = super().formatMessage(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            text += " " + " ".join(
+                f"{k}={json.dumps(v, ensure_ascii=False, default=str)}" for k, v in truncate(fields).items()
+            )
+        return text
+
+    def format(self, record: logging.LogRecord) -> str:
+        record = copy.copy(record)
+        record.msg = truncate(record.getMessage())
+        record.args = None
+        return super().format(record)
+
+
+def configure_logging(config) -> logging.handlers.QueueListener:
+    """
+    把根日志替换为队列处理器，返回尚未启动的 QueueListener（由调用方在合适的时机 start）。
+    fork 出的子进程不会继承后台线程，需要在子进程中重新调用。
+    """
+    global _max_field_chars, _dropped
+    _max_field_chars = config.log_max_field_chars
+    # fork 出的子进程继承了主进程尚未汇总的计数，由主进程自己上报
+    with _dropped_lock:
+        _dropped = 0
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if config.log_format == "json" else TextFormatter())
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=max(0, config.log_queue_size))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_DroppingQueueHandler(log_queue))
+    root.setLevel(getattr(logging, config.logging_level.upper(), logging.INFO))
+    return logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+
+
+class RequestLogger:
+    """
+    请求日志：失败（状态码 >= 400）与耗时不低于 slow_seconds 的请求总是记录，
+    其余请求按 sample_rate 抽样。
+    """
+
+    def __init__(self, sample_rate: float, slow_seconds: float = 0.0):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self._logger = logging.getLogger(REQUEST_LOGGER)
+
+    def log(self, status: int, duration: float, fields: Dict[str, Any]) -> None:
+        slow = self.slow_seconds > 0 and duration >= self.slow_seconds
+        if status < 400 and not slow and random.random() >= self.sample_rate:
+            return
+        level = logging.ERROR if status >= 500 else logging.WARNING if status >= 400 or slow else logging.INFO
+        if not self._logger.isEnabledFor(level):
+            return
+        record = dict(fields, status=status, duration_ms=round(duration * 1000, 2))
+        self._logger.log(level, "请求完成", extra={"fields": record})
+
+
+def new_request_id(incoming: Optional[str] = None) -> str:
+    """沿用客户端或代理传入的 X-Request-ID（截断到 64 字符），没有时生成新的"""
+    if incoming:
+        return incoming.strip()[:64]
+    return os.urandom(8).hex()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# filename: lru_cache.py
+"""
+线程安全的有界 LRU 缓存，带命中/未命中计数。
+"""
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Generic, Hashable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """
+    有界 LRU 缓存。超出 maxsize 时淘汰最久未使用的条目；maxsize <= 0 表示不缓存。
+    """
+
+    def __init__(self, maxsize: int = 128):
+        self._maxsize = maxsize
+        self._data: "OrderedDict[K, V]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self) -> int:
+        return self._maxsize
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        """读取条目并刷新其最近使用时间"""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: K, value: V) -> None:
+        """写入条目，必要时淘汰最久未使用的条目"""
+        if self._maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_create(self, key: K, factory: Callable[[], V]) -> V:
+        """
+        命中则直接返回；否则调用 factory 生成并写入。
+        factory 在锁外执行，并发未命中时可能重复生成，但结果一致。
+        """
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+        value = factory()
+        self.put(key, value)
+        return value
+
+    def resize(self, maxsize: int) -> None:
+        """调整容量上限，多余条目按 LRU 顺序淘汰"""
+        with self._lock:
+            self._maxsize = maxsize
+            while self._data and len(self._data) > max(maxsize, 0):
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        """清空缓存并重置计数"""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        """返回命中、未命中、当前条目数与容量上限"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._data),
+                "maxsize": self._maxsize,
+            }
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._data
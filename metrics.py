@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+# filename: metrics.py
+"""
+进程内指标：计数器、仪表与直方图，按 Prometheus 文本格式输出（/metrics）。
+
+渲染在进程池中执行时，工作进程中的各阶段耗时与缓存命中数不能直接写入主进程的指标。
+collect() 在当前线程内暂存这些观测值，随任务结果一起返回主进程后由 replay() 计入；
+不在 collect() 范围内时直接计入当前进程的指标。
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# 耗时直方图的默认桶上界（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 一次观测：(指标名, 标签, 数值)，可跨进程传递
+Observation = Tuple[str, Dict[str, str], float]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    """按标签值分组的指标基类"""
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"指标 {self.name} 的标签应为 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def expose(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        if amount < 0:
+            raise ValueError("计数器只能增加")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """可增可减的瞬时值"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    """按固定桶累计的分布，输出 _bucket / _sum / _count"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 标签值 -> [各桶计数（非累计）..., +Inf 桶计数, 总和]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """记录 with 块的耗时（秒）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        counts = self._values.get(self._key(labels))
+        return int(sum(counts[:-1])) if counts else 0
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        lines = []
+        for key, counts in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (math.inf,), counts[:-1]):
+                cumulative += n
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """指标注册表；输出前依次调用 on_collect 注册的回调，用于刷新仪表与外部统计"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._hooks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"指标已注册: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name: str) -> Optional[_Metric]:
+        return self._metrics.get(name)
+
+    def on_collect(self, hook: Callable[[], None]) -> None:
+        self._hooks.append(hook)
+
+    def expose(self) -> str:
+        """按 Prometheus 文本格式（0.0.4）输出全部指标"""
+        for hook in self._hooks:
+            hook()
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(m.expose() for m in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "anan_stage_seconds",
+    "各处理阶段耗时（秒）；font_search 包含其中的 wrap，render 为渲染任务总耗时，queue 为排队与进程间传输耗时",
+    ["stage"],
+))
+FONT_PROBES = REGISTRY.register(Histogram(
+    "anan_font_search_probes",
+    "排版缓存未命中时确定字号实际执行换行的次数",
+    buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15, 20),
+))
+CACHE_HITS = REGISTRY.register(Counter("anan_cache_hits_total", "缓存命中次数", ["cache"]))
+CACHE_MISSES = REGISTRY.register(Counter("anan_cache_misses_total", "缓存未命中次数", ["cache"]))
+CACHE_ENTRIES = REGISTRY.register(Gauge("anan_cache_entries", "主进程中的缓存条目数", ["cache"]))
+REQUESTS = REGISTRY.register(Counter("anan_http_requests_total", "HTTP 请求数", ["endpoint", "status"]))
+REQUEST_SECONDS = REGISTRY.register(Histogram("anan_http_request_seconds", "HTTP 请求处理耗时（秒）", ["endpoint"]))
+IN_FLIGHT = REGISTRY.register(Gauge("anan_http_requests_in_flight", "正在处理的 HTTP 请求数"))
+QUEUE_DEPTH = REGISTRY.register(Gauge("anan_render_queue_depth", "已提交尚未完成的渲染任务数（含执行中）"))
+RENDER_WORKERS = REGISTRY.register(Gauge("anan_render_workers", "渲染进程数，0 表示在请求线程中渲染"))
+LOG_DROPPED = REGISTRY.register(Counter("anan_log_records_dropped_total", "日志队列已满而丢弃的记录数"))
+
+
+_local = threading.local()
+
+
+def _record(metric: _Metric, value: float, labels: Dict[str, str]) -> None:
+    pending = getattr(_local, "observations", None)
+    if pending is not None:
+        pending.append((metric.name, labels, value))
+    elif isinstance(metric, Histogram):
+        metric.observe(value, **labels)
+    else:
+        metric.inc(value, **labels)
+
+
+def observe(metric: Histogram, value: float, **labels: str) -> None:
+    """记录一次直方图观测；在 collect() 范围内时暂存，等待 replay"""
+    _record(metric, value, labels)
+
+
+def count(metric: Counter, amount: float = 1, **labels: str) -> None:
+    """计数器增加 amount；在 collect() 范围内时暂存，等待 replay"""
+    if amount:
+        _record(metric, amount, labels)
+
+
+class stage:
+    """
+    记录 with 块的耗时到 STAGE_SECONDS。热路径上频繁使用，不用 contextmanager 以减少开销。
+
+        with stage("draw"):
+            ...
+    """
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self) -> "stage":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        _record(STAGE_SECONDS, time.perf_counter() - self.start, {"stage": self.name})
+
+
+@contextmanager
+def collect() -> Iterator[List[Observation]]:
+    """在当前线程内暂存 with 块中的观测值，而不是直接计入指标（用于进程池任务）"""
+    previous = getattr(_local, "observations", None)
+    _local.observations = observations = []
+    try:
+        yield observations
+    finally:
+        _local.observations = previous
+
+
+def replay(observations: Sequence[Observation]) -> None:
+    """把 collect() 暂存的观测值计入当前进程（或外层 collect）的指标"""
+    for name, labels, value in observations:
+        metric = REGISTRY.get(name)
+        if metric is not None:
+            _record(metric, value, labels)
+
+
+class CacheStatsReporter:
+    """把 LRUCache.stats() 的累计命中/未命中数换算为增量计入 CACHE_HITS / CACHE_MISSES"""
+
+    def __init__(self):
+        self._last: Dict[str, Tuple[int, int]] = {}
+        self._lock = threading.Lock()
+
+    def baseline(self, cache: str, stats: Dict[str, int]) -> None:
+        """以当前累计数为起点（如启动预热之后），此前的命中/未命中不计入"""
+        with self._lock:
+            self._last[cache] = (stats["hits"], stats["misses"])
+
+    def report(self, cache: str, stats: Dict[str, int]) -> None:
+        hits, misses = stats["hits"], stats["misses"]
+        with self._lock:
+            last_hits, last_misses = self._last.get(cache, (0, 0))
+            self._last[cache] = (hits, misses)
+        # 缓存被清空时计数归零，增量从零重新计算
+        count(CACHE_HITS, hits - last_hits if hits >= last_hits else hits, cache=cache)
+        count(CACHE_MISSES, misses - last_misses if misses >= last_misses else misses, cache=cache)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# filename: png_stitch.py
+"""
+PNG 分段编码：同一张底图每次只有文本框所在的几行会变化。
+底图上方与下方不变的行按 Sub 滤波后单独压缩并缓存（zlib 完全刷新点处截断，可直接拼接），
+每次请求只压缩变化的行，再把各段数据拼成多个 IDAT 块输出，编码耗时与文本框高度成正比。
+"""
+import logging
+import struct
+import threading
+import time
+import weakref
+import zlib
+from typing import Dict, NamedTuple, Tuple
+
+from PIL import Image, ImageChops
+
+_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# zlib 流头：deflate、32K 窗口（压缩级别字段仅供参考，不影响解码）
+_ZLIB_HEADER = b"\x78\x9c"
+_ADLER_BASE = 65521
+# PNG 颜色类型与每像素字节数
+_COLOR_TYPES = {"RGB": (2, 3), "RGBA": (6, 4)}
+
+
+class _Bands(NamedTuple):
+    """一张底图在给定变化行范围之外的预压缩数据"""
+    head: bytes
+    """PNG 签名 + IHDR + 上方不变行的 IDAT（含 zlib 流头）"""
+    top_adler: int
+    tail: bytes
+    """下方不变行的 IDAT（含 deflate 结束块）"""
+    bottom_adler: int
+    bottom_length: int
+
+
+# id(底图) -> {(变化行起止, 压缩级别): _Bands}；Image 不可哈希，底图对象释放（重新加载）时一并移除
+_band_cache: Dict[int, Dict[tuple, _Bands]] = {}
+_band_lock = threading.Lock()
+
+
+def _chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(data, zlib.crc32(tag)))
+
+
+def _adler32_combine(adler1: int, adler2: int, length2: int) -> int:
+    """由两段数据各自的 adler32 求拼接后的 adler32（同 zlib 的 adler32_combine）"""
+    rem = length2 % _ADLER_BASE
+    sum1 = adler1 & 0xFFFF
+    sum2 = (rem * sum1) % _ADLER_BASE
+    sum1 = (sum1 + (adler2 & 0xFFFF) + _ADLER_BASE - 1) % _ADLER_BASE
+    sum2 = (sum2 + (adler1 >> 16) + (adler2 >> 16) + _ADLER_BASE - rem) % _ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+
+def filter_rows(img: Image.Image) -> bytes:
+    """
+    对每一行做 PNG Sub 滤波（每个字节减去左侧像素的同一通道，模 256），行首加滤波类型字节。
+    Sub 滤波只依赖本行，任意行范围都可以独立滤波与压缩。
+    """
+    bpp = _COLOR_TYPES[img.mode][1]
+    left = Image.new(img.mode, img.size)
+    left.paste(img.crop((0, 0, img.width - 1, img.height)), (1, 0))
+    data = ImageChops.subtract_modulo(img, left).tobytes()
+    stride = img.width * bpp
+    return b"".join(b"\x01" + data[i:i + stride] for i in range(0, len(data), stride))
+
+
+def _deflate(data: bytes, level: int, finish: bool) -> bytes:
+    """压缩为裸 deflate 数据；未结束的段以完全刷新点收尾，不引用之前的数据，可直接拼接"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if finish else zlib.Z_FULL_FLUSH)
+
+
+def _build_bands(background: Image.Image, rows: Tuple[int, int], level: int) -> _Bands:
+    width, height = background.size
+    y0, y1 = rows
+    color_type, _ = _COLOR_TYPES[background.mode]
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+
+    top = filter_rows(background.crop((0, 0, width, y0))) if y0 > 0 else b""
+    bottom = filter_rows(background.crop((0, y1, width, height))) if y1 < height else b""
+    head = (
+        _SIGNATURE
+        + _chunk(b"IHDR", ihdr)
+        + _chunk(b"IDAT", _ZLIB_HEADER + _deflate(top, level, finish=False))
+    )
+    tail = _chunk(b"IDAT", _deflate(bottom, level, finish=True))
+    return _Bands(head, zlib.adler32(top), tail, zlib.adler32(bottom), len(bottom))
+
+
+def _get_bands(background: Image.Image, rows: Tuple[int, int], level: int) -> _Bands:
+    key = (rows, level)
+    with _band_lock:
+        bands = _band_cache.get(id(background), {}).get(key)
+    if bands is None:
+        # 不变的部分只压缩一次
+        bands = _build_bands(background, rows, level)
+        with _band_lock:
+            entry = _band_cache.get(id(background))
+            if entry is None:
+                entry = _band_cache[id(background)] = {}
+                weakref.finalize(background, _band_cache.pop, id(background), None)
+            bands = entry.setdefault(key, bands)
+    return bands
+
+
+def warm_bands(background: Image.Image, rows: Tuple[int, int], band_level: int = 9) -> None:
+    """预先压缩 background 在变化行 rows = (y0, y1) 之外的部分"""
+    _get_bands(background, rows, band_level)
+
+
+def encode_png_rows(
+    background: Image.Image,
+    tile: Image.Image,
+    box: Tuple[int, int, int, int],
+    compress_level: int = 6,
+    band_level: int = 9,
+) -> bytes:
+    """
+    将 tile 贴到 background 的 box 处后的整张画布编码为 PNG（不修改 background）。
+    只有 box 覆盖的行在本次压缩，其余行使用按 background 缓存的压缩数据。
+
+    :param compress_level: 变化行的 zlib 压缩级别（0-9）
+    :param band_level: 不变行的 zlib 压缩级别，只在首次使用时压缩一次
+    """
+    if background.mode not in _COLOR_TYPES or tile.mode != background.mode:
+        raise ValueError(f"不支持的图片模式: {background.mode} / {tile.mode}")
+    start = time.perf_counter()
+    x0, y0, _, y1 = box
+    bands = _get_bands(background, (y0, y1), band_level)
+
+    band = background.crop((0, y0, background.width, y1))
+    band.paste(tile, (x0, 0))
+    middle = filter_rows(band)
+    adler = _adler32_combine(zlib.adler32(middle, bands.top_adler), bands.bottom_adler, bands.bottom_length)
+
+    data = b"".join((
+        bands.head,
+        _chunk(b"IDAT", _deflate(middle, compress_level, finish=False)),
+        bands.tail,
+        # zlib 流尾的 adler32 校验值随每次内容变化，单独放在最后一个 IDAT 中
+        _chunk(b"IDAT", struct.pack(">I", adler)),
+        _chunk(b"IEND", b""),
+    ))
+    logging.debug(
+        "分段编码 png 耗时 %.1fms，%d 字节", (time.perf_counter() - start) * 1000, len(data)
+    )
+    return data
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# filename: profiler.py
+"""
+按需采样分析：开启后，每个渲染任务执行期间由后台线程按固定间隔采样渲染线程的调用栈，
+累计为折叠栈（flamegraph.pl / speedscope 可直接读取），随任务结果返回主进程汇总。
+未开启时渲染任务不启动采样线程，没有额外开销。
+
+另外按耗时阈值把慢请求的各阶段耗时记录在环形缓冲区中，供事后取出分析。
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from types import CodeType
+from typing import Any, Deque, Dict, List, Optional
+
+Stacks = Dict[str, int]
+
+
+def _frame_name(code: CodeType) -> str:
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class StackSampler:
+    """
+    在后台线程中按 interval 秒采样线程 thread_id 的调用栈。
+    root 为栈底的函数（如渲染入口），更外层的框架代码不计入。
+    """
+
+    def __init__(self, thread_id: int, interval: float, root: Optional[CodeType] = None):
+        self._thread_id = thread_id
+        self._interval = interval
+        self._root = root
+        self._stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> Stacks:
+        """停止采样，返回 {折叠栈: 采样次数}"""
+        self._stop.set()
+        self._thread.join()
+        return dict(self._stacks)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame.f_code))
+                if frame.f_code is self._root:
+                    break
+                frame = frame.f_back
+            if names:
+                self._stacks[";".join(reversed(names))] += 1
+
+
+class ProfileSession:
+    """一次采样分析：持续到 deadline 或累计 max_requests 个渲染任务（0 表示不限）"""
+
+    def __init__(self, interval: float, seconds: float, max_requests: int = 0):
+        self.interval = interval
+        self.max_requests = max_requests
+        self.started = time.time()
+        self._deadline = time.monotonic() + seconds
+        self._stacks: Counter = Counter()
+        self._requests = 0
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    @property
+    def requests(self) -> int:
+        return self._requests
+
+    def active(self) -> bool:
+        return not self._done.is_set() and time.monotonic() < self._deadline
+
+    def add(self, stacks: Stacks) -> None:
+        """计入一个渲染任务的采样结果"""
+        with self._lock:
+            self._stacks.update(stacks)
+            self._requests += 1
+            if self.max_requests and self._requests >= self.max_requests:
+                self._done.set()
+
+    def wait(self) -> None:
+        """阻塞到时间用完或达到请求数"""
+        self._done.wait(max(0.0, self._deadline - time.monotonic()))
+        self._done.set()
+
+    def collapsed(self) -> str:
+        """折叠栈文本：每行 "帧1;帧2;... 次数"，按次数降序"""
+        with self._lock:
+            items = self._stacks.most_common()
+        return "".join(f"{stack} {count}\n" for stack, count in items)
+
+
+class ProfileBusyError(Exception):
+    """已有采样分析正在进行"""
+
+
+_session: Optional[ProfileSession] = None
+_session_lock = threading.Lock()
+
+
+def start_profile(interval: float, seconds: float, max_requests: int = 0) -> ProfileSession:
+    """开始采样分析；同一时间只允许一个，已有进行中的分析时抛出 ProfileBusyError"""
+    global _session
+    with _session_lock:
+        if _session is not None and _session.active():
+            raise ProfileBusyError("已有采样分析正在进行")
+        _session = ProfileSession(interval, seconds, max_requests)
+        return _session
+
+
+def active_session() -> Optional[ProfileSession]:
+    """进行中的采样分析，没有时返回 None"""
+    session = _session
+    return session if session is not None and session.active() else None
+
+
+class SlowRequestLog:
+    """
+    慢请求环形缓冲区：耗时不低于 threshold 秒的请求连同各阶段耗时一起保留最近 maxlen 条。
+    threshold <= 0 或 maxlen <= 0 时不记录。
+    """
+
+    def __init__(self, threshold: float, maxlen: int = 100):
+        self.threshold = threshold
+        self._entries: Deque[Dict[str, Any]] = deque(maxlen=max(maxlen, 1))
+        self._enabled = threshold > 0 and maxlen > 0
+        self._lock = threading.Lock()
+
+    def is_slow(self, seconds: float) -> bool:
+        return self._enabled and seconds >= self.threshold
+
+    def record(self, entry: Dict[str, Any]) -> None:
+        with self._lock:
+            self._entries.append(entry)
+
+    def entries(self, clear: bool = False) -> List[Dict[str, Any]]:
+        """按时间顺序返回缓冲区中的记录，clear 为真时同时清空"""
+        with self._lock:
+            items = list(self._entries)
+            if clear:
+                self._entries.clear()
+        return items
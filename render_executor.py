@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# filename: render_executor.py
+"""
+渲染任务执行器：CPU 密集的合成与编码放到进程池中执行，单个服务实例即可用满全部核心。
+排队任务数有上限，队列已满时立即拒绝（由调用方返回 503 + Retry-After），每个任务有超时时间。
+"""
+import concurrent.futures
+import logging
+import math
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional, Tuple
+
+
+class ExecutorBusyError(Exception):
+    """排队任务已满，retry_after 为建议的重试等待秒数"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"渲染队列已满，请 {retry_after} 秒后重试")
+        self.retry_after = retry_after
+
+
+class RenderTimeoutError(Exception):
+    """任务在超时时间内未完成"""
+
+
+class WorkerCrashedError(Exception):
+    """工作进程异常退出，任务未完成；retry_after 为建议的重试等待秒数"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("渲染进程异常退出")
+        self.retry_after = retry_after
+
+
+def _noop() -> None:
+    pass
+
+
+class _Deadline(BaseException):
+    """工作进程中任务到达时间上限；不继承 Exception，避免被任务内部的 except Exception 吞掉"""
+
+
+def _on_deadline(signum, frame) -> None:
+    raise _Deadline()
+
+
+def _run_limited(seconds: float, fn: Callable[..., Any], *args: Any) -> Any:
+    """
+    在工作进程中执行任务，超过 seconds 秒时由 SIGALRM 中止，释放工作进程。
+    工作进程在主线程中执行任务，信号处理函数在下一条字节码处中断任务；
+    长时间停留在单个 C 调用中的任务要等该调用返回后才会中止。
+    """
+    signal.signal(signal.SIGALRM, _on_deadline)
+    try:
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+        try:
+            return fn(*args)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    except _Deadline:
+        # 也覆盖任务刚完成、计时器尚未取消时到达的信号
+        raise RenderTimeoutError(f"渲染超过 {seconds} 秒，已在工作进程中中止") from None
+
+
+def _fork_context():
+    # fork 启动的工作进程直接继承主进程已解码的底图与字体（写时复制），无需重新导入主模块
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return None
+
+
+class RenderExecutor:
+    """
+    进程池 + 有界队列。
+
+    同时提交（执行中 + 排队）的任务数不超过 workers + queue_size；workers 为 0
+    或当前平台不支持 fork 时，任务直接在调用线程中执行。
+    工作进程中的任务超过 timeout 秒后被中止，不会一直占用工作进程。
+
+    进程池损坏（工作进程异常退出）后改为在调用线程中执行，仍受同样的任务数上限约束，
+    但调用线程中的任务无法中止，超时后只能等它完成。
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        queue_size: int = 32,
+        timeout: float = 30.0,
+        initializer: Optional[Callable[..., None]] = None,
+        initargs: Tuple[Any, ...] = (),
+    ):
+        self._workers = workers
+        self._timeout = timeout
+        self._initializer = initializer
+        self._initargs = initargs
+        self._capacity = max(1, workers + queue_size)
+        self._slots = threading.BoundedSemaphore(self._capacity)
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        # 任务从提交到完成耗时（含排队）的指数滑动平均，用作 Retry-After
+        self._avg_seconds = 1.0
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, initializer=None, initargs=()) -> "RenderExecutor":
+        """render_workers 为空时使用 CPU 核心数"""
+        workers = config.render_workers
+        if workers is None:
+            workers = os.cpu_count() or 1
+        return cls(workers, config.render_queue_size, config.render_timeout, initializer, initargs)
+
+    @property
+    def workers(self) -> int:
+        """实际运行的工作进程数，0 表示在调用线程中执行"""
+        return self._workers if self._pool is not None else 0
+
+    @property
+    def pending(self) -> int:
+        """已提交但尚未完成的任务数（含排队）"""
+        return self._pending
+
+    @property
+    def capacity(self) -> int:
+        """同时提交（执行中 + 排队）的任务数上限"""
+        return self._capacity
+
+    def check_capacity(self) -> None:
+        """
+        名额已满时抛出 ExecutorBusyError，只检查不占用名额，供调用方在准备任务之前尽早拒绝。
+        workers 为 0（在调用线程中执行、不限制任务数）时不检查。
+        """
+        if self._workers > 0 and self._pending >= self._capacity:
+            raise ExecutorBusyError(self._retry_after())
+
+    def start(self) -> None:
+        """
+        创建进程池并立即启动全部工作进程。
+        应在启动其他线程之前调用，避免 fork 时复制其他线程持有的锁。
+        """
+        if self._workers <= 0:
+            return
+        ctx = _fork_context()
+        if ctx is None:
+            logging.warning("当前平台不支持 fork，渲染任务将在请求线程中执行")
+            return
+        self._pool = ProcessPoolExecutor(
+            max_workers=self._workers,
+            mp_context=ctx,
+            initializer=self._initializer,
+            initargs=self._initargs,
+        )
+        # fork 方式下首次提交会一次性创建全部工作进程
+        concurrent.futures.wait([self._pool.submit(_noop) for _ in range(self._workers)])
+        logging.info("已启动 %d 个渲染进程", self._workers)
+
+    def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """
+        执行任务并返回结果。
+        队列已满时抛出 ExecutorBusyError，超时抛出 RenderTimeoutError，
+        工作进程异常退出时抛出 WorkerCrashedError。
+        """
+        pool = self._pool
+        if pool is None and self._workers <= 0:
+            return fn(*args)
+
+        if not self._slots.acquire(blocking=False):
+            raise ExecutorBusyError(self._retry_after())
+        start = time.perf_counter()
+        if pool is None:
+            # 进程池不可用时在调用线程中执行，保留任务数上限
+            with self._pending_lock:
+                self._pending += 1
+            try:
+                return fn(*args)
+            finally:
+                self._done(start)
+
+        try:
+            future = pool.submit(_run_limited, self._timeout, fn, *args)
+        except BrokenProcessPool as e:
+            self._slots.release()
+            self._abandon(pool)
+            raise WorkerCrashedError(self._retry_after()) from e
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._pending_lock:
+            self._pending += 1
+        # 超时的任务在工作进程中由 _run_limited 中止后才释放名额
+        future.add_done_callback(lambda _f: self._done(start))
+
+        try:
+            return future.result(timeout=self._timeout)
+        except concurrent.futures.TimeoutError as e:
+            raise RenderTimeoutError(f"渲染超过 {self._timeout} 秒未完成") from e
+        except BrokenProcessPool as e:
+            # 工作进程异常退出（如被 OOM 终止）。此时主进程已有其他线程在运行，
+            # 再次 fork 可能继承被持有的锁而死锁，因此不重建进程池
+            self._abandon(pool)
+            raise WorkerCrashedError(self._retry_after()) from e
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _done(self, start: float) -> None:
+        elapsed = time.perf_counter() - start
+        with self._pending_lock:
+            self._pending -= 1
+            self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * elapsed
+        self._slots.release()
+
+    def _retry_after(self) -> int:
+        with self._pending_lock:
+            return max(1, math.ceil(self._avg_seconds))
+
+    def _abandon(self, broken: ProcessPoolExecutor) -> None:
+        with self._pool_lock:
+            if self._pool is not broken:
+                return
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        logging.error("渲染进程池已损坏（工作进程异常退出），之后改在请求线程中渲染，重启服务后恢复进程池")
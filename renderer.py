@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+# filename: renderer.py
+"""
+渲染流水线：在底图上合成文本与图片并编码。
+既可以在请求线程中直接调用，也可以作为进程池任务在工作进程中运行（见 render_executor）。
+"""
+import logging
+import multiprocessing.util
+import signal
+import threading
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from PIL import Image
+
+from asset_cache import BaseImageRegistry
+from emotion_matcher import EmotionMatcher
+from glyph_atlas import configure_glyph_cache, glyph_cache_stats
+from image_encoder import encode_image
+from image_fit_paste import paste_image_onto
+from log_pipeline import configure_logging, take_dropped
+from metrics import LOG_DROPPED, CacheStatsReporter, Observation, collect, count, stage
+from png_stitch import encode_png_rows, warm_bands
+from profiler import Stacks, StackSampler
+from text_fit_draw import (
+    configure_font_cache,
+    configure_layout_cache,
+    draw_text_onto,
+    font_cache_stats,
+    layout_cache_stats,
+    warm_font_cache,
+    warm_glyph_cache,
+)
+
+# 重绘区域在文本/图片区域四周的扩展量，容纳字形越出排版框的部分（抗锯齿边缘、字形外伸）
+DIRTY_PADDING = 16
+
+# 当前进程的渲染资源，由 init_renderer 设置；fork 出的工作进程直接继承
+_config = None
+_base_images: Optional[BaseImageRegistry] = None
+_fingerprint: Optional[str] = None
+
+# 本进程字体、排版与字形缓存的命中数，随每次渲染的观测值一起汇总到主进程
+_cache_reporter = CacheStatsReporter()
+
+
+@dataclass(frozen=True)
+class RenderContext:
+    """
+    单次渲染的状态：使用的底图、文本/图片区域与排布比例。
+    每个请求各自创建，不在请求之间共享，可随任务一起提交到渲染进程。
+    """
+    base_file: str
+    """使用的底图文件路径"""
+    region: Tuple[int, int, int, int]
+    """文本/图片区域 (x1, y1, x2, y2)"""
+    ratio: float
+    """区域宽高比，用于判断图片按竖图还是横图排布"""
+    crop: bool = False
+    """只输出重绘区域（见 dirty_box），而不是整张画布"""
+
+    @classmethod
+    def from_config(cls, config, base_file: str, crop: bool = False) -> "RenderContext":
+        x1, y1 = config.text_box_topleft
+        x2, y2 = config.image_box_bottomright
+        return cls(base_file, (x1, y1, x2, y2), get_ratio(x1, y1, x2, y2), crop)
+
+
+def init_renderer(config, base_images: Optional[BaseImageRegistry] = None,
+                  fingerprint: Optional[str] = None) -> None:
+    """设置渲染配置与底图注册表，并按配置预热字体、字形与 PNG 分段编码缓存"""
+    global _config, _base_images, _fingerprint
+    _config = config
+    _base_images = base_images if base_images is not None else BaseImageRegistry.from_config(config)
+    _fingerprint = fingerprint
+
+    # 字体缓存：设置容量并预加载全部候选字号
+    configure_font_cache(config.font_cache_size)
+    if config.warm_font_cache:
+        warm_font_cache(config.font_file, config.max_font_height)
+    configure_layout_cache(config.layout_cache_size)
+
+    # 字形缓存：按配置的字符表预先光栅化，fork 出的工作进程直接继承
+    configure_glyph_cache(config.glyph_cache_size)
+    if config.glyph_warm_file:
+        try:
+            with open(config.glyph_warm_file, encoding="utf-8") as f:
+                chars = f.read()
+        except OSError as e:
+            logging.warning("读取字形预热字符表失败: %s", e)
+        else:
+            sizes = config.glyph_warm_sizes or [config.max_font_height]
+            warm_glyph_cache(config.font_file, sizes, chars)
+
+    # PNG 分段编码：预先压缩各底图不变的部分（素材重新加载后按需重新压缩）
+    if config.png_band_cache:
+        _warm_png_bands(config)
+
+    # 预热产生的未命中不计入指标
+    _cache_reporter.baseline("font", font_cache_stats())
+    _cache_reporter.baseline("layout", layout_cache_stats())
+    _cache_reporter.baseline("glyph", glyph_cache_stats())
+
+
+def _warm_png_bands(config) -> None:
+    """预先压缩各底图在重绘区域上下不变的部分，fork 出的工作进程直接继承"""
+    region = RenderContext.from_config(config, config.baseimage_file).region
+    for path in dict.fromkeys(list(config.baseimage_mapping.values()) + [config.baseimage_file]):
+        try:
+            background = _base_images.composited(path)
+        except (OSError, ValueError):
+            # 缺失的底图已在加载时记录警告
+            continue
+        box = dirty_box(region, background.size)
+        warm_bands(background, (box[1], box[3]))
+
+
+def init_worker(config, fingerprint: Optional[str] = None) -> None:
+    """
+    进程池 initializer。fork 出的工作进程已继承主进程预加载的底图与字体，直接复用；
+    否则在此加载。Ctrl+C 由主进程统一处理。
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # 日志写出线程不会随 fork 继承，在工作进程中重新建立；
+    # 工作进程以 os._exit 退出，由 multiprocessing 的退出回调写完队列中剩余的记录
+    listener = configure_logging(config)
+    listener.start()
+    multiprocessing.util.Finalize(None, listener.stop, exitpriority=10)
+    if _config is None:
+        init_renderer(config, fingerprint=fingerprint)
+
+
+def reload_assets(fingerprint: Optional[str] = None) -> None:
+    """重新从磁盘加载底图资源并记录新的素材指纹"""
+    global _fingerprint
+    if _base_images is not None:
+        _base_images.reload()
+    _fingerprint = fingerprint
+
+
+def select_base_image(config, text: str, emotion: Optional[str] = None) -> Tuple[str, str]:
+    """
+    确定使用的底图，返回 (去除表情关键词后的文本, 底图文件路径)。
+    未指定表情且文本中没有表情关键词时使用默认底图。
+    文本中有多个表情关键词时全部去除，按 baseimage_mapping 中的顺序取靠前的一个。
+
+    Args:
+        text: 文本内容
+        emotion: 表情标签（可选）
+    """
+    if emotion and emotion in config.baseimage_mapping:
+        base_file = config.baseimage_mapping[emotion]
+        logging.debug("使用表情: %s，底图: %s", emotion, base_file)
+        return text, base_file
+    if not emotion:
+        # 如果没有指定表情，检查文本中是否包含表情标签
+        text, keyword = EmotionMatcher.from_config(config).match(text)
+        if keyword is not None:
+            img_file = config.baseimage_mapping[keyword]
+            logging.debug("检测到关键词 '%s'，使用底图: %s", keyword, img_file)
+            return text, img_file
+    return text, config.baseimage_file
+
+
+def dirty_box(region: Tuple[int, int, int, int], size: Tuple[int, int]) -> Tuple[int, int, int, int]:
+    """
+    每次渲染实际会变化的画布范围：文本/图片区域四周扩展 DIRTY_PADDING，并限制在画布内
+    """
+    x1, y1, x2, y2 = region
+    width, height = size
+    return (
+        max(0, x1 - DIRTY_PADDING),
+        max(0, y1 - DIRTY_PADDING),
+        min(width, x2 + DIRTY_PADDING),
+        min(height, y2 + DIRTY_PADDING),
+    )
+
+
+def _intersect(a: Tuple[int, int, int, int], b: Tuple[int, int, int, int]) -> Optional[Tuple[int, int, int, int]]:
+    box = (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+    return box if box[0] < box[2] and box[1] < box[3] else None
+
+
+def is_vertical_image(image: Image.Image, ratio: float = 1) -> bool:
+    """
+    判断图像是否为竖图（按区域宽高比 ratio 归一化）
+    """
+    return image.height * ratio > image.width
+
+
+def get_ratio(x1, y1, x2, y2) -> float:
+    """
+    计算区域宽高比，区域无效时返回 1
+    """
+    try:
+        return (x2 - x1) / (y2 - y1)
+    except Exception as e:
+        logging.error("计算比例时出错: %s", e)
+        return 1
+
+
+def compose_region(text: str, image: Optional[Image.Image],
+                   context: RenderContext) -> Optional[Tuple[Image.Image, Tuple[int, int, int, int]]]:
+    """
+    按渲染上下文合成文本和图像，只在重绘区域（dirty_box）内绘制并覆盖置顶图层。
+
+    Args:
+        text: 文本内容（已去除表情关键词）
+        image: PIL Image对象（可选）
+        context: 本次渲染的底图、区域与比例
+
+    Returns:
+        (重绘区域的画布, 重绘区域在整张底图中的位置)，如果失败返回None
+    """
+    if text == "" and image is None:
+        return None
+
+    config = _config
+
+    # 获取区域坐标
+    x1, y1, x2, y2 = context.region
+    region_width = x2 - x1
+    region_height = y2 - y1
+
+    text_options = dict(
+        color=(0, 0, 0),
+        max_font_height=config.max_font_height,
+        font_path=config.font_file,
+        wrap_algorithm=config.text_wrap_algorithm,
+    )
+    image_options = dict(
+        align="center",
+        valign="middle",
+        padding=12,
+        allow_upscale=True,
+        keep_alpha=True,
+    )
+
+    try:
+        # 只在重绘区域的小画布上绘制，区域坐标换算到小画布内；所有步骤不产生中间 PNG
+        with stage("base"):
+            base = _base_images.get(context.base_file)
+            dirty = dirty_box(context.region, base.size)
+            canvas = base.crop(dirty)
+        dx, dy = dirty[0], dirty[1]
+        x1, y1, x2, y2 = x1 - dx, y1 - dy, x2 - dx, y2 - dy
+
+        # 只有图像的情况
+        if text == "" and image is not None:
+            logging.debug("处理图片内容")
+            paste_image_onto(canvas, (x1, y1), (x2, y2), image, **image_options)
+
+        # 只有文本的情况
+        elif text != "" and image is None:
+            logging.debug("从文本生成图片，%d 字", len(text))
+            draw_text_onto(canvas, (x1, y1), (x2, y2), text, **text_options)
+
+        # 同时有图像和文本的情况
+        else:
+            logging.debug("同时处理文本和图片内容，%d 字，比例: %s", len(text), context.ratio)
+            # 根据图像方向决定排布方式
+            if is_vertical_image(image, context.ratio):
+                logging.debug("使用左右排布（竖图）")
+                # 左右排布：图像在左，文本在右
+                spacing = 10
+                left_width = region_width // 2 - spacing // 2
+
+                left_region_right = x1 + left_width
+                right_region_left = left_region_right + spacing
+
+                # 先绘制左半部分的图像，再在右半部分添加文本
+                paste_image_onto(canvas, (x1, y1), (left_region_right, y2), image, **image_options)
+                draw_text_onto(canvas, (right_region_left, y1), (x2, y2), text, **text_options)
+            else:
+                logging.debug("使用上下排布（横图）")
+                # 上下排布：图像在上，文本在下
+                estimated_text_height = min(region_height // 2, 100)
+                image_region_bottom = y1 + (region_height - estimated_text_height)
+
+                paste_image_onto(canvas, (x1, y1), (x2, image_region_bottom), image, **image_options)
+                draw_text_onto(canvas, (x1, image_region_bottom), (x2, y2), text, **text_options)
+
+        # 只在重绘区域内覆盖置顶图层（如果有），区域外的置顶图层已预先合成到底图上
+        overlay, overlay_bbox = _base_images.overlay, _base_images.overlay_bbox
+        overlay_box = _intersect(dirty, overlay_bbox) if overlay_bbox is not None else None
+        if overlay is not None and overlay_box is not None:
+            with stage("overlay"):
+                part = overlay.crop(overlay_box)
+                canvas.paste(part, (overlay_box[0] - dx, overlay_box[1] - dy), part)
+        return canvas, dirty
+
+    except Exception as e:
+        logging.error("生成图片失败: %s", e, exc_info=True)
+        return None
+
+
+def compose(text: str, image: Optional[Image.Image], context: RenderContext) -> Optional[Image.Image]:
+    """
+    按渲染上下文在底图上合成文本和图像：重绘区域贴回预先叠加了置顶图层的底图；
+    context.crop 为真时直接返回重绘区域。
+
+    Returns:
+        合成完成的画布（PIL Image，由调用方统一编码），如果失败返回None
+    """
+    result = compose_region(text, image, context)
+    if result is None:
+        return None
+    canvas, dirty = result
+    if context.crop:
+        return canvas
+    full = _base_images.composited(context.base_file).copy()
+    full.paste(canvas, dirty[:2])
+    return full
+
+
+def render(text: str, image: Optional[Image.Image], context: RenderContext, fmt: str,
+           fingerprint: Optional[str] = None) -> Optional[bytes]:
+    """
+    合成并编码一张图片，失败时返回 None。可直接作为进程池任务提交：
+    主进程重新加载素材后指纹随之变化，工作进程据此在渲染前重新加载底图。
+    """
+    if fingerprint is not None and fingerprint != _fingerprint:
+        reload_assets(fingerprint)
+
+    if fmt == "png" and _config.png_band_cache and _config.quantize_colors <= 0 and not context.crop:
+        # 底图上下不变的行复用缓存的压缩数据，只压缩重绘区域所在的行
+        result = compose_region(text, image, context)
+        if result is None:
+            return None
+        canvas, dirty = result
+        background = _base_images.composited(context.base_file)
+        with stage("encode_png"):
+            return encode_png_rows(background, canvas, dirty, compress_level=_config.png_compress_level)
+
+    canvas = compose(text, image, context)
+    if canvas is None:
+        return None
+    with stage(f"encode_{fmt}"):
+        return encode_image(
+            canvas,
+            fmt,
+            compress_level=_config.png_compress_level,
+            quality=_config.output_quality,
+            quantize_colors=_config.quantize_colors,
+        )
+
+
+def render_observed(
+    text: str,
+    image: Optional[Image.Image],
+    context: RenderContext,
+    fmt: str,
+    fingerprint: Optional[str] = None,
+    profile_interval: Optional[float] = None,
+) -> Tuple[Optional[bytes], List[Observation], Optional[Stacks]]:
+    """
+    同 render，另外返回本次渲染的各阶段耗时，以及本进程缓存命中数与丢弃日志数的增量。
+    在工作进程中执行时这些观测值无法直接写入主进程的指标，由调用方用 metrics.replay 计入。
+    指定 profile_interval（秒）时在渲染期间采样调用栈，一并返回折叠栈计数，否则返回 None。
+    """
+    sampler = None
+    if profile_interval:
+        sampler = StackSampler(threading.get_ident(), profile_interval, render.__code__)
+        sampler.start()
+    try:
+        with collect() as observations:
+            with stage("render"):
+                image_bytes = render(text, image, context, fmt, fingerprint)
+            _cache_reporter.report("font", font_cache_stats())
+            _cache_reporter.report("layout", layout_cache_stats())
+            _cache_reporter.report("glyph", glyph_cache_stats())
+            count(LOG_DROPPED, take_dropped())
+    finally:
+        stacks = sampler.stop() if sampler is not None else None
+    return image_bytes, observations, stacks
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# filename: result_cache.py
+"""
+渲染结果缓存：以请求内容与配置/素材指纹的哈希作为键，缓存最终编码后的图片字节。
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from typing import Any, Dict, Iterable, Optional
+
+from lru_cache import LRUCache
+
+
+def _config_dict(config) -> Dict[str, Any]:
+    # 兼容 pydantic v1 / v2
+    dump = getattr(config, "model_dump", None)
+    return dump() if dump else config.dict()
+
+
+def compute_fingerprint(config, asset_files: Iterable[str]) -> str:
+    """
+    计算配置与素材文件的指纹。配置或素材（按路径、大小、修改时间）变化时指纹随之变化，
+    旧缓存自然失效。
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps(_config_dict(config), sort_keys=True, default=str).encode("utf-8"))
+    for path in sorted(set(asset_files)):
+        try:
+            st = os.stat(path)
+            h.update(f"{path}:{st.st_size}:{st.st_mtime_ns}".encode("utf-8"))
+        except OSError:
+            h.update(f"{path}:missing".encode("utf-8"))
+    return h.hexdigest()
+
+
+def make_cache_key(fingerprint: str, **fields: Any) -> str:
+    """由指纹与规范化后的请求字段计算内容寻址键（sha256 十六进制）"""
+    payload = json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str)
+    h = hashlib.sha256(fingerprint.encode("ascii"))
+    h.update(payload.encode("utf-8"))
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    两级结果缓存：内存 LRU + 可选的磁盘目录。
+    磁盘层命中时会回填内存层；磁盘写入失败只记录警告。
+    """
+
+    def __init__(self, maxsize: int = 128, disk_dir: Optional[str] = None):
+        self._memory: LRUCache[str, bytes] = LRUCache(maxsize)
+        self._disk_dir = disk_dir
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self._disk_dir, key[:2], key)  # type: ignore[arg-type]
+
+    def get(self, key: str) -> Optional[bytes]:
+        data = self._memory.get(key)
+        if data is not None or not self._disk_dir:
+            return data
+        try:
+            with open(self._disk_path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        self._memory.put(key, data)
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        self._memory.put(key, data)
+        if not self._disk_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 先写临时文件再原子替换，避免并发读取到半个文件
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.warning("写入磁盘结果缓存失败: %s", e)
+
+    def clear(self) -> None:
+        """清空内存层（磁盘层依靠指纹变化自然失效）"""
+        self._memory.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return self._memory.stats()
@@ -0,0 +1,532 @@
+# -*- coding: utf-8 -*-
+# filename: service.py
+"""
+生成服务：进程级共享资源（配置、底图、缓存、渲染进程池、图片获取器）与请求处理流程，
+由 Flask（api.py）与 ASGI（asgi.py）两种入口共用。
+"""
+import atexit
+import base64
+import hmac
+import io
+import json
+import logging
+import os
+import signal
+import time
+import urllib.parse
+import uuid
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+from PIL import Image
+
+from asset_cache import BaseImageRegistry
+from config_loader import load_config
+from image_decoder import ImageDecoder
+from image_encoder import MIME_TYPES, negotiate_format
+from image_fetcher import ImageFetcher
+from log_pipeline import RequestLogger, configure_logging, take_dropped
+from metrics import (
+    CACHE_ENTRIES,
+    LOG_DROPPED,
+    QUEUE_DEPTH,
+    REGISTRY,
+    RENDER_WORKERS,
+    STAGE_SECONDS,
+    CacheStatsReporter,
+    observe,
+    replay,
+    stage,
+)
+from profiler import ProfileSession, SlowRequestLog, active_session, start_profile
+from render_executor import ExecutorBusyError, RenderExecutor, RenderTimeoutError, WorkerCrashedError
+from renderer import RenderContext, init_renderer, init_worker, reload_assets, render_observed, select_base_image
+from result_cache import ResultCache, compute_fingerprint, make_cache_key
+from upload_reader import Upload, b64decode_chunked
+
+config = load_config()
+
+# 配置日志：记录经队列由后台线程写出；后台线程在渲染进程池启动之后再开启，之前的记录暂存在队列中
+log_listener = configure_logging(config)
+
+# 启动时预解码全部底图与置顶图层，请求处理时直接复用
+base_images = BaseImageRegistry.from_config(config)
+
+# 渲染结果缓存：键包含配置与素材指纹，素材重载后旧结果自然失效
+result_cache = ResultCache(config.result_cache_size, config.result_cache_dir)
+render_fingerprint = compute_fingerprint(config, base_images.files + [config.font_file])
+
+# 渲染资源（底图、字体与排版缓存）在 fork 渲染进程之前准备好，工作进程直接继承
+init_renderer(config, base_images, render_fingerprint)
+
+# 渲染进程池：必须在创建其他线程之前启动
+render_executor = RenderExecutor.from_config(config, init_worker, (config, render_fingerprint))
+render_executor.start()
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# 用户图片解码器：检查像素上限，按图片区域大小缩小解码
+image_decoder = ImageDecoder.from_config(config)
+
+# 远程图片获取器：连接复用、并发下载、大小限制与按 URL 缓存
+image_fetcher = ImageFetcher.from_config(config)
+
+# 慢请求环形缓冲区：渲染耗时（含排队）超过阈值的请求及其各阶段耗时
+slow_requests = SlowRequestLog(config.slow_request_ms / 1000, config.slow_request_buffer)
+
+# 请求日志：成功的请求按比例抽样，失败与慢请求总是记录
+request_logger = RequestLogger(config.log_sample_rate, config.slow_request_ms / 1000)
+
+# 批量生成的条目并行渲染，共享底图、字体、排版与结果缓存
+batch_executor = ThreadPoolExecutor(max_workers=config.batch_workers, thread_name_prefix="batch-render")
+
+REMOTE_PREFIXES = ('http://', 'https://', 'http%3A', 'https%3A')
+
+# 主进程中的结果缓存与远程图片缓存的命中数，在输出指标时汇总
+_cache_reporter = CacheStatsReporter()
+
+
+def _collect_metrics() -> None:
+    """输出 /metrics 前刷新渲染队列、主进程缓存与丢弃日志数的统计"""
+    QUEUE_DEPTH.set(render_executor.pending)
+    RENDER_WORKERS.set(render_executor.workers)
+    for name, stats in (('result', result_cache.stats()), ('fetch', image_fetcher.cache_stats())):
+        _cache_reporter.report(name, stats)
+        CACHE_ENTRIES.set(stats['size'], cache=name)
+    LOG_DROPPED.inc(take_dropped())
+
+
+REGISTRY.on_collect(_collect_metrics)
+
+
+def _reload_base_images(signum, frame):
+    """收到 SIGHUP 时重新加载底图资源，替换素材无需重启服务"""
+    global render_fingerprint
+    logging.info("收到信号 %s，重新加载底图资源", signum)
+    render_fingerprint = compute_fingerprint(config, base_images.files + [config.font_file])
+    # 渲染进程在下一次任务中发现指纹变化后各自重新加载
+    reload_assets(render_fingerprint)
+    result_cache.clear()
+
+
+if hasattr(signal, "SIGHUP"):
+    try:
+        signal.signal(signal.SIGHUP, _reload_base_images)
+    except ValueError:
+        # 非主线程导入（如部分 WSGI 容器）时无法注册信号处理器
+        pass
+
+
+class RenderError(Exception):
+    """单张图片生成失败，status 为应返回的 HTTP 状态码，retry_after 为 503 时建议的重试秒数"""
+
+    def __init__(self, message: str, status: int = 400, retry_after: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def load_image_from_url_or_base64(image_input: str) -> Optional[Image.Image]:
+    """
+    从URL或base64字符串加载图片
+
+    Args:
+        image_input: 图片URL或base64编码的图片数据（支持 data:image/...;base64,... 格式）
+
+    Returns:
+        PIL Image对象，如果加载失败返回None
+    """
+    try:
+        # URL解码（处理URL编码的字符）；不含转义字符时跳过，避免复制大段 base64 数据
+        if '%' in image_input:
+            image_input = urllib.parse.unquote(image_input)
+
+        # 检查是否是base64格式
+        if image_input.startswith('data:image'):
+            # 处理 data:image/png;base64,xxx 格式，从逗号之后分块解码
+            comma = image_input.index(',')
+            return image_decoder.decode(b64decode_chunked(image_input, comma + 1))
+        elif image_input.startswith('http://') or image_input.startswith('https://'):
+            # 从URL下载图片（返回的图片可能被缓存共享，只读使用）
+            return image_fetcher.fetch(image_input)
+        else:
+            # 尝试直接作为base64解码
+            return image_decoder.decode(b64decode_chunked(image_input))
+    except Exception as e:
+        logging.error("加载图片失败: %s", e)
+        return None
+
+
+def remote_image_url(image_url: str) -> Optional[str]:
+    """image_url 是远程地址时返回解码后的 URL，否则返回 None"""
+    if not image_url.startswith(REMOTE_PREFIXES):
+        return None
+    return urllib.parse.unquote(image_url) if '%' in image_url else image_url
+
+
+def parse_flag(value) -> bool:
+    """解析布尔型请求参数：JSON 的 true，或表单/查询字符串中的 1 / true / yes / on"""
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+def result_cache_key(text: str, emotion: str, image_url: str, fmt: str,
+                     upload: Optional[Upload] = None, crop: bool = False) -> Optional[str]:
+    """计算结果缓存键；远程 URL 的内容可能变化，不参与结果缓存（返回 None），base64 与上传数据按内容寻址"""
+    if upload is None and image_url.startswith(REMOTE_PREFIXES):
+        return None
+    fields = dict(
+        text=text,
+        emotion=emotion,
+        image=f"sha256:{upload.digest}" if upload is not None else image_url,
+        format=fmt,
+    )
+    if crop:
+        # 整张画布的缓存键保持不变
+        fields['crop'] = True
+    return make_cache_key(render_fingerprint, **fields)
+
+
+def load_input_image(image_url: str, upload: Optional[Upload] = None) -> Optional[Image.Image]:
+    """加载上传的图片或 image_url 指向的图片（都未提供时返回 None），失败时抛出 RenderError"""
+    if upload is None and not image_url:
+        return None
+    with stage('image_load'):
+        return _load_input_image(image_url, upload)
+
+
+def _load_input_image(image_url: str, upload: Optional[Upload]) -> Optional[Image.Image]:
+    if upload is not None:
+        image = None
+        try:
+            image = image_decoder.decode(upload.file)
+        except ValueError as e:
+            logging.error("加载上传图片失败: %s", e)
+        finally:
+            upload.file.close()
+        if image is None:
+            raise RenderError('无法加载上传的图片，请检查图片文件是否有效')
+        return image
+    if image_url:
+        image = load_image_from_url_or_base64(image_url)
+        if image is None:
+            raise RenderError('无法加载图片，请检查 image_url 参数是否正确')
+        return image
+    return None
+
+
+def check_render_capacity() -> None:
+    """渲染队列已满时抛出 RenderError（503），在加载图片与排队等待之前尽早拒绝"""
+    try:
+        render_executor.check_capacity()
+    except ExecutorBusyError as e:
+        raise RenderError('服务繁忙，请稍后重试', 503, retry_after=e.retry_after)
+
+
+def render_loaded(text: str, emotion: str, image: Optional[Image.Image], fmt: str,
+                  cache_key: Optional[str] = None, crop: bool = False,
+                  log_fields: Optional[Dict[str, Any]] = None) -> bytes:
+    """
+    用已加载的图片生成并编码结果，写入结果缓存。crop 为真时只返回文本/图片所在的重绘区域。
+    每个请求使用独立的渲染上下文，合成与编码交给渲染进程池；失败时抛出 RenderError。
+    传入 log_fields 时写入本次渲染的底图与各阶段耗时（毫秒），供请求日志使用。
+    """
+    text, base_file = select_base_image(config, text, emotion or None)
+    context = RenderContext.from_config(config, base_file, crop)
+    # 进行中的采样分析：渲染任务执行期间采样调用栈
+    session = active_session()
+    start = time.perf_counter()
+    try:
+        image_bytes, observations, stacks = render_executor.run(
+            render_observed, text, image, context, fmt, render_fingerprint,
+            session.interval if session is not None else None,
+        )
+    except ExecutorBusyError as e:
+        raise RenderError('服务繁忙，请稍后重试', 503, retry_after=e.retry_after)
+    except WorkerCrashedError as e:
+        raise RenderError('渲染进程异常退出，请稍后重试', 503, retry_after=e.retry_after)
+    except RenderTimeoutError:
+        _record_slow_request(time.perf_counter() - start, 504, text, image, context, fmt, {})
+        raise RenderError('生成图片超时，请稍后重试', 504)
+    elapsed = time.perf_counter() - start
+    if session is not None and stacks is not None:
+        session.add(stacks)
+    # 工作进程中记录的各阶段耗时与缓存命中数计入主进程指标；总耗时中渲染以外的部分为排队与进程间传输
+    replay(observations)
+    stages: Dict[str, float] = {}
+    for _, labels, value in observations:
+        if 'stage' in labels:
+            stages[labels['stage']] = stages.get(labels['stage'], 0.0) + value
+    stages['queue'] = max(0.0, elapsed - stages.get('render', 0.0))
+    observe(STAGE_SECONDS, stages['queue'], stage='queue')
+    if log_fields is not None:
+        log_fields.update(
+            base_file=os.path.basename(base_file),
+            image_size=list(image.size) if image is not None else None,
+            stages_ms={name: round(value * 1000, 2) for name, value in sorted(stages.items())},
+        )
+    _record_slow_request(elapsed, 200 if image_bytes is not None else 500, text, image, context, fmt, stages)
+    if image_bytes is None:
+        raise RenderError('生成图片失败，请检查参数是否正确', 500)
+    if cache_key is not None:
+        result_cache.put(cache_key, image_bytes)
+    return image_bytes
+
+
+def _record_slow_request(elapsed: float, status: int, text: str, image: Optional[Image.Image],
+                         context: RenderContext, fmt: str, stages: Dict[str, float]) -> None:
+    """渲染耗时超过 slow_request_ms 时记录请求概况与各阶段耗时（毫秒）；不保存文本内容"""
+    if not slow_requests.is_slow(elapsed):
+        return
+    slow_requests.record({
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'total_ms': round(elapsed * 1000, 2),
+        'status': status,
+        'pid': os.getpid(),
+        'text_length': len(text),
+        'image_size': list(image.size) if image is not None else None,
+        'base_file': os.path.basename(context.base_file),
+        'format': fmt,
+        'crop': context.crop,
+        'stages_ms': {name: round(value * 1000, 2) for name, value in sorted(stages.items())},
+    })
+
+
+def render_image_bytes(text: str, emotion: str, image_url: str, fmt: str,
+                       upload: Optional[Upload] = None, cache_key: Optional[str] = None,
+                       crop: bool = False, log_fields: Optional[Dict[str, Any]] = None) -> bytes:
+    """
+    生成并编码一张图片；命中结果缓存时直接返回缓存的字节。
+    图片加载失败或生成失败时抛出 RenderError。log_fields 同 render_loaded，另外记录是否命中结果缓存。
+    """
+    if cache_key is not None:
+        image_bytes = result_cache.get(cache_key)
+        if log_fields is not None:
+            log_fields['cache'] = 'hit' if image_bytes is not None else 'miss'
+        if image_bytes is not None:
+            return image_bytes
+    image = load_input_image(image_url, upload)
+    return render_loaded(text, emotion, image, fmt, cache_key, crop, log_fields)
+
+
+BATCH_OUTPUTS = ('json', 'zip', 'multipart')
+
+
+def _negotiate_batch_output(requested: Optional[str], accept: Optional[str]) -> str:
+    """选择批量结果的返回形式：显式指定的 output 优先，其次 Accept 头，默认 json"""
+    if requested:
+        output = requested.strip().lower()
+        if output not in BATCH_OUTPUTS:
+            raise ValueError(f"不支持的返回形式: {requested}，可选值: {', '.join(BATCH_OUTPUTS)}")
+        return output
+    accept = (accept or '').lower()
+    if 'application/zip' in accept:
+        return 'zip'
+    if 'multipart/mixed' in accept:
+        return 'multipart'
+    return 'json'
+
+
+def parse_batch_request(data: Any, args: Mapping[str, Any],
+                        accept: Optional[str]) -> Tuple[List[Any], str, str, bool]:
+    """
+    解析 /generate/batch 的请求体（对象或直接为条目数组）与查询参数，
+    返回 (条目, 输出格式, 返回形式, crop)；参数无效时抛出 ValueError。
+    """
+    if isinstance(data, list):
+        data = {'items': data}
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        raise ValueError('请在 items 中提供至少一个条目')
+    if len(items) > config.batch_max_items:
+        raise ValueError(f'条目数量超过上限 {config.batch_max_items}')
+    fmt = negotiate_format(data.get('format') or args.get('format'), accept, config.output_format)
+    output = _negotiate_batch_output(data.get('output') or args.get('output'), accept)
+    crop = parse_flag(data.get('crop') or args.get('crop'))
+    return items, fmt, output, crop
+
+
+def _render_batch_item(index: int, item: Any, fmt: str, crop: bool = False) -> Dict[str, Any]:
+    """渲染批量请求中的一项；失败只记录在该项的结果中，不影响其他条目"""
+    if not isinstance(item, dict):
+        return {'index': index, 'status': 400, 'error': '条目必须是 JSON 对象'}
+    text = str(item.get('text') or '').strip()
+    image_url = str(item.get('image_url') or '').strip()
+    emotion = str(item.get('emotion') or '').strip()
+    if not text and not image_url:
+        return {'index': index, 'status': 400, 'error': '请至少提供 text 或 image_url 参数之一'}
+
+    try:
+        cache_key = result_cache_key(text, emotion, image_url, fmt, crop=crop)
+        image_bytes = render_image_bytes(text, emotion, image_url, fmt, cache_key=cache_key, crop=crop)
+    except RenderError as e:
+        result = {'index': index, 'status': e.status, 'error': str(e)}
+        if e.retry_after is not None:
+            result['retry_after'] = e.retry_after
+        return result
+    except Exception as e:
+        logging.error("批量条目 %d 生成失败: %s", index, e, exc_info=True)
+        return {'index': index, 'status': 500, 'error': f'服务器内部错误: {str(e)}'}
+    return {
+        'index': index,
+        'status': 200,
+        'etag': cache_key[:32] if cache_key is not None else None,
+        'data': image_bytes,
+    }
+
+
+def submit_batch(items: List[Any], fmt: str, crop: bool = False) -> List["Future[Dict[str, Any]]"]:
+    """把各条目提交到批量线程池并行渲染，返回与条目一一对应的 Future"""
+    return [batch_executor.submit(_render_batch_item, i, item, fmt, crop) for i, item in enumerate(items)]
+
+
+def batch_log_fields(results: List[Dict[str, Any]], fmt: str, output: str, crop: bool) -> Dict[str, Any]:
+    """批量请求的请求日志字段"""
+    succeeded = sum(1 for r in results if 'data' in r)
+    return {'items': len(results), 'succeeded': succeeded, 'format': fmt, 'output': output, 'crop': crop}
+
+
+def batch_json(results: List[Dict[str, Any]], fmt: str) -> Dict[str, Any]:
+    """JSON 形式：成功的条目以 data URI 返回"""
+    items = []
+    for r in results:
+        entry = {k: v for k, v in r.items() if k != 'data'}
+        if 'data' in r:
+            entry['data_uri'] = f"data:{MIME_TYPES[fmt]};base64,{base64.b64encode(r['data']).decode('ascii')}"
+        items.append(entry)
+    return {'results': items}
+
+
+def batch_zip(results: List[Dict[str, Any]], fmt: str) -> bytes:
+    """ZIP 形式：成功的条目为 000.png 等文件，manifest.json 记录每一项的状态"""
+    buf = io.BytesIO()
+    manifest = []
+    # 图片本身已压缩，直接存储
+    with zipfile.ZipFile(buf, 'w', compression=zipfile.ZIP_STORED) as zf:
+        for r in results:
+            entry = {k: v for k, v in r.items() if k != 'data'}
+            if 'data' in r:
+                entry['file'] = f"{r['index']:03d}.{fmt}"
+                zf.writestr(entry['file'], r['data'])
+            manifest.append(entry)
+        zf.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2))
+    return buf.getvalue()
+
+
+def batch_multipart(results: List[Dict[str, Any]], fmt: str) -> Tuple[bytes, str]:
+    """multipart/mixed 形式：每项一个部分，失败的条目为 JSON 错误信息；返回 (响应体, boundary)"""
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for r in results:
+        if 'data' in r:
+            headers = [
+                f"Content-Type: {MIME_TYPES[fmt]}",
+                f'Content-Disposition: attachment; filename="{r["index"]:03d}.{fmt}"',
+            ]
+            if r.get('etag'):
+                headers.append(f'ETag: "{r["etag"]}"')
+            payload = r['data']
+        else:
+            headers = ["Content-Type: application/json; charset=utf-8"]
+            payload = json.dumps({'error': r['error']}, ensure_ascii=False).encode('utf-8')
+        headers += [f"X-Item-Index: {r['index']}", f"X-Item-Status: {r['status']}"]
+        head = ''.join(f"{h}\r\n" for h in headers)
+        body.write(f"--{boundary}\r\n{head}\r\n".encode('utf-8'))
+        body.write(payload)
+        body.write(b"\r\n")
+    body.write(f"--{boundary}--\r\n".encode('ascii'))
+    return body.getvalue(), boundary
+
+
+class AdminAuthError(Exception):
+    """管理接口鉴权失败，status 为应返回的 HTTP 状态码"""
+
+    def __init__(self, message: str, status: int):
+        super().__init__(message)
+        self.status = status
+
+
+def require_admin(authorization: Optional[str], token: Optional[str] = None) -> None:
+    """
+    校验管理接口令牌（Authorization: Bearer <令牌> 或 X-Admin-Token 头）。
+    未配置 admin_token 时管理接口不可用（404），令牌不匹配时返回 403。
+    """
+    expected = config.admin_token
+    if not expected:
+        raise AdminAuthError('未找到', 404)
+    if not token and authorization and authorization.lower().startswith('bearer '):
+        token = authorization[7:].strip()
+    if not token or not hmac.compare_digest(token.encode('utf-8'), expected.encode('utf-8')):
+        raise AdminAuthError('管理令牌无效', 403)
+
+
+# 单次采样分析的时长上限（秒）与采样间隔范围（毫秒）
+MAX_PROFILE_SECONDS = 300
+PROFILE_INTERVAL_MS = (1, 1000)
+
+
+def parse_profile_args(args: Mapping[str, Any]) -> Tuple[float, int, float]:
+    """
+    解析采样分析参数，返回 (持续秒数, 最多渲染任务数, 采样间隔秒数)，参数无效时抛出 ValueError。
+    seconds 默认 10，requests 默认 0（只按时长），interval_ms 默认 5
+    """
+    seconds = float(args.get('seconds') or 10)
+    max_requests = int(args.get('requests') or 0)
+    interval_ms = float(args.get('interval_ms') or 5)
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise ValueError(f'seconds 应在 0 到 {MAX_PROFILE_SECONDS} 之间')
+    if max_requests < 0:
+        raise ValueError('requests 不能为负数')
+    if not PROFILE_INTERVAL_MS[0] <= interval_ms <= PROFILE_INTERVAL_MS[1]:
+        raise ValueError(f'interval_ms 应在 {PROFILE_INTERVAL_MS[0]} 到 {PROFILE_INTERVAL_MS[1]} 之间')
+    return seconds, max_requests, interval_ms / 1000
+
+
+def run_profile(seconds: float, max_requests: int, interval: float) -> ProfileSession:
+    """
+    对之后 seconds 秒内（或前 max_requests 个）渲染任务采样调用栈，阻塞到结束后返回结果。
+    已有进行中的分析时抛出 ProfileBusyError。
+    """
+    session = start_profile(interval, seconds, max_requests)
+    logging.info("开始采样分析：%.0f 秒，最多 %d 个请求，间隔 %.0fms", seconds, max_requests, interval * 1000)
+    session.wait()
+    logging.info("采样分析结束：%d 个请求", session.requests)
+    return session
+
+
+def generate_log_fields(text: str, emotion: str, image_url: str, fmt: str,
+                        upload: Optional[Upload] = None, crop: bool = False) -> Dict[str, Any]:
+    """/generate 请求日志的结构化字段；只记录文本长度与图片来源，不记录内容"""
+    if upload is not None:
+        source = 'upload'
+    elif not image_url:
+        source = None
+    elif image_url.startswith(REMOTE_PREFIXES):
+        source = 'remote'
+    else:
+        source = 'base64'
+    return {
+        'emotion': emotion or None,
+        'text_length': len(text),
+        'image': source,
+        'format': fmt,
+        'crop': crop,
+    }
+
+
+def public_urls(scheme: str, host: str, server_port: Optional[str]) -> Dict[str, str]:
+    """
+    前端使用的服务地址。
+    server_port 为实际接收请求的端口，使用协议标准端口时不显示端口号；否则显示配置的端口
+    """
+    if (scheme == 'https' and server_port == '443') or \
+       (scheme == 'http' and server_port == '80'):
+        base_url = f'{scheme}://{host}'
+    else:
+        base_url = f'{scheme}://{host}:{config.server_port}'
+    return {
+        'server_url': base_url,
+        'api_url': f'{base_url}/generate'
+    }
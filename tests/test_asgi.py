@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""ASGI 入口：直接调用 asgi.app，检查生成接口、批量生成接口与渲染队列已满时的 503"""
+import asyncio
+import io
+import json
+import threading
+import time
+import zipfile
+
+import pytest
+
+asgi = pytest.importorskip("asgi")
+import service
+from render_executor import RenderExecutor, _fork_context
+
+
+def _call(method, path, body=None, headers=()):
+    """调用 ASGI 应用，返回 (状态码, 响应头, 响应体)"""
+    payload = json.dumps(body).encode("utf-8") if body is not None else b""
+    messages = [{"type": "http.request", "body": payload, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": b"",
+        "headers": [(b"content-type", b"application/json")] + [
+            (k.encode("latin-1"), v.encode("latin-1")) for k, v in headers
+        ],
+        "scheme": "http",
+        "server": ("127.0.0.1", 5000),
+    }
+    asyncio.run(asgi.app(scope, receive, send))
+    response_headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in sent[0]["headers"]}
+    return sent[0]["status"], response_headers, sent[1]["body"]
+
+
+def test_generate(monkeypatch):
+    monkeypatch.setattr(service.result_cache, "get", lambda key: None)
+    status, headers, body = _call("POST", "/generate", {"text": "你好", "format": "png"})
+    assert status == 200
+    assert headers["content-type"] == "image/png"
+    assert body.startswith(b"\x89PNG")
+
+
+@pytest.mark.parametrize("output", ["json", "zip", "multipart"])
+def test_generate_batch(monkeypatch, output):
+    monkeypatch.setattr(service.result_cache, "get", lambda key: None)
+    items = [{"text": "第一项"}, {"emotion": "开心"}, {"text": "第三项"}]
+    status, headers, body = _call("POST", "/generate/batch", {"items": items, "format": "png", "output": output})
+    assert status == 200
+    if output == "json":
+        results = json.loads(body)["results"]
+        assert [r["status"] for r in results] == [200, 400, 200]
+        assert results[0]["data_uri"].startswith("data:image/png;base64,")
+    elif output == "zip":
+        assert headers["content-type"] == "application/zip"
+        with zipfile.ZipFile(io.BytesIO(body)) as zf:
+            manifest = json.loads(zf.read("manifest.json"))
+            assert [r["status"] for r in manifest] == [200, 400, 200]
+            assert zf.read("002.png").startswith(b"\x89PNG")
+    else:
+        content_type, _, boundary = headers["content-type"].partition("; boundary=")
+        assert content_type == "multipart/mixed"
+        parts = body.split(b"--" + boundary.encode("ascii"))[1:-1]
+        assert [b"X-Item-Status: 200" in p for p in parts] == [True, False, True]
+
+
+def test_generate_batch_rejects_bad_request():
+    status, _, body = _call("POST", "/generate/batch", {"items": []})
+    assert status == 400
+    assert "items" in json.loads(body)["error"]
+    status, _, body = _call("POST", "/generate/batch", {"items": [{"text": "a"}], "output": "tar"})
+    assert status == 400
+
+
+def _slow_render(*args):
+    """替代 render_observed 的渲染任务：占用工作进程一段时间"""
+    time.sleep(1.0)
+    return b"\x89PNG", [], None
+
+
+async def _gather_calls(bodies):
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(*(loop.run_in_executor(None, _call, "POST", "/generate", b) for b in bodies))
+
+
+@pytest.mark.skipif(_fork_context() is None, reason="需要 fork")
+def test_full_render_queue_returns_503(monkeypatch):
+    executor = RenderExecutor(1, queue_size=0, timeout=10)
+    executor.start()
+    monkeypatch.setattr(service, "render_executor", executor)
+    monkeypatch.setattr(service, "render_observed", _slow_render)
+    monkeypatch.setattr(service.result_cache, "get", lambda key: None)
+    monkeypatch.setattr(service.result_cache, "put", lambda key, value: None)
+    try:
+        # 第一个请求占用唯一的名额，其余请求应立即得到 503，而不是排队等待
+        started = time.monotonic()
+        first = threading.Thread(target=_call, args=("POST", "/generate", {"text": "占用"}))
+        first.start()
+        while not executor.pending:
+            time.sleep(0.01)
+        results = asyncio.run(_gather_calls([{"text": f"排队 {i}"} for i in range(4)]))
+        assert time.monotonic() - started < 0.9
+        for status, headers, body in results:
+            assert status == 503
+            assert int(headers["retry-after"]) >= 1
+            assert "繁忙" in json.loads(body)["error"]
+        first.join()
+    finally:
+        executor.shutdown()
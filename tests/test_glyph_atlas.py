@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""draw_glyphs 与 draw.text 逐像素一致；Pillow 内部接口出错时停用并交回 draw.text"""
+import pytest
+from PIL import Image, ImageDraw, ImageFont
+
+import glyph_atlas
+from glyph_atlas import draw_glyphs
+
+TEXT = "AVATAR fi Wa, Tokyo"
+
+
+@pytest.fixture
+def font():
+    font = ImageFont.load_default(24)
+    if not isinstance(font, ImageFont.FreeTypeFont):
+        pytest.skip("需要 FreeType")
+    return font
+
+
+def _canvas():
+    return Image.new("RGBA", (400, 60), (255, 255, 255, 255))
+
+
+def test_matches_draw_text(font):
+    expected = _canvas()
+    draw = ImageDraw.Draw(expected)
+    draw.text((7, 11), TEXT, font=font, fill=(200, 30, 40))
+
+    actual = _canvas()
+    draw = ImageDraw.Draw(actual)
+    assert draw_glyphs(draw, (7, 11), TEXT, font, (200, 30, 40), draw.textlength(TEXT, font=font))
+    assert actual.tobytes() == expected.tobytes()
+
+
+def test_internal_api_error_disables_atlas(font, monkeypatch):
+    def broken(*args):
+        raise AttributeError("'Image' object has no attribute '_new'")
+
+    monkeypatch.setattr(glyph_atlas, "_enabled", True)
+    monkeypatch.setattr(glyph_atlas, "_rasterize", broken)
+    glyph_atlas._glyph_cache.clear()
+
+    canvas = _canvas()
+    draw = ImageDraw.Draw(canvas)
+    assert not draw_glyphs(draw, (0, 0), TEXT, font, (0, 0, 0))
+    assert canvas.tobytes() == _canvas().tobytes()
+    assert not glyph_atlas._enabled
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""ImageDecoder 缩小解码：各种模式与格式的大图都应能解码为 RGBA"""
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from image_decoder import ImageDecoder
+
+TARGET = (279, 175)
+SIZE = (2000, 2000)
+
+
+def _encode(im: Image.Image, fmt: str, **params) -> bytes:
+    buf = BytesIO()
+    im.save(buf, fmt, **params)
+    return buf.getvalue()
+
+
+def _palette_image() -> Image.Image:
+    im = Image.new("RGB", SIZE, (255, 0, 0))
+    im.paste((0, 0, 255), (0, 0, SIZE[0] // 2, SIZE[1]))
+    return im.quantize(4)
+
+
+def _gif() -> bytes:
+    return _encode(_palette_image(), "GIF")
+
+
+def _palette_png_transparent() -> bytes:
+    im = _palette_image()
+    transparent = im.getpixel((0, 0))
+    return _encode(im, "PNG", transparency=transparent)
+
+
+def _bilevel_png() -> bytes:
+    return _encode(Image.new("1", SIZE, 1), "PNG")
+
+
+def _png_16bit() -> bytes:
+    return _encode(Image.new("I;16", SIZE, 40000), "PNG")
+
+
+def _cmyk_jpeg() -> bytes:
+    return _encode(Image.new("CMYK", SIZE, (0, 255, 255, 0)), "JPEG")
+
+
+@pytest.mark.parametrize("data", [_gif(), _palette_png_transparent(), _bilevel_png(), _png_16bit(), _cmyk_jpeg()],
+                         ids=["gif", "palette-png", "1-bit", "16-bit", "cmyk-jpeg"])
+def test_reduced_decode_supports_mode(data):
+    im = ImageDecoder(TARGET).decode(data)
+    assert im.mode == "RGBA"
+    # 缩小后仍不小于等比放入尺寸的 reducing_gap 倍，且确实缩小了
+    assert TARGET[1] * 2 <= im.height < SIZE[1]
+
+
+def test_palette_transparency_is_kept():
+    im = ImageDecoder(TARGET).decode(_palette_png_transparent())
+    assert im.getpixel((0, 0))[3] == 0
+    assert im.getpixel((im.width - 1, 0)) == (255, 0, 0, 255)
+
+
+def test_cmyk_colors():
+    r, g, b, a = ImageDecoder(TARGET).decode(_cmyk_jpeg()).getpixel((10, 10))
+    assert r > 200 and g < 50 and b < 50 and a == 255
+
+
+def test_exif_rotated_jpeg():
+    exif = Image.Exif()
+    exif[0x0112] = 6  # 顺时针旋转 90°
+    im = Image.new("RGB", (2000, 1000), (0, 128, 0))
+    decoded = ImageDecoder(TARGET).decode(_encode(im, "JPEG", exif=exif.tobytes()))
+    assert decoded.mode == "RGBA"
+    assert decoded.height > decoded.width
+    # 目标框按旋转后的方向计算：缩小后的宽不低于目标框的高
+    assert TARGET[1] <= decoded.width < 1000
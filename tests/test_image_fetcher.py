@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""ImageFetcher：用本地 http.server 模拟远程图片服务"""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from image_fetcher import FetchError, ImageFetcher
+
+MAX_BYTES = 64 * 1024
+
+
+def _png(color=(255, 0, 0)) -> bytes:
+    buf = BytesIO()
+    Image.new("RGB", (32, 32), color).save(buf, "PNG")
+    return buf.getvalue()
+
+
+PNG = _png()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        if not any(name == "Content-Length" for name, _ in headers):
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, dict(self.headers)))
+        if self.path in ("/img.png", "/other.png"):
+            if self.headers.get("If-None-Match") == '"v1"':
+                self._send(304, headers=[("ETag", '"v1"')])
+            else:
+                self._send(200, PNG, [("Content-Type", "image/png"), ("ETag", '"v1"'),
+                                      ("Cache-Control", server.cache_control)])
+        elif self.path == "/page.html":
+            self._send(200, b"<html>" + b" " * 100 + b"</html>", [("Content-Type", "text/html")])
+        elif self.path == "/fake.png":
+            self._send(200, b"this is not a png at all" * 10, [("Content-Type", "image/png")])
+        elif self.path == "/declared-big.png":
+            self._send(200, PNG, [("Content-Type", "image/png"), ("Content-Length", str(MAX_BYTES + 1))])
+        elif self.path == "/streamed-big.png":
+            # 不声明长度，只能在读取过程中按已读字节数中止
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            try:
+                self.wfile.write(PNG[:16])
+                for _ in range(MAX_BYTES // 4096 * 4):
+                    self.wfile.write(b"\0" * 4096)
+            except OSError:
+                pass
+        elif self.path == "/redirect":
+            self._send(302, headers=[("Location", "/img.png")])
+        elif self.path in ("/endless-redirect", "/declared-endless-redirect"):
+            # 重定向正文不设上限地发送，客户端不应读完
+            self.send_response(302)
+            self.send_header("Location", "/img.png")
+            if self.path.startswith("/declared"):
+                self.send_header("Content-Length", str(1 << 40))
+            else:
+                self.send_header("Connection", "close")
+                self.close_connection = True
+            self.end_headers()
+            try:
+                while True:
+                    self.wfile.write(b"\0" * 65536)
+            except OSError:
+                pass
+        else:
+            self._send(404, b"not found", [("Content-Type", "text/plain")])
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    httpd.daemon_threads = True
+    httpd.connections = 0
+    httpd.requests = []
+    httpd.cache_control = "max-age=300"
+    thread = threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def make_fetcher():
+    fetchers = []
+
+    def make(**kwargs):
+        kwargs.setdefault("timeout", 5.0)
+        kwargs.setdefault("max_bytes", MAX_BYTES)
+        fetcher = ImageFetcher(**kwargs)
+        fetchers.append(fetcher)
+        return fetcher
+
+    yield make
+    for fetcher in fetchers:
+        fetcher.close()
+
+
+def _url(server, path):
+    return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+
+def test_fetch_decodes_image(server, make_fetcher):
+    image = make_fetcher().fetch(_url(server, "/img.png"))
+    assert image.size == (32, 32)
+    assert image.convert("RGB").getpixel((0, 0)) == (255, 0, 0)
+
+
+def test_keep_alive_connection_is_reused(server, make_fetcher):
+    fetcher = make_fetcher()
+    fetcher.fetch(_url(server, "/img.png"))
+    fetcher.fetch(_url(server, "/other.png"))
+    assert len(server.requests) == 2
+    assert server.connections == 1
+
+
+def test_cache_hit_skips_request(server, make_fetcher):
+    fetcher = make_fetcher()
+    first = fetcher.fetch(_url(server, "/img.png"))
+    assert fetcher.fetch(_url(server, "/img.png")) is first
+    assert len(server.requests) == 1
+
+
+def test_no_store_is_not_cached(server, make_fetcher):
+    server.cache_control = "no-store"
+    fetcher = make_fetcher()
+    fetcher.fetch(_url(server, "/img.png"))
+    fetcher.fetch(_url(server, "/img.png"))
+    assert len(server.requests) == 2
+    assert "If-None-Match" not in server.requests[1][1]
+
+
+def test_expired_entry_is_revalidated(server, make_fetcher):
+    fetcher = make_fetcher(cache_ttl=0)
+    first = fetcher.fetch(_url(server, "/img.png"))
+    # 过期后发条件请求，304 时沿用已解码的图片
+    assert fetcher.fetch(_url(server, "/img.png")) is first
+    assert len(server.requests) == 2
+    assert server.requests[1][1].get("If-None-Match") == '"v1"'
+
+
+def test_redirect_is_followed(server, make_fetcher):
+    image = make_fetcher().fetch(_url(server, "/redirect"))
+    assert image.size == (32, 32)
+    assert [path for path, _ in server.requests] == ["/redirect", "/img.png"]
+
+
+@pytest.mark.parametrize("path", ["/endless-redirect", "/declared-endless-redirect"])
+def test_redirect_body_is_not_read(server, make_fetcher, path):
+    fetcher = make_fetcher(max_bytes=MAX_BYTES, timeout=5.0)
+    image = fetcher.fetch(_url(server, path))
+    assert image.size == (32, 32)
+    # 正文未读完的连接被关闭，跟随重定向时建立新连接
+    assert server.connections == 2
+
+
+@pytest.mark.parametrize("path, message", [
+    ("/page.html", "不是图片"),
+    ("/fake.png", "不是可识别的图片格式"),
+    ("/declared-big.png", "图片过大"),
+    ("/streamed-big.png", "超过大小上限"),
+    ("/missing", "HTTP 404"),
+])
+def test_rejected_responses(server, make_fetcher, path, message):
+    with pytest.raises(FetchError, match=message):
+        make_fetcher().fetch(_url(server, path))
+
+
+def test_unsupported_scheme(make_fetcher):
+    with pytest.raises(FetchError, match="不支持的图片地址"):
+        make_fetcher().fetch("ftp://example.com/a.png")
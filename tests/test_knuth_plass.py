@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""_kp_break_paragraph 的单调队列 DP 应与同一代价模型的 O(n^2) 动态规划结果一致"""
+import random
+from typing import List
+
+import pytest
+
+from text_fit_draw import (
+    _KP_BRACKET_BREAK_PENALTY,
+    _KP_LINE_PENALTY,
+    _KP_LINE_START_PENALTY,
+    _NO_LINE_START,
+    _kp_break_paragraph,
+)
+
+
+def _brute_force(tokens: List[str], widths: List[float], max_w: int) -> List[str]:
+    """逐一比较全部起点的参考实现，代价定义与 _kp_break_paragraph 的文档一致"""
+    n = len(tokens)
+    if n == 0:
+        return [""]
+
+    def line_width(j: int, i: int) -> float:
+        lo = j + 1 if tokens[j].isspace() else j
+        hi = i - 1 if tokens[i - 1].isspace() else i
+        return sum(widths[lo:hi]) if lo < hi else 0.0
+
+    def penalty(i: int) -> float:
+        depth = sum(t.count("【") - t.count("】") for t in tokens[:i])
+        p = _KP_BRACKET_BREAK_PENALTY if depth > 0 else 0.0
+        if tokens[i][0] in _NO_LINE_START:
+            p += _KP_LINE_START_PENALTY
+        return p
+
+    inf = float("inf")
+    dp = [inf] * (n + 1)
+    prev = [-1] * (n + 1)
+    dp[0] = 0.0
+    for i in range(1, n):
+        best, best_cost = -1, inf
+        for j in range(i):
+            slack = max_w - line_width(j, i)
+            if slack < 0:
+                continue
+            c = dp[j] + (_KP_LINE_PENALTY + 100.0 * (slack / max_w) ** 3) ** 2
+            if c < best_cost:
+                best, best_cost = j, c
+        if best < 0:
+            best, best_cost = i - 1, dp[i - 1] + _KP_LINE_PENALTY ** 2
+        dp[i] = best_cost + penalty(i)
+        prev[i] = best
+
+    best = n - 1
+    for j in range(n - 1, -1, -1):
+        if line_width(j, n) <= max_w and dp[j] <= dp[best]:
+            best = j
+    prev[n] = best
+
+    lines = []
+    idx = n
+    while idx > 0:
+        j = prev[idx]
+        lines.append("".join(tokens[j:idx]).strip(" \t"))
+        idx = j
+    lines.reverse()
+    return lines
+
+
+_POOL = ["字", "词", "word", " ", "，", "。", "！", "【", "】", "…"]
+
+
+def _random_case(rng: random.Random):
+    n = rng.randint(1, 60)
+    tokens = []
+    for k in range(n):
+        tok = rng.choice(_POOL)
+        # 加上序号，使不同的断行方案得到不同的行文本
+        tokens.append(tok if tok.isspace() else f"{tok}{k}")
+    # 宽度取连续随机值，除行首/行尾空白外不会出现代价相同的方案
+    widths = [rng.uniform(4.0, 60.0) for _ in tokens]
+    max_w = rng.randint(40, 320)
+    return tokens, widths, max_w
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_matches_brute_force(seed):
+    rng = random.Random(seed)
+    for _ in range(300):
+        tokens, widths, max_w = _random_case(rng)
+        assert _kp_break_paragraph(tokens, widths, max_w) == _brute_force(tokens, widths, max_w), (
+            tokens, widths, max_w)
+
+
+def test_empty_paragraph():
+    assert _kp_break_paragraph([], [], 100) == [""]
+
+
+def test_overwide_token_gets_own_line():
+    tokens = ["a", "wide", "b"]
+    assert _kp_break_paragraph(tokens, [10.0, 500.0, 10.0], 100) == ["a", "wide", "b"]
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""非阻塞日志：队列已满时丢弃并计数，计数可随渲染任务的观测值汇总；字段截断"""
+import json
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+import log_pipeline
+from log_pipeline import JsonFormatter, configure_logging, take_dropped, truncate
+from metrics import LOG_DROPPED, collect, count, replay
+
+
+@pytest.fixture
+def root_logger():
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield root
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+    log_pipeline._max_field_chars = 256
+
+
+def _config(**overrides):
+    values = dict(log_format="json", log_queue_size=2, log_max_field_chars=16, logging_level="INFO")
+    values.update(overrides)
+    return SimpleNamespace(**values)
+
+
+def test_full_queue_drops_without_blocking(root_logger):
+    # 不启动写出线程，队列放满后的记录全部丢弃
+    configure_logging(_config())
+    for i in range(5):
+        logging.info("记录 %d", i)
+    assert take_dropped() == 3
+    assert take_dropped() == 0
+
+
+def test_drops_are_replayed_into_metric(root_logger):
+    configure_logging(_config(log_queue_size=1))
+    logging.info("a")
+    logging.info("b")
+    before = LOG_DROPPED.value()
+    # 渲染进程中的丢弃数随任务观测值返回主进程后计入
+    with collect() as observations:
+        count(LOG_DROPPED, take_dropped())
+    assert LOG_DROPPED.value() == before
+    replay(observations)
+    assert LOG_DROPPED.value() == before + 1
+
+
+def test_configure_resets_inherited_count(root_logger):
+    configure_logging(_config(log_queue_size=1))
+    logging.info("a")
+    logging.info("b")
+    configure_logging(_config())
+    assert take_dropped() == 0
+
+
+def test_json_formatter_truncates_fields(root_logger):
+    configure_logging(_config())
+    record = logging.LogRecord("anan.request", logging.INFO, __file__, 1, "x" * 40, None, None)
+    record.fields = {"emotion": "y" * 40, "status": 200}
+    data = json.loads(JsonFormatter().format(record))
+    assert data["msg"] == truncate("x" * 40) and data["msg"].startswith("x" * 16 + "…")
+    assert data["emotion"].startswith("y" * 16 + "…") and data["status"] == 200
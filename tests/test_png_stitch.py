@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""分段编码的 PNG 解码后应与直接贴图的结果逐像素一致，zlib 流（含 adler32）完整有效"""
+import os
+import random
+import struct
+import zlib
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from png_stitch import _adler32_combine, encode_png_rows
+
+WIDTH, HEIGHT = 97, 61
+
+
+def _noise(mode: str, size) -> Image.Image:
+    return Image.frombytes(mode, size, os.urandom(size[0] * size[1] * len(mode)))
+
+
+def _idat_stream(data: bytes) -> bytes:
+    """拼接全部 IDAT 块的数据，同时校验每个块的 CRC"""
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+    pos, stream = 8, b""
+    while pos < len(data):
+        length, tag = struct.unpack(">I4s", data[pos:pos + 8])
+        body = data[pos + 8:pos + 8 + length]
+        (crc,) = struct.unpack(">I", data[pos + 8 + length:pos + 12 + length])
+        assert crc == zlib.crc32(body, zlib.crc32(tag))
+        if tag == b"IDAT":
+            stream += body
+        pos += 12 + length
+    assert tag == b"IEND"
+    return stream
+
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA"])
+@pytest.mark.parametrize("box", [
+    (10, 20, 50, 35),                # 中间若干行
+    (0, 0, 30, 12),                  # 从第 0 行开始
+    (40, HEIGHT - 9, WIDTH, HEIGHT),  # 到最后一行为止
+    (5, 0, 60, HEIGHT),              # 覆盖全部行
+    (0, 30, WIDTH, 31),              # 单行、整行宽
+], ids=["middle", "first-row", "last-row", "full-height", "single-row"])
+def test_round_trip_matches_paste(mode, box):
+    background = _noise(mode, (WIDTH, HEIGHT))
+    # 同一底图、同一行范围编码两次，第二次使用缓存的上下两段
+    for _ in range(2):
+        tile = _noise(mode, (box[2] - box[0], box[3] - box[1]))
+        data = encode_png_rows(background, tile, box, compress_level=1)
+
+        expected = background.copy()
+        expected.paste(tile, box[:2])
+        decoded = Image.open(BytesIO(data))
+        assert decoded.mode == mode and decoded.size == (WIDTH, HEIGHT)
+        assert decoded.tobytes() == expected.tobytes()
+
+        # zlib 严格校验 adler32，拼接处或校验值出错时抛出异常
+        raw = zlib.decompress(_idat_stream(data))
+        assert len(raw) == HEIGHT * (1 + WIDTH * len(mode))
+
+
+def test_background_is_not_modified():
+    background = _noise("RGB", (WIDTH, HEIGHT))
+    before = background.tobytes()
+    encode_png_rows(background, _noise("RGB", (20, 10)), (0, 5, 20, 15))
+    assert background.tobytes() == before
+
+
+def test_mode_mismatch_is_rejected():
+    with pytest.raises(ValueError):
+        encode_png_rows(_noise("RGB", (8, 8)), _noise("RGBA", (4, 4)), (0, 0, 4, 4))
+
+
+def test_adler32_combine():
+    rng = random.Random(0)
+    for length in (0, 1, 100, 65521, 65522, 200_000):
+        data = rng.randbytes(length)
+        for split in {0, length // 3, length}:
+            a, b = data[:split], data[split:]
+            assert _adler32_combine(zlib.adler32(a), zlib.adler32(b), len(b)) == zlib.adler32(data)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""RenderExecutor：排队上限、工作进程内的超时中止，以及工作进程异常退出后的降级"""
+import os
+import threading
+import time
+
+import pytest
+
+from render_executor import (
+    ExecutorBusyError,
+    RenderExecutor,
+    RenderTimeoutError,
+    WorkerCrashedError,
+    _fork_context,
+)
+
+pytestmark = pytest.mark.skipif(_fork_context() is None, reason="需要 fork")
+
+
+def _crash() -> None:
+    os._exit(1)
+
+
+@pytest.fixture
+def make_executor():
+    executors = []
+
+    def make(workers=1, queue_size=0, timeout=10.0):
+        executor = RenderExecutor(workers, queue_size=queue_size, timeout=timeout)
+        executor.start()
+        executors.append(executor)
+        return executor
+
+    yield make
+    for executor in executors:
+        executor.shutdown()
+
+
+def _wait_idle(executor, seconds=5.0):
+    deadline = time.monotonic() + seconds
+    while executor.pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return executor.pending == 0
+
+
+def test_full_queue_is_rejected(make_executor):
+    executor = make_executor(workers=1, queue_size=0)
+    thread = threading.Thread(target=executor.run, args=(time.sleep, 0.5))
+    thread.start()
+    while not executor.pending:
+        time.sleep(0.01)
+    with pytest.raises(ExecutorBusyError):
+        executor.run(os.getpid)
+    thread.join()
+
+
+def test_timed_out_job_is_stopped_in_worker(make_executor):
+    executor = make_executor(workers=1, queue_size=0, timeout=0.3)
+    started = time.monotonic()
+    with pytest.raises(RenderTimeoutError):
+        executor.run(time.sleep, 30)
+    # 任务在工作进程中被中止，名额与工作进程随即释放
+    assert _wait_idle(executor)
+    assert time.monotonic() - started < 5
+    assert executor.run(os.getpid) != os.getpid()
+
+
+def test_broken_pool_falls_back_to_calling_thread(make_executor):
+    executor = make_executor(workers=1, queue_size=0)
+    assert executor.workers == 1
+    assert executor.run(os.getpid) != os.getpid()
+    with pytest.raises(WorkerCrashedError) as info:
+        executor.run(_crash)
+    assert info.value.retry_after >= 1
+    assert executor.workers == 0
+    assert executor.run(os.getpid) == os.getpid()
+
+
+def test_fallback_keeps_queue_limit(make_executor):
+    executor = make_executor(workers=1, queue_size=0)
+    with pytest.raises(WorkerCrashedError):
+        executor.run(_crash)
+    release = threading.Event()
+    thread = threading.Thread(target=executor.run, args=(release.wait,))
+    thread.start()
+    while not executor.pending:
+        time.sleep(0.01)
+    try:
+        with pytest.raises(ExecutorBusyError):
+            executor.run(os.getpid)
+    finally:
+        release.set()
+        thread.join()
+    assert executor.run(os.getpid) == os.getpid()
@@ -1,18 +1,46 @@
 # -*- coding: utf-8 -*-
 # filename: text_fit_draw.py
+import math
 import os
+import time
+import weakref
+from collections import deque
 from io import BytesIO
-from typing import List, Literal, Optional, Tuple, Union
+from typing import Deque, Dict, Iterable, List, Literal, NamedTuple, Optional, Tuple, Union
 
 from PIL import Image, ImageDraw, ImageFont
 
+from glyph_atlas import draw_glyphs, warm_glyphs
+from lru_cache import LRUCache
+from metrics import FONT_PROBES, STAGE_SECONDS, observe, stage
+
 RGBColor = Tuple[int, int, int]
 
 Align = Literal["left", "center", "right"]
 VAlign = Literal["top", "middle", "bottom"]
 
+# 进程级字体缓存：(font_path, size) -> 字体对象
+_font_cache: LRUCache[Tuple[Optional[str], int], ImageFont.FreeTypeFont] = LRUCache(256)
 
-def _load_font(font_path: Optional[str], size: int) -> ImageFont.FreeTypeFont:
+
+class TextLayout(NamedTuple):
+    """字号搜索与换行的结果，可跨请求复用"""
+    font_size: int
+    lines: Tuple[str, ...]
+    line_height: int
+    block_height: int
+    probes: int = 0
+    """确定字号时实际执行换行的次数"""
+
+
+# 排版结果缓存：(text, font_path, region_w, region_h, line_spacing, wrap_algorithm, max_font_height) -> TextLayout
+_layout_cache: LRUCache[tuple, TextLayout] = LRUCache(1024)
+
+# 逐字符前进宽度表：字体对象 -> {字符: 宽度}，随字体对象一同释放
+_advance_tables: "weakref.WeakKeyDictionary[ImageFont.FreeTypeFont, Dict[str, float]]" = weakref.WeakKeyDictionary()
+
+
+def _create_font(font_path: Optional[str], size: int) -> ImageFont.FreeTypeFont:
     """
     加载指定路径的字体文件，如果失败则加载默认字体。
     """
@@ -24,18 +52,117 @@ def _load_font(font_path: Optional[str], size: int) -> ImageFont.FreeTypeFont:
         return ImageFont.load_default()  # type: ignore # 如果没有可用的 TTF 字体，则加载默认位图字体
 
 
+def _load_font(font_path: Optional[str], size: int) -> ImageFont.FreeTypeFont:
+    """
+    从缓存获取字体对象，未命中时从磁盘加载。
+    """
+    return _font_cache.get_or_create((font_path, size), lambda: _create_font(font_path, size))
+
+
+def configure_font_cache(maxsize: int) -> None:
+    """设置字体缓存容量上限"""
+    _font_cache.resize(maxsize)
+
+
+def warm_font_cache(font_path: Optional[str], max_size: int) -> None:
+    """
+    预加载 1..max_size 全部字号，使字号搜索过程不再访问文件系统。
+    """
+    for size in range(1, max_size + 1):
+        _load_font(font_path, size)
+
+
+def warm_glyph_cache(font_path: Optional[str], sizes: Iterable[int], chars: Iterable[str]) -> None:
+    """
+    在给定字号下预先光栅化字符，绘制这些字符时直接使用缓存的字形。
+    """
+    chars = set(chars)
+    for size in sizes:
+        warm_glyphs(_load_font(font_path, size), chars)
+
+
+def font_cache_stats() -> dict:
+    """返回字体缓存的命中/未命中统计"""
+    return _font_cache.stats()
+
+
+def configure_layout_cache(maxsize: int) -> None:
+    """设置排版结果缓存容量上限"""
+    _layout_cache.resize(maxsize)
+
+
+def layout_cache_stats() -> dict:
+    """返回排版结果缓存的命中/未命中统计"""
+    return _layout_cache.stats()
+
+
+class _Measurer:
+    """
+    文本测宽工具。字符宽度从按字体缓存的前进宽度表中累加得到，避免对逐步增长的字符串反复排版；
+    仅当累加值落在 max_w ± slack 的临界区间内时，才用 draw.textlength 精确测量以计入字距调整。
+    """
+
+    __slots__ = ("draw", "font", "widths", "slack")
+
+    def __init__(self, draw: ImageDraw.ImageDraw, font: ImageFont.FreeTypeFont):
+        self.draw = draw
+        self.font = font
+        widths = _advance_tables.get(font)
+        if widths is None:
+            widths = _advance_tables.setdefault(font, {})
+        self.widths = widths
+        # 字距调整对整行宽度的影响远小于 1/8 字号
+        self.slack = max(1.0, getattr(font, "size", 8) / 8)
+
+    def char(self, ch: str) -> float:
+        w = self.widths.get(ch)
+        if w is None:
+            w = self.widths[ch] = self.draw.textlength(ch, font=self.font)
+        return w
+
+    def width(self, s: str) -> float:
+        """按字符宽度累加估算字符串宽度"""
+        widths = self.widths
+        total = 0.0
+        for ch in s:
+            w = widths.get(ch)
+            if w is None:
+                w = self.char(ch)
+            total += w
+        return total
+
+    def exact(self, s: str) -> float:
+        """精确宽度：单字符直接查表，多字符调用 draw.textlength"""
+        if len(s) == 1:
+            return self.char(s)
+        return self.draw.textlength(s, font=self.font)
+
+    def fits(self, s: str, estimate: float, max_w: float) -> bool:
+        """判断宽度估算为 estimate 的字符串 s 是否不超过 max_w"""
+        if estimate <= max_w - self.slack:
+            return True
+        if estimate > max_w + self.slack:
+            return False
+        return self.draw.textlength(s, font=self.font) <= max_w
+
+
 def wrap_lines(
     draw: ImageDraw.ImageDraw, txt: str, font: ImageFont.FreeTypeFont, max_w: int
 ) -> List[str]:
     """
     将文本按指定宽度拆分为多行。
+    行宽按字符宽度增量累加，只在接近行宽上限时精确测量。
     """
     lines: List[str] = []
+    m = _Measurer(draw, font)
+    space_w = m.char(" ")
 
     for para in txt.splitlines() or [""]:
         has_space = " " in para
         units = para.split(" ") if has_space else list(para)
+        sep_w = space_w if has_space else 0.0
         buf = ""
+        buf_w = 0.0
 
         def unit_join(a: str, b: str) -> str:
             if not a:
@@ -43,12 +170,13 @@ def wrap_lines(
             return (a + " " + b) if has_space else (a + b)
 
         for u in units:
+            u_w = m.width(u)
             trial = unit_join(buf, u)
-            w = draw.textlength(trial, font=font)
+            trial_w = buf_w + sep_w + u_w if buf else u_w
 
             # 如果加入当前单元后宽度未超限，则继续累积
-            if w <= max_w:
-                buf = trial
+            if m.fits(trial, trial_w, max_w):
+                buf, buf_w = trial, trial_w
                 continue
 
             # 否则先将缓冲区内容作为一行输出
@@ -58,22 +186,25 @@ def wrap_lines(
             # 处理当前单元
             if has_space and len(u) > 1:
                 tmp = ""
+                tmp_w = 0.0
                 for ch in u:
-                    if draw.textlength(tmp + ch, font=font) <= max_w:
+                    ch_w = m.char(ch)
+                    if m.fits(tmp + ch, tmp_w + ch_w, max_w):
                         tmp += ch
+                        tmp_w += ch_w
                         continue
 
                     if tmp:
                         lines.append(tmp)
-                    tmp = ch
-                buf = tmp
+                    tmp, tmp_w = ch, ch_w
+                buf, buf_w = tmp, tmp_w
                 continue
 
-            if draw.textlength(u, font=font) <= max_w:
-                buf = u
+            if m.fits(u, u_w, max_w):
+                buf, buf_w = u, u_w
             else:
                 lines.append(u)
-                buf = ""
+                buf, buf_w = "", 0.0
         if buf != "":
             lines.append(buf)
         if para == "" and (not lines or lines[-1] != ""):
@@ -95,69 +226,46 @@ def _split_long_token(draw: ImageDraw.ImageDraw, token: str, font: ImageFont.Fre
     对于成对括号 token，会尝试在不拆开括号两端的情况下拆内部；当确实无法放下时，
     会把内部切成多个段并把括号字符附在首/尾段上，从而在必要时可拆开。
     """
+    m = _Measurer(draw, font)
+
     # 快速返回
-    if draw.textlength(token, font=font) <= max_w:
+    if m.fits(token, m.width(token), max_w):
         return [token]
 
-    # 检查是否为成对括号 token
-    if _is_bracket_token(token) and len(token) > 2:
-        inner = token
-        # 先尝试把整个 bracket token 当作一个单位（失败），则分割 inner
-        chunks_inner: List[str] = []
+    def split_chars(s: str, out: List[str]) -> None:
+        # 按字符累积拆分；单字符也超限时强行发出该字符，避免死循环
         buf = ""
-        for ch in inner:
-            trial = buf + ch
-            # 为首段和末段我们会额外加上括号宽度，先用 conservative 估计：
-            # 这里不把括号加到 trial 中判断（下面会在生成带括号的段时二次检查）
-            if draw.textlength(trial, font=font) <= max_w:
-                buf = trial
+        buf_w = 0.0
+        for ch in s:
+            ch_w = m.char(ch)
+            if m.fits(buf + ch, buf_w + ch_w, max_w):
+                buf += ch
+                buf_w += ch_w
+            elif buf == "":
+                out.append(ch)
             else:
-                if buf == "":
-                    # 单字符也超过 max_w，强行发出单字符（避免死循环）
-                    chunks_inner.append(ch)
-                    buf = ""
-                else:
-                    chunks_inner.append(buf)
-                    buf = ch
+                out.append(buf)
+                buf, buf_w = ch, ch_w
         if buf:
-            chunks_inner.append(buf)
+            out.append(buf)
+
+    # 检查是否为成对括号 token
+    if _is_bracket_token(token) and len(token) > 2:
+        # 整个 bracket token 放不下，则分割其内部；括号字符留在首/尾段上
+        chunks_inner: List[str] = []
+        split_chars(token, chunks_inner)
 
         safe: List[str] = []
         for piece in chunks_inner:
-            if draw.textlength(piece, font=font) <= max_w:
+            if m.fits(piece, m.width(piece), max_w):
                 safe.append(piece)
             else:
-                # break into characters
-                tmp = ""
-                for ch in piece:
-                    trial = tmp + ch
-                    if draw.textlength(trial, font=font) <= max_w:
-                        tmp = trial
-                    else:
-                        if tmp:
-                            safe.append(tmp)
-                        tmp = ch
-                if tmp:
-                    safe.append(tmp)
+                split_chars(piece, safe)
         return safe
 
     # 非括号长 token：按字符累积拆分
     parts: List[str] = []
-    buf = ""
-    for ch in token:
-        trial = buf + ch
-        if draw.textlength(trial, font=font) <= max_w:
-            buf = trial
-        else:
-            if buf == "":
-                # 单字符也超限（极端），强行放这个字符
-                parts.append(ch)
-                buf = ""
-            else:
-                parts.append(buf)
-                buf = ch
-    if buf:
-        parts.append(buf)
+    split_chars(token, parts)
     return parts
 
 
@@ -204,11 +312,12 @@ def tokenize(
         tokens.append(buf)
 
     # now split tokens that are too long
+    m = _Measurer(draw, font)
     final_tokens: List[str] = []
     for tok in tokens:
         if tok == "":
             continue
-        if draw.textlength(tok, font=font) <= max_w:
+        if m.fits(tok, m.width(tok), max_w):
             final_tokens.append(tok)
         else:
             splits = _split_long_token(draw, tok, font, max_w)
@@ -216,68 +325,140 @@ def tokenize(
     return final_tokens
 
 
-def wrap_lines_knuth_plass(
-        draw: ImageDraw.ImageDraw, txt: str, font: ImageFont.FreeTypeFont, max_w: int
-) -> List[str]:
+# Knuth–Plass 代价模型（参考 TeX 的 demerits 定义）
+_KP_LINE_PENALTY = 10.0
+"""每行的固定代价，使总行数更少的方案更优"""
+_KP_BRACKET_BREAK_PENALTY = 2500.0
+"""在【】括号内部断行的额外代价"""
+_KP_LINE_START_PENALTY = 10000.0
+"""以禁止出现在行首的标点开头的额外代价"""
+_NO_LINE_START = set("，。、！？；：,.!?;:）)》」』】…—~～")
+
+
+def _kp_break_paragraph(tokens: List[str], widths: List[float], max_w: int) -> List[str]:
     """
-    将文本按指定宽度拆分为多行。
-    简化的 Knuth–Plass 算法
+    对单个段落的 token 序列求最优断行。
+
+    dp[i] 为前 i 个 token 的最小总代价；行 (j, i] 的代价为
+    (行惩罚 + 100 * (剩余宽度 / max_w)^3)^2（超宽为无穷大），再加上在位置 i 断行的惩罚
+    （括号内、行首标点）。段落最后一行不计剩余宽度。行首/行尾的空白 token 不计入行宽，输出时去掉。
+
+    行代价是行宽的凸函数，满足四边形不等式，因此每个起点 j 成为最优的 i 构成连续区间，
+    且较晚的 j 只会接管靠后的区间。用单调队列保存 (j, 起始 i)，新候选入队时
+    二分查找其接管位置，总复杂度 O(n log n)。最后一行只在有界回看窗口
+    （max_w / 最小 token 宽度）内扫描。
     """
-    tokens = tokenize(draw, txt, font, max_w)
     n = len(tokens)
-    widths = [draw.textlength(t, font=font) for t in tokens]
+    if n == 0:
+        return [""]
+
+    is_space = [t.isspace() for t in tokens]
     cum = [0.0] * (n + 1)
     for i in range(n):
         cum[i + 1] = cum[i] + widths[i]
+    # 以 token j 开头的行的左端（跳过行首空白）、到位置 i 结束的行的右端（去掉行尾空白），均单调不减
+    start = [cum[j] + (widths[j] if is_space[j] else 0.0) for j in range(n)]
+    end = [0.0] + [cum[i] - (widths[i - 1] if is_space[i - 1] else 0.0) for i in range(1, n + 1)]
+
+    # 在位置 i 断行（下一行以 tokens[i] 开头）的惩罚
+    penalty = [0.0] * (n + 1)
+    depth = 0
+    for i in range(1, n):
+        tok = tokens[i - 1]
+        depth += tok.count("【") - tok.count("】")
+        if depth > 0:
+            penalty[i] += _KP_BRACKET_BREAK_PENALTY
+        if tokens[i][0] in _NO_LINE_START:
+            penalty[i] += _KP_LINE_START_PENALTY
 
     INF = float("inf")
     dp = [INF] * (n + 1)
     prev = [-1] * (n + 1)
     dp[0] = 0.0
 
-    for i in range(1, n + 1):
-        # iterate j backwards for early break when width > max_w
-        for j in range(i - 1, -1, -1):
-            line_width = cum[i] - cum[j]
-            if line_width > max_w:
-                break
-            remaining = max_w - line_width
-            badness = remaining ** 2
-            if i == n:  # 最后一行不计惩罚
-                badness = 0.0
-            cost = dp[j] + badness
-            if cost < dp[i]:
-                dp[i] = cost
-                prev[i] = j
-
-    # if prev[n] == -1 then even after splitting there's no feasible layout (理论上不应发生)
-    if prev[n] == -1:
-        # fallback to greedy splitting (保证有结果)
-        lines = []
-        cur = ""
-        for tok in tokens:
-            trial = cur + tok
-            if draw.textlength(trial, font=font) <= max_w:
-                cur = trial
+    def cost(j: int, i: int) -> float:
+        slack = max_w - (end[i] - start[j])
+        if slack < 0:
+            return INF
+        return dp[j] + (_KP_LINE_PENALTY + 100.0 * (slack / max_w) ** 3) ** 2
+
+    # 队列元素 (j, s)：在下一元素的 s 之前，j 是位置 s 起的最优起点
+    queue: Deque[List[int]] = deque()
+    for i in range(1, n):
+        j = i - 1
+        if dp[j] < INF:
+            # 新候选在 s 处不差于队尾，则队尾的区间整体被接管
+            while queue and queue[-1][1] >= i and cost(j, queue[-1][1]) <= cost(queue[-1][0], queue[-1][1]):
+                queue.pop()
+            if not queue:
+                queue.append([j, i])
             else:
-                if cur:
-                    lines.append(cur)
-                cur = tok
-        if cur:
-            lines.append(cur)
-        return lines
+                lo, hi = max(queue[-1][1], i), n
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if cost(j, mid) <= cost(queue[-1][0], mid):
+                        hi = mid
+                    else:
+                        lo = mid + 1
+                if lo < n:
+                    queue.append([j, lo])
+        while len(queue) >= 2 and queue[1][1] <= i:
+            queue.popleft()
+
+        best = queue[0][0] if queue else -1
+        best_cost = cost(best, i) if best >= 0 else INF
+        if best_cost == INF:
+            # 单个 token 已超宽（tokenize 已尽量拆分，理论上极少出现），强制独占一行
+            best, best_cost = j, dp[j] + _KP_LINE_PENALTY ** 2
+        dp[i] = best_cost + penalty[i]
+        prev[i] = best
+
+    # 最后一行不计剩余宽度，只在有界回看窗口内比较
+    min_w = min((w for w in widths if w > 0), default=1.0)
+    lookback = int(max_w // min_w) + 1
+    best = n - 1
+    for j in range(n - 1, max(-1, n - 1 - lookback), -1):
+        if end[n] - start[j] > max_w:
+            break
+        if dp[j] <= dp[best]:
+            best = j
+    dp[n] = dp[best] + _KP_LINE_PENALTY ** 2
+    prev[n] = best
 
     # 回溯
     lines = []
     idx = n
     while idx > 0:
         j = prev[idx]
-        lines.append("".join(tokens[j:idx]))
+        lines.append("".join(tokens[j:idx]).strip(" \t"))
         idx = j
     lines.reverse()
     return lines
 
 
+def wrap_lines_knuth_plass(
+        draw: ImageDraw.ImageDraw, txt: str, font: ImageFont.FreeTypeFont, max_w: int
+) -> List[str]:
+    """
+    将文本按指定宽度拆分为多行。
+    Knuth–Plass 最优断行：逐段落对 tokenize 的结果做有界回看的动态规划，
+    避免在【】括号内部和禁则标点前断行。
+    """
+    m = _Measurer(draw, font)
+    token_widths: Dict[str, float] = {}
+    lines: List[str] = []
+    for para in txt.splitlines() or [""]:
+        tokens = tokenize(draw, para, font, max_w)
+        widths = []
+        for tok in tokens:
+            w = token_widths.get(tok)
+            if w is None:
+                w = token_widths[tok] = m.exact(tok)
+            widths.append(w)
+        lines.extend(_kp_break_paragraph(tokens, widths, max_w))
+    return lines
+
+
 def parse_color_segments(
     s: str, in_bracket: bool, bracket_color: RGBColor, color: RGBColor
 ) -> Tuple[List[Tuple[str, RGBColor]], bool]:
@@ -325,8 +506,124 @@ def measure_block(
     return max_w, total_h, line_h
 
 
-def draw_text_auto(
-    image_source: Union[str, Image.Image],
+def _wrap(
+    draw: ImageDraw.ImageDraw, text: str, font: ImageFont.FreeTypeFont, max_w: int, wrap_algorithm: str
+) -> List[str]:
+    """根据配置选择换行算法"""
+    with stage("wrap"):
+        if wrap_algorithm == "knuth_plass":
+            return wrap_lines_knuth_plass(draw, text, font, max_w)
+        return wrap_lines(draw, text, font, max_w)
+
+
+def _estimate_font_size(
+    draw: ImageDraw.ImageDraw,
+    text: str,
+    font_path: Optional[str],
+    ref_size: int,
+    region_w: int,
+    region_h: int,
+    line_spacing: float,
+) -> int:
+    """
+    由总前进宽度与区域尺寸估算可容纳的最大字号。
+    前进宽度与行高都近似随字号线性缩放，因此只在参考字号下测量一次：
+    对每个候选行数 n，字号同时受“n 行能放下全部文字”（每行平均浪费半个换行单元）
+    与“n 行高度不超过区域高”约束，取所有 n 中的最大值。
+    """
+    font = _load_font(font_path, ref_size)
+    ascent, descent = font.getmetrics()
+    ref_line_h = (ascent + descent) * (1 + line_spacing)
+    paragraphs = text.splitlines() or [""]
+    total_w = _Measurer(draw, font).width("".join(paragraphs))
+    if ref_line_h <= 0 or total_w <= 0:
+        return ref_size
+
+    units = sum(len(p.split(" ")) if " " in p else len(p) for p in paragraphs)
+    waste = total_w / max(1, units) / 2
+    best = 0.0
+    n = len(paragraphs)
+    while True:
+        # measure_block 对行高取整，平均每行约少 0.5 像素
+        by_height = ref_size * (region_h / n + 0.5) / ref_line_h
+        by_width = ref_size * n * region_w / (total_w + n * waste)
+        best = max(best, min(by_height, by_width))
+        if by_width >= by_height or by_height < 1:
+            break
+        n += 1
+    return max(1, min(ref_size, int(best)))
+
+
+def layout_text(
+    draw: ImageDraw.ImageDraw,
+    text: str,
+    font_path: Optional[str],
+    region_w: int,
+    region_h: int,
+    max_font_height: Optional[int] = None,
+    line_spacing: float = 0.15,
+    wrap_algorithm: str = "original",
+) -> TextLayout:
+    """
+    在 region_w x region_h 内搜索能容纳文本的最大字号，并返回换行结果。
+    从估算字号出发，先探测相邻字号，再按实际块高修正一次，此后在 [可容纳, 不可容纳) 区间内二分，
+    通常 2 次换行即可确定字号；每个字号的换行结果在本次搜索中只计算一次，选中字号直接复用。
+    结果按全部影响排版的参数缓存，重复文本直接复用。
+    """
+    key = (text, font_path, region_w, region_h, line_spacing, wrap_algorithm, max_font_height)
+    cached = _layout_cache.get(key)
+    if cached is not None:
+        return cached
+
+    start = time.perf_counter()
+    hi = min(region_h, max_font_height) if max_font_height else region_h
+    probes: Dict[int, Tuple[bool, List[str], int, int]] = {}
+
+    def fits(size: int) -> bool:
+        if size not in probes:
+            font = _load_font(font_path, size)
+            lines = _wrap(draw, text, font, region_w, wrap_algorithm)
+            w, h, lh = measure_block(draw, lines, font, line_spacing)
+            probes[size] = (w <= region_w and h <= region_h, lines, lh, h)
+        return probes[size][0]
+
+    # good: 已知可容纳的最大字号（0 表示尚无）；bad: 已知不可容纳的最小字号
+    good, bad = 0, hi + 1
+    size = _estimate_font_size(draw, text, font_path, hi, region_w, region_h, line_spacing) if hi >= 1 else 0
+    while bad - good > 1:
+        ok = fits(size)
+        if ok:
+            good = size
+        else:
+            bad = size
+        if len(probes) == 1:
+            # 估算值通常与结果相差不超过 1，先探测相邻字号
+            guess = size + 1 if ok else size - 1
+        elif len(probes) == 2:
+            # 块高约与字号平方成正比，按实际块高修正下一次探测的字号
+            guess = int(size * math.sqrt(region_h / max(1, probes[size][3])))
+            guess = max(guess, size + 1) if ok else min(guess, size - 1)
+        else:
+            guess = (good + bad) // 2
+        size = min(max(guess, good + 1), bad - 1)
+
+    if good == 0:
+        font = _load_font(font_path, 1)
+        best_lines = probes[1][1] if 1 in probes else _wrap(draw, text, font, region_w, wrap_algorithm)
+        layout = TextLayout(1, tuple(best_lines), 1, 1, len(probes))
+    else:
+        _, best_lines, best_line_h, best_block_h = probes[good]
+        layout = TextLayout(good, tuple(best_lines), best_line_h, best_block_h, len(probes))
+
+    # 字号搜索耗时（含其中各次换行）与换行次数
+    observe(STAGE_SECONDS, time.perf_counter() - start, stage="font_search")
+    observe(FONT_PROBES, len(probes))
+    _layout_cache.put(key, layout)
+    return layout
+
+
+def draw_text_onto(
+    img: Image.Image,
     top_left: Tuple[int, int],
     bottom_right: Tuple[int, int],
     text: str,
@@ -337,71 +634,29 @@ def draw_text_auto(
     valign: VAlign = "middle",
     line_spacing: float = 0.15,
     bracket_color: RGBColor = (128, 0, 128),  # 中括号及内部内容颜色
-    image_overlay: Union[str, Image.Image, None] = None,
-    wrap_algorithm: str = "original"  # 新增参数，用于选择换行算法
-) -> bytes:
+    wrap_algorithm: str = "original",
+) -> Image.Image:
     """
-    在指定矩形内自适应字号绘制文本；
+    在画布 img 的指定矩形内自适应字号绘制文本（原地修改并返回 img）；
     中括号及括号内文字使用 bracket_color。
     """
-
-    # --- 1. 打开图像 ---
-    if isinstance(image_source, Image.Image):
-        img = image_source.copy()
-    else:
-        img = Image.open(image_source).convert("RGBA")
     draw = ImageDraw.Draw(img)
 
-    if image_overlay is not None:
-        if isinstance(image_overlay, Image.Image):
-            img_overlay = image_overlay.copy()
-        else:
-            img_overlay = (
-                Image.open(image_overlay).convert("RGBA")
-                if os.path.isfile(image_overlay)
-                else None
-            )
-    else:
-        img_overlay = None
-
     x1, y1 = top_left
     x2, y2 = bottom_right
     if not (x2 > x1 and y2 > y1):
         raise ValueError("无效的文字区域。")
     region_w, region_h = x2 - x1, y2 - y1
 
-    # --- 2. 搜索最大字号 ---
-    hi = min(region_h, max_font_height) if max_font_height else region_h
-    lo, best_size, best_lines, best_line_h, best_block_h = 1, 0, [], 0, 0
+    # --- 1. 搜索最大字号（命中缓存时跳过） ---
+    layout = layout_text(
+        draw, text, font_path, region_w, region_h,
+        max_font_height, line_spacing, wrap_algorithm,
+    )
+    font = _load_font(font_path, layout.font_size)
+    best_lines, best_line_h, best_block_h = layout.lines, layout.line_height, layout.block_height
 
-    while lo <= hi:
-        mid = (lo + hi) // 2
-        font = _load_font(font_path, mid)
-        # 根据配置选择换行算法
-        if wrap_algorithm == "knuth_plass":
-            lines = wrap_lines_knuth_plass(draw, text, font, region_w)
-        else:
-            lines = wrap_lines(draw, text, font, region_w)
-        w, h, lh = measure_block(draw, lines, font, line_spacing)
-        if w <= region_w and h <= region_h:
-            best_size, best_lines, best_line_h, best_block_h = mid, lines, lh, h
-            lo = mid + 1
-        else:
-            hi = mid - 1
-
-    if best_size == 0:
-        font = _load_font(font_path, 1)
-        # 根据配置选择换行算法
-        if wrap_algorithm == "knuth_plass":
-            best_lines = wrap_lines_knuth_plass(draw, text, font, region_w)
-        else:
-            best_lines = wrap_lines(draw, text, font, region_w)
-        best_block_h, best_line_h = 1, 1
-        best_size = 1
-    else:
-        font = _load_font(font_path, best_size)
-
-    # --- 3. 垂直对齐 ---
+    # --- 2. 垂直对齐 ---
     if valign == "top":
         y_start = y1
     elif valign == "middle":
@@ -409,7 +664,8 @@ def draw_text_auto(
     else:
         y_start = y2 - best_block_h
 
-    # --- 4. 绘制 ---
+    # --- 3. 绘制 ---
+    start = time.perf_counter()
     y = y_start
     in_bracket = False
     for ln in best_lines:
@@ -425,11 +681,71 @@ def draw_text_auto(
         )
         for seg_text, seg_color in segments:
             if seg_text:
-                draw.text((x, y), seg_text, font=font, fill=seg_color)
-                x += int(draw.textlength(seg_text, font=font))
+                seg_w = draw.textlength(seg_text, font=font)
+                # 优先使用缓存的字形，字距调整导致宽度不一致时回退到逐次光栅化
+                if not draw_glyphs(draw, (x, y), seg_text, font, seg_color, seg_w):
+                    draw.text((x, y), seg_text, font=font, fill=seg_color)
+                x += int(seg_w)
         y += best_line_h
         if y - y_start > region_h:
             break
+    observe(STAGE_SECONDS, time.perf_counter() - start, stage="draw")
+
+    return img
+
+
+def draw_text_auto(
+    image_source: Union[str, Image.Image],
+    top_left: Tuple[int, int],
+    bottom_right: Tuple[int, int],
+    text: str,
+    color: RGBColor = (0, 0, 0),
+    max_font_height: Optional[int] = None,
+    font_path: Optional[str] = None,
+    align: Align = "center",
+    valign: VAlign = "middle",
+    line_spacing: float = 0.15,
+    bracket_color: RGBColor = (128, 0, 128),  # 中括号及内部内容颜色
+    image_overlay: Union[str, Image.Image, None] = None,
+    wrap_algorithm: str = "original"  # 新增参数，用于选择换行算法
+) -> bytes:
+    """
+    在指定矩形内自适应字号绘制文本；
+    中括号及括号内文字使用 bracket_color。
+    返回 PNG 字节；需要继续合成时请直接使用 draw_text_onto。
+    """
+
+    # --- 1. 打开图像 ---
+    if isinstance(image_source, Image.Image):
+        img = image_source.copy()
+    else:
+        img = Image.open(image_source).convert("RGBA")
+
+    if image_overlay is not None:
+        if isinstance(image_overlay, Image.Image):
+            # 置顶图层只作为粘贴源读取，无需复制
+            img_overlay = image_overlay
+        else:
+            img_overlay = (
+                Image.open(image_overlay).convert("RGBA")
+                if os.path.isfile(image_overlay)
+                else None
+            )
+    else:
+        img_overlay = None
+
+    # --- 2. 排版并绘制 ---
+    draw_text_onto(
+        img, top_left, bottom_right, text,
+        color=color,
+        max_font_height=max_font_height,
+        font_path=font_path,
+        align=align,
+        valign=valign,
+        line_spacing=line_spacing,
+        bracket_color=bracket_color,
+        wrap_algorithm=wrap_algorithm,
+    )
 
     # 覆盖置顶图层（如果有）
     if image_overlay is not None and img_overlay is not None:
@@ -437,7 +753,7 @@ def draw_text_auto(
     elif image_overlay is not None and img_overlay is None:
         print("Warning: overlay image is not exist.")
 
-    # --- 5. 输出 PNG ---
+    # --- 3. 输出 PNG ---
     buf = BytesIO()
     img.save(buf, format="PNG")
     return buf.getvalue()
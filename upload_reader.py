@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# filename: upload_reader.py
+"""
+上传图片读取：原始二进制请求体分块写入临时文件（小文件留在内存），
+data URI / base64 字符串分块解码，避免同一份数据在内存中同时存在多份拷贝。
+"""
+import binascii
+import hashlib
+import tempfile
+from io import BytesIO
+from typing import BinaryIO, NamedTuple
+
+_CHUNK_SIZE = 64 * 1024
+# 超过该大小的上传数据转存到磁盘临时文件
+_SPOOL_MAX_MEMORY = 1024 * 1024
+# base64 中允许出现的空白（换行的 MIME 风格编码）
+_WHITESPACE = b" \t\r\n"
+
+
+class UploadError(ValueError):
+    """上传数据超出大小上限或格式错误"""
+
+
+class Upload(NamedTuple):
+    file: BinaryIO
+    """已定位到开头的图片数据"""
+    digest: str
+    """图片数据的 sha256，用于结果缓存键"""
+    size: int
+
+
+class UploadSpooler:
+    """
+    增量接收上传数据（如异步读取到的请求体分块）：写入临时文件的同时计算摘要并检查大小上限。
+    """
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._file = tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_MEMORY)
+        self._hash = hashlib.sha256()
+        self._size = 0
+
+    def write(self, chunk: bytes) -> None:
+        """追加一块数据，超过 max_bytes 时关闭临时文件并抛出 UploadError"""
+        self._size += len(chunk)
+        if self._size > self._max_bytes:
+            self._file.close()
+            raise UploadError(f"上传数据超过大小上限 {self._max_bytes} 字节")
+        self._hash.update(chunk)
+        self._file.write(chunk)
+
+    def finish(self) -> Upload:
+        """结束写入，返回定位到开头的上传数据"""
+        if self._size == 0:
+            self._file.close()
+            raise UploadError("上传数据为空")
+        self._file.seek(0)
+        return Upload(self._file, self._hash.hexdigest(), self._size)
+
+
+def spool_stream(stream: BinaryIO, max_bytes: int) -> Upload:
+    """分块读取请求体到临时文件并同时计算摘要，超过 max_bytes 时抛出 UploadError"""
+    spooler = UploadSpooler(max_bytes)
+    for chunk in iter(lambda: stream.read(_CHUNK_SIZE), b""):
+        spooler.write(chunk)
+    return spooler.finish()
+
+
+def digest_file(fp: BinaryIO) -> Upload:
+    """为已落地的上传文件（如 multipart 文件字段）计算摘要，读取后回到开头"""
+    h = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: fp.read(_CHUNK_SIZE), b""):
+        h.update(chunk)
+        size += len(chunk)
+    if size == 0:
+        raise UploadError("上传数据为空")
+    fp.seek(0)
+    return Upload(fp, h.hexdigest(), size)
+
+
+def b64decode_chunked(text: str, start: int = 0, chunk_size: int = _CHUNK_SIZE) -> BytesIO:
+    """
+    从 text[start:] 分块解码 base64，结果写入 BytesIO。
+    不复制整段输入（不做切片/拆分），允许其中夹杂空白字符。
+    """
+    chunk_size -= chunk_size % 4
+    out = BytesIO()
+    pending = b""
+    try:
+        for i in range(start, len(text), chunk_size):
+            chunk = pending + text[i:i + chunk_size].encode("ascii").translate(None, _WHITESPACE)
+            usable = len(chunk) - len(chunk) % 4
+            out.write(binascii.a2b_base64(chunk[:usable]))
+            pending = chunk[usable:]
+        if pending:
+            # 兼容省略了末尾填充的输入
+            out.write(binascii.a2b_base64(pending + b"=" * (-len(pending) % 4)))
+    except (UnicodeEncodeError, binascii.Error) as e:
+        raise UploadError(f"base64 数据无效: {e}") from e
+    out.seek(0)
+    return out